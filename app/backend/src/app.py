@@ -7,12 +7,16 @@ from sentry_sdk.integrations import argv, atexit, dedupe, modules, stdlib, threa
 from sentry_sdk.integrations import logging as sentry_logging
 from sqlalchemy.sql import text
 
+from couchers.api_call_log import start_api_call_log_writer
+from couchers.auth_cache import start_auth_cache_listener, start_session_activity_flusher
 from couchers.config import check_config, config
 from couchers.db import apply_migrations, session_scope
-from couchers.jobs.worker import start_jobs_scheduler, start_jobs_worker
+from couchers.geojson_snapshots import start_geojson_snapshots_listener
+from couchers.jobs.worker import start_jobs_scheduler, start_jobs_workers
 from couchers.metrics import create_prometheus_server, main_process_registry
 from couchers.server import create_main_server, create_media_server
 from couchers.tracing import setup_tracing
+from couchers.unread_counts import start_unread_counts_listener
 from dummy_data import add_dummy_data
 
 check_config()
@@ -78,11 +82,16 @@ if config["ROLE"] in ["scheduler", "all"]:
     scheduler = start_jobs_scheduler()
 
 if config["ROLE"] in ["worker", "all"]:
-    worker = start_jobs_worker()
+    workers = start_jobs_workers()
 
 setup_tracing()
 
 if config["ROLE"] in ["api", "all"]:
+    session_activity_flusher = start_session_activity_flusher()
+    auth_cache_listener = start_auth_cache_listener()
+    api_call_log_writer = start_api_call_log_writer()
+    unread_counts_listener = start_unread_counts_listener()
+    geojson_snapshots_listener = start_geojson_snapshots_listener()
     server = create_main_server(port=1751)
     server.start()
     media_server = create_media_server(port=1753)
@@ -0,0 +1,268 @@
+"""
+Asynchronous, batched logging of API calls into logging.api_calls
+
+The interceptor only puts the call on a bounded queue; sanitizing, serializing and inserting happens on a writer thread
+"""
+
+import atexit
+import functools
+import logging
+from copy import deepcopy
+from datetime import timedelta
+from queue import Empty, Full, Queue
+from random import random
+from threading import Event, Thread
+
+from google.protobuf import descriptor_pool
+from sqlalchemy.sql import insert
+
+from couchers.config import config
+from couchers.db import session_scope
+from couchers.descriptor_pool import get_descriptor_pool
+from couchers.metrics import api_calls_log_dropped_counter, api_calls_log_written_counter
+from couchers.models import APICall
+from couchers.utils import now
+from proto import annotations_pb2
+
+logger = logging.getLogger(__name__)
+
+# calls that come in while the queue is full are dropped
+API_CALL_LOG_QUEUE_SIZE = 10_000
+
+# maximum number of rows written in one insert
+API_CALL_LOG_BATCH_SIZE = 500
+
+# how long the writer waits for more calls before writing out a partial batch
+API_CALL_LOG_FLUSH_INTERVAL = timedelta(seconds=1)
+
+# responses are truncated to this many bytes
+TRUNCATE_RESPONSE_BYTES_LENGTH = 16 * 1024  # 16 kB
+
+
+# how a submessage field holding sensitive fields is stored in its parent
+_SINGULAR, _REPEATED, _MAP = range(3)
+
+
+def _get_message_descriptor(full_name):
+    try:
+        return get_descriptor_pool().FindMessageTypeByName(full_name)
+    except KeyError:
+        # not part of our API (e.g. in tests), fall back to the descriptors compiled into the python package
+        return descriptor_pool.Default().FindMessageTypeByName(full_name)
+
+
+def _is_sensitive(field):
+    return field.GetOptions().Extensions[annotations_pb2.sensitive]
+
+
+@functools.cache
+def _contains_sensitive_fields(full_name):
+    """
+    Whether the message type or any message type reachable from it has fields marked sensitive
+    """
+    seen = set()
+    to_visit = [_get_message_descriptor(full_name)]
+    while to_visit:
+        descriptor = to_visit.pop()
+        if descriptor.full_name in seen:
+            continue
+        seen.add(descriptor.full_name)
+        for field in descriptor.fields:
+            if _is_sensitive(field):
+                return True
+            if field.message_type:
+                to_visit.append(field.message_type)
+    return False
+
+
+@functools.cache
+def get_sanitization_plan(full_name):
+    """
+    Works out once per message type which fields need to be cleared before logging
+
+    Returns None if the message type has no sensitive fields anywhere inside it, otherwise a tuple of (names of
+    sensitive fields, tuple of (field name, _SINGULAR/_REPEATED/_MAP, message type) for submessages that need sanitizing)
+    """
+    if not _contains_sensitive_fields(full_name):
+        return None
+
+    descriptor = _get_message_descriptor(full_name)
+    sensitive_fields = []
+    submessages = []
+    for field in descriptor.fields:
+        if _is_sensitive(field):
+            sensitive_fields.append(field.name)
+        elif field.message_type and field.message_type.GetOptions().map_entry:
+            value_type = field.message_type.fields_by_name["value"].message_type
+            if value_type and _contains_sensitive_fields(value_type.full_name):
+                submessages.append((field.name, _MAP, value_type.full_name))
+        elif field.message_type and _contains_sensitive_fields(field.message_type.full_name):
+            kind = _REPEATED if field.label == field.LABEL_REPEATED else _SINGULAR
+            submessages.append((field.name, kind, field.message_type.full_name))
+    return tuple(sensitive_fields), tuple(submessages)
+
+
+def _sanitize_message(message, plan):
+    sensitive_fields, submessages = plan
+    for name in sensitive_fields:
+        message.ClearField(name)
+    for name, kind, full_name in submessages:
+        subplan = get_sanitization_plan(full_name)
+        if kind == _SINGULAR:
+            if message.HasField(name):
+                _sanitize_message(getattr(message, name), subplan)
+        else:
+            values = getattr(message, name)
+            for submessage in values.values() if kind == _MAP else values:
+                _sanitize_message(submessage, subplan)
+
+
+def _sanitized_bytes(proto):
+    """
+    Remove fields marked sensitive and return serialized bytes
+    """
+    if not proto:
+        return None
+
+    plan = get_sanitization_plan(proto.DESCRIPTOR.full_name)
+    if not plan:
+        # nothing to remove, no need to copy
+        return proto.SerializeToString()
+
+    new_proto = deepcopy(proto)
+    _sanitize_message(new_proto, plan)
+    return new_proto.SerializeToString()
+
+
+def _api_call_row(request, response, **kwargs):
+    res_bytes = _sanitized_bytes(response)
+    response_truncated = False
+    if res_bytes and len(res_bytes) > TRUNCATE_RESPONSE_BYTES_LENGTH:
+        res_bytes = res_bytes[:TRUNCATE_RESPONSE_BYTES_LENGTH]
+        response_truncated = True
+    return dict(
+        request=_sanitized_bytes(request),
+        response=res_bytes,
+        response_truncated=response_truncated,
+        **kwargs,
+    )
+
+
+class APICallLog:
+    """
+    A bounded queue of API calls waiting to be written to the database
+    """
+
+    def __init__(self, maxsize, batch_size):
+        self._queue = Queue(maxsize)
+        self._batch_size = batch_size
+
+    def log(
+        self,
+        *,
+        method,
+        status_code,
+        duration,
+        user_id,
+        is_api_key,
+        request,
+        response,
+        traceback,
+        perf_report,
+        ip_address,
+        user_agent,
+    ):
+        """
+        Queues an API call to be logged, never blocks
+
+        Calls that raised are always logged, successful calls are sampled at API_CALL_LOG_SAMPLE_RATE
+        """
+        if not traceback and random() >= config["API_CALL_LOG_SAMPLE_RATE"]:
+            api_calls_log_dropped_counter.labels("sampled").inc()
+            return
+        try:
+            self._queue.put_nowait(
+                dict(
+                    time=now(),
+                    method=method,
+                    status_code=status_code,
+                    duration=duration,
+                    user_id=user_id,
+                    is_api_key=bool(is_api_key),
+                    request=request,
+                    response=response,
+                    traceback=traceback,
+                    perf_report=perf_report,
+                    ip_address=ip_address,
+                    user_agent=user_agent,
+                )
+            )
+        except Full:
+            api_calls_log_dropped_counter.labels("queue_full").inc()
+
+    def _get_batch(self, timeout=None):
+        batch = []
+        try:
+            batch.append(self._queue.get(timeout=timeout) if timeout else self._queue.get_nowait())
+            while len(batch) < self._batch_size:
+                batch.append(self._queue.get_nowait())
+        except Empty:
+            pass
+        return batch
+
+    def _write(self, batch):
+        try:
+            rows = [_api_call_row(**call) for call in batch]
+            with session_scope() as session:
+                session.execute(insert(APICall), rows)
+        except Exception as e:
+            logger.exception("Failed to write API calls", exc_info=e)
+            api_calls_log_dropped_counter.labels("error").inc(len(batch))
+        else:
+            api_calls_log_written_counter.inc(len(batch))
+
+    def write_batch(self, timeout=None):
+        """
+        Writes out up to one batch of queued calls, waiting up to timeout seconds for the first one
+
+        Returns the number of calls taken off the queue
+        """
+        batch = self._get_batch(timeout)
+        if batch:
+            self._write(batch)
+        return len(batch)
+
+    def flush(self):
+        """
+        Writes out everything currently queued
+        """
+        while self.write_batch():
+            pass
+
+    def clear(self):
+        while self._get_batch():
+            pass
+
+
+api_call_log = APICallLog(API_CALL_LOG_QUEUE_SIZE, API_CALL_LOG_BATCH_SIZE)
+
+
+def start_api_call_log_writer():
+    """
+    Starts a daemon thread that writes out queued API calls, and flushes the rest at exit
+    """
+    stop = Event()
+
+    def run():
+        while not stop.is_set():
+            api_call_log.write_batch(timeout=API_CALL_LOG_FLUSH_INTERVAL.total_seconds())
+
+    def shutdown():
+        stop.set()
+        t.join()
+        api_call_log.flush()
+
+    t = Thread(target=run, name="api_call_log_writer", daemon=True)
+    t.start()
+    atexit.register(shutdown)
+    return t
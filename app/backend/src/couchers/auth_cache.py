@@ -0,0 +1,206 @@
+"""
+In-process cache of session token -> user auth details for the auth interceptor, and batched updates of session
+activity (last seen time, API call count, user last active time)
+"""
+
+import atexit
+import hashlib
+import logging
+from collections import Counter
+from datetime import timedelta
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from sqlalchemy import Integer, String, column, event, values
+from sqlalchemy.sql import func, update
+
+from couchers.db import session_scope, start_notify_listener
+from couchers.models import User, UserSession
+from couchers.sql import couchers_select as select
+from couchers.utils import now
+
+logger = logging.getLogger(__name__)
+
+# how long a token's auth details are trusted without going back to the database. Changes made through the API
+# invalidate the cache in every process straight away, this bounds how stale it can get due to changes made elsewhere
+AUTH_CACHE_TTL = timedelta(seconds=60)
+
+# dropped auth details are announced on this channel so every API process drops them, the payload is "user:<user id>"
+# or "token:<sha256 of the token>", so that tokens aren't sent around
+AUTH_CACHE_NOTIFY_CHANNEL = "auth_cache"
+
+# how often the recorded session activity is written to the database
+SESSION_ACTIVITY_FLUSH_INTERVAL = timedelta(seconds=15)
+
+# we update the user last active time only if it's been a while
+USER_LAST_ACTIVE_RESOLUTION = timedelta(minutes=5)
+
+
+def _token_digest(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class AuthCache:
+    """
+    A TTL cache of (token, is_api_key) -> (user_id, is_jailed, is_superuser, token_expiry)
+
+    Only valid sessions are cached, unknown or invalid tokens always go to the database.
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl.total_seconds()
+        self._lock = Lock()
+        # (token, is_api_key) -> (cached until, auth info)
+        self._entries = {}
+
+    def get(self, token, is_api_key):
+        with self._lock:
+            entry = self._entries.get((token, is_api_key))
+            if not entry:
+                return None
+            cached_until, auth_info = entry
+            _, _, _, token_expiry = auth_info
+            if cached_until < monotonic() or token_expiry < now():
+                del self._entries[(token, is_api_key)]
+                return None
+            return auth_info
+
+    def put(self, token, is_api_key, auth_info):
+        with self._lock:
+            self._entries[(token, is_api_key)] = (monotonic() + self._ttl, auth_info)
+
+    def invalidate_token(self, token):
+        with self._lock:
+            self._entries.pop((token, False), None)
+            self._entries.pop((token, True), None)
+
+    def invalidate_token_digest(self, digest):
+        with self._lock:
+            for key in [key for key in self._entries if _token_digest(key[0]) == digest]:
+                del self._entries[key]
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            for key in [key for key, (_, auth_info) in self._entries.items() if auth_info[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SessionActivityBuffer:
+    """
+    Collects session activity in memory so it can be written out in one transaction instead of once per API call
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._api_calls = Counter()
+        self._active_user_ids = set()
+
+    def record(self, token, user_id):
+        with self._lock:
+            self._api_calls[token] += 1
+            self._active_user_ids.add(user_id)
+
+    def flush(self):
+        with self._lock:
+            api_calls, self._api_calls = self._api_calls, Counter()
+            active_user_ids, self._active_user_ids = self._active_user_ids, set()
+
+        if not api_calls:
+            return
+
+        logger.debug(f"Flushing session activity for {len(api_calls)} sessions")
+
+        activity = values(
+            column("token", String),
+            column("api_calls", Integer),
+            name="activity",
+        ).data(sorted(api_calls.items()))
+
+        with session_scope() as session:
+            session.execute(
+                update(UserSession)
+                .where(UserSession.token == activity.c.token)
+                .values(last_seen=func.now(), api_calls=UserSession.api_calls + activity.c.api_calls)
+                .execution_options(synchronize_session=False)
+            )
+            session.execute(
+                update(User)
+                .where(User.id.in_(sorted(active_user_ids)))
+                .where(User.last_active < func.now() - USER_LAST_ACTIVE_RESOLUTION)
+                .values(last_active=func.now())
+                .execution_options(synchronize_session=False)
+            )
+
+
+auth_cache = AuthCache(AUTH_CACHE_TTL)
+session_activity = SessionActivityBuffer()
+
+
+def invalidate_user_auth_on_commit(session, user_id):
+    """
+    Drops cached auth details for all of the user's sessions once the current transaction commits, in every process.
+    Call this whenever something changes whether a user is visible, jailed, or a superuser.
+    """
+    # delivered when the transaction commits
+    session.execute(select(func.pg_notify(AUTH_CACHE_NOTIFY_CHANNEL, f"user:{user_id}")))
+    event.listen(session, "after_commit", lambda _: auth_cache.invalidate_user(user_id), once=True)
+
+
+def invalidate_token_auth_on_commit(session, token):
+    """
+    Drops cached auth details for the given session token once the current transaction commits, in every process
+    """
+    session.execute(select(func.pg_notify(AUTH_CACHE_NOTIFY_CHANNEL, f"token:{_token_digest(token)}")))
+    event.listen(session, "after_commit", lambda _: auth_cache.invalidate_token(token), once=True)
+
+
+def handle_auth_cache_notify(payload):
+    """
+    Called for each notification on AUTH_CACHE_NOTIFY_CHANNEL
+    """
+    kind, _, value = payload.partition(":")
+    if kind == "user":
+        auth_cache.invalidate_user(int(value))
+    elif kind == "token":
+        auth_cache.invalidate_token_digest(value)
+    else:
+        logger.warning(f"Unknown auth cache notification: {payload!r}")
+
+
+def start_auth_cache_listener():
+    """
+    Starts a daemon thread that drops cached auth details when other processes announce changes
+    """
+    # anything cached before we started listening may have missed a change
+    return start_notify_listener(AUTH_CACHE_NOTIFY_CHANNEL, handle_auth_cache_notify, auth_cache.clear)
+
+
+def _flush_session_activity():
+    try:
+        session_activity.flush()
+    except Exception as e:
+        logger.exception("Failed to flush session activity", exc_info=e)
+
+
+def start_session_activity_flusher():
+    """
+    Starts a daemon thread that periodically writes out recorded session activity, and flushes once more at exit
+    """
+    stop = Event()
+
+    def run():
+        while not stop.wait(SESSION_ACTIVITY_FLUSH_INTERVAL.total_seconds()):
+            _flush_session_activity()
+
+    def shutdown():
+        stop.set()
+        _flush_session_activity()
+
+    t = Thread(target=run, name="session_activity_flusher", daemon=True)
+    t.start()
+    atexit.register(shutdown)
+    return t
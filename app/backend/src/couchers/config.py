@@ -57,6 +57,8 @@ CONFIG_OPTIONS = [
     ("CONTRIBUTOR_FORM_EMAIL_RECIPIENT", str),
     # Address to moderation notifications
     ("MODS_EMAIL_RECIPIENT", str),
+    # Re-read email templates from disk for every email instead of caching them, for editing templates in development
+    ("EMAIL_TEMPLATE_AUTO_RELOAD", bool, "0"),
     # SMTP settings
     ("SMTP_HOST", str),
     ("SMTP_PORT", int),
@@ -84,6 +86,20 @@ CONFIG_OPTIONS = [
     ("LISTMONK_BASE_URL", str),
     ("LISTMONK_API_KEY", str),
     ("LISTMONK_LIST_UUID", str),
+    # Background job workers: number of worker processes, and threads per process servicing all queues
+    ("JOB_WORKER_PROCESSES", int, "1"),
+    ("JOB_WORKER_THREADS", int, "1"),
+    # Comma separated list of queue:threads, each worker process runs that many threads servicing only that queue, e.g.
+    # "default:2,push:1,email:1", replaces JOB_WORKER_THREADS if set
+    ("JOB_WORKER_QUEUES", str, ""),
+    # Comma separated list of job_type:max_threads, caps how many threads per worker process run a job type at once
+    (
+        "JOB_CONCURRENCY_LIMITS",
+        str,
+        "send_raw_push_notification:2,send_raw_push_notifications:1,send_email:2",
+    ),
+    # Fraction of successful API calls that are logged to logging.api_calls, failed calls are always logged
+    ("API_CALL_LOG_SAMPLE_RATE", float, "1"),
     # Whether we're in test
     ("IN_TEST", bool, "0"),
 ]
@@ -156,3 +172,15 @@ def check_config():
     if config["ENABLE_STRONG_VERIFICATION"]:
         if not config["IRIS_ID_PUBKEY"] or not config["IRIS_ID_SECRET"] or not config["VERIFICATION_DATA_PUBLIC_KEY"]:
             raise Exception("No Iris ID pubkey/secret or verification data pubkey but strong verification enabled")
+
+
+def get_job_worker_threads():
+    """
+    Parses JOB_WORKER_QUEUES into a list of (queue, threads), where a queue of None means all queues
+    """
+    queues = []
+    for entry in config["JOB_WORKER_QUEUES"].split(","):
+        if entry.strip():
+            queue, threads = entry.split(":")
+            queues.append((queue.strip(), int(threads)))
+    return queues or [(None, config["JOB_WORKER_THREADS"])]
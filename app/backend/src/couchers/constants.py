@@ -29,7 +29,11 @@ DATETIME_INFINITY = pytz.UTC.localize(datetime(9876, 12, 31, hour=23, minute=59,
 
 SERVER_THREADS = 128
 
-WORKER_THREADS = 1
+# threads running the sub-searches of Search, each holds a database connection while searching
+SEARCH_THREADS = 16
+
+# how long a message has to go unseen before we notify about it by email
+MISSED_MESSAGES_NOTIFICATION_DELAY = timedelta(minutes=5)
 
 # how long the user has to undelete their account
 UNDELETE_DAYS = 7
@@ -3,9 +3,11 @@ import inspect
 import logging
 import os
 from contextlib import contextmanager
+from datetime import timedelta
 from os import getpid
-from threading import get_ident
-from time import perf_counter_ns
+from select import select as wait_until_readable
+from threading import Thread, get_ident
+from time import perf_counter_ns, sleep
 
 from alembic import command
 from alembic.config import Config
@@ -16,8 +18,8 @@ from sqlalchemy.orm.session import Session
 from sqlalchemy.pool import QueuePool
 from sqlalchemy.sql import and_, func, literal, or_
 
-from couchers.config import config
-from couchers.constants import SERVER_THREADS, WORKER_THREADS
+from couchers.config import config, get_job_worker_threads
+from couchers.constants import SEARCH_THREADS, SERVER_THREADS
 from couchers.models import (
     Cluster,
     ClusterRole,
@@ -35,6 +37,9 @@ logger = logging.getLogger(__name__)
 
 tracer = trace.get_tracer(__name__)
 
+# how often notification listeners wake up to check their connection when there are no notifications
+NOTIFY_LISTEN_INTERVAL = timedelta(seconds=60)
+
 
 def apply_migrations():
     alembic_dir = os.path.dirname(__file__) + "/../.."
@@ -58,8 +63,9 @@ def _get_base_engine():
         pool_pre_ping=True,
         # one connection per thread
         poolclass=QueuePool,
-        # main threads + a few extra in case
-        pool_size=SERVER_THREADS + WORKER_THREADS + 12,
+        # main threads + search threads + a few extra in case. job worker threads each hold a listening connection, and
+        # one session at a time to claim a job, run it, or record its outcome
+        pool_size=SERVER_THREADS + SEARCH_THREADS + 2 * sum(threads for _, threads in get_job_worker_threads()) + 12,
     )
 
 
@@ -92,48 +98,51 @@ def session_scope():
                     logger.debug(f"SScope: closed {backend_pid=}")
 
 
-@contextmanager
-def worker_repeatable_read_session_scope():
+def db_post_fork():
     """
-    This is a separate sesson scope that is isolated from the main one since otherwise we end up nesting transactions,
-    this causes two different connections to be used
-
-    This operates in a `REPEATABLE READ` isolation level so that we can do a `SELECT ... FOR UPDATE SKIP LOCKED` in the
-    background worker, effectively using postgres as a queueing system.
+    Fix post-fork issues with sqlalchemy
     """
-    with tracer.start_as_current_span("worker_session_scope") as rollspan:
-        with Session(_get_base_engine().execution_options(isolation_level="REPEATABLE READ")) as session:
-            session.begin()
-            try:
-                if logger.isEnabledFor(logging.DEBUG):
-                    try:
-                        frame = inspect.stack()[2]
-                        filename_line = f"{frame.filename}:{frame.lineno}"
-                    except Exception as e:
-                        filename_line = "{unknown file}"
-                    backend_pid = session.execute(text("SELECT pg_backend_pid();")).scalar()
-                    logger.debug(f"SScope (worker): got {backend_pid=} at {filename_line}")
-                    rollspan.set_attribute("db.backend_pid", backend_pid)
-                    rollspan.set_attribute("db.filename_line", filename_line)
-                rollspan.set_attribute("rpc.thread", get_ident())
-                rollspan.set_attribute("rpc.pid", getpid())
+    # see https://docs.sqlalchemy.org/en/20/core/pooling.html#using-connection-pools-with-multiprocessing-or-os-fork
+    _get_base_engine().dispose(close=False)
 
-                yield session
-                session.commit()
-            except:
-                session.rollback()
-                raise
-            finally:
-                if logger.isEnabledFor(logging.DEBUG):
-                    logger.debug(f"SScope (worker): closed {backend_pid=}")
+
+def _listen_for_notifications(channel, handle_payload, on_listen):
+    connection = _get_base_engine().raw_connection()
+    try:
+        dbapi_connection = connection.driver_connection
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {channel};")
+        on_listen()
+        while True:
+            wait_until_readable([dbapi_connection], [], [], NOTIFY_LISTEN_INTERVAL.total_seconds())
+            dbapi_connection.poll()
+            for notify in dbapi_connection.notifies:
+                handle_payload(notify.payload)
+            dbapi_connection.notifies.clear()
+    finally:
+        connection.invalidate()
 
 
-def db_post_fork():
+def start_notify_listener(channel, handle_payload, on_listen):
     """
-    Fix post-fork issues with sqlalchemy
+    Starts a daemon thread that calls handle_payload with the payload of each notification on channel, reconnecting if
+    anything goes wrong
+
+    on_listen is called every time the thread starts listening, since anything could have been missed until then
     """
-    # see https://docs.sqlalchemy.org/en/20/core/pooling.html#using-connection-pools-with-multiprocessing-or-os-fork
-    _get_base_engine().dispose(close=False)
+
+    def run():
+        while True:
+            try:
+                _listen_for_notifications(channel, handle_payload, on_listen)
+            except Exception as e:
+                logger.exception(f"Listener for {channel} failed, reconnecting", exc_info=e)
+                sleep(1)
+
+    t = Thread(target=run, name=f"{channel}_listener", daemon=True)
+    t.start()
+    return t
 
 
 @event.listens_for(Engine, "before_cursor_execute")
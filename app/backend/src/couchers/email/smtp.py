@@ -1,15 +1,30 @@
+import functools
+import logging
 import smtplib
+from contextlib import contextmanager
+from datetime import timedelta
 from email.headerregistry import Address
 from email.message import EmailMessage
 from email.utils import make_msgid
 from pathlib import Path
+from threading import Lock
+from time import monotonic
 
 from couchers.config import config
 from couchers.crypto import EMAIL_SOURCE_DATA_KEY_NAME, random_hex, simple_hash_signature
+from couchers.metrics import smtp_connections_opened_counter
 from couchers.models import Email
 
+logger = logging.getLogger(__name__)
+
 template_base = Path(Path(__file__).parent / ".." / ".." / ".." / "templates" / "v2")
 
+# a connection that has been sitting idle for longer than this is checked with a NOOP before it's reused
+SMTP_NOOP_INTERVAL = timedelta(seconds=30)
+
+# connections are closed and reopened after this long, so we don't hold on to one forever
+SMTP_MAX_CONNECTION_AGE = timedelta(minutes=10)
+
 
 def make_cid(sender_email):
     cid = make_msgid(domain=Address(addr_spec=sender_email).domain)
@@ -17,11 +32,109 @@ def make_cid(sender_email):
     return cid, without_tag
 
 
-def send_smtp_email(sender_name, sender_email, recipient, subject, plain, html, list_unsubscribe_header, source_data):
+@functools.cache
+def get_attachments():
     """
-    Sends out the email through SMTP, settings from config.
+    Reads the png files in attachment_imgs/ once
 
-    Returns a models.Email object that can be straight away added to the database.
+    Returns a tuple of (path as used in the html, png bytes)
+    """
+    return tuple(
+        (str(attachment.relative_to(template_base)), attachment.read_bytes())
+        for attachment in sorted((template_base / "attachment_imgs").glob("*.png"))
+    )
+
+
+def _open_connection():
+    server = smtplib.SMTP(config["SMTP_HOST"], config["SMTP_PORT"])
+    try:
+        server.ehlo()
+        if not config["DEV"]:
+            server.starttls()
+            # stmplib docs recommend calling ehlo() before and after starttls()
+            server.ehlo()
+            server.login(config["SMTP_USERNAME"], config["SMTP_PASSWORD"])
+    except Exception:
+        server.close()
+        raise
+    smtp_connections_opened_counter.inc()
+    return server
+
+
+def _close_connection(server):
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+def _is_alive(server):
+    try:
+        code, _ = server.noop()
+    except (smtplib.SMTPException, OSError):
+        return False
+    return code == 250
+
+
+class SMTPConnectionPool:
+    """
+    Keeps authenticated SMTP connections open between emails instead of connecting (and doing STARTTLS and logging in)
+    for each one
+
+    Each connection is used by one thread at a time; idle ones are checked with a NOOP before they're handed out again.
+    """
+
+    def __init__(self, noop_interval, max_age):
+        self._noop_interval = noop_interval.total_seconds()
+        self._max_age = max_age.total_seconds()
+        self._lock = Lock()
+        # list of (server, opened at, last used at)
+        self._idle = []
+
+    def _get(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                server, opened_at, last_used_at = self._idle.pop()
+            if monotonic() - opened_at > self._max_age:
+                _close_connection(server)
+                continue
+            if monotonic() - last_used_at > self._noop_interval and not _is_alive(server):
+                logger.info("Idle SMTP connection went stale, reconnecting")
+                server.close()
+                continue
+            return server, opened_at
+        return _open_connection(), monotonic()
+
+    @contextmanager
+    def connection(self):
+        """
+        Gives out a connected SMTP object. It's returned to the pool afterwards unless something went wrong using it.
+        """
+        server, opened_at = self._get()
+        try:
+            yield server
+        except Exception:
+            # the connection may be in a bad state, don't reuse it
+            server.close()
+            raise
+        with self._lock:
+            self._idle.append((server, opened_at, monotonic()))
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for server, _, _ in idle:
+            _close_connection(server)
+
+
+smtp_pool = SMTPConnectionPool(SMTP_NOOP_INTERVAL, SMTP_MAX_CONNECTION_AGE)
+
+
+def _build_smtp_email(sender_name, sender_email, recipient, subject, plain, html, list_unsubscribe_header, source_data):
+    """
+    Returns (EmailMessage to send, models.Email to store)
     """
     message_id = random_hex()
     msg = EmailMessage()
@@ -42,12 +155,10 @@ def send_smtp_email(sender_name, sender_email, recipient, subject, plain, html,
     if html:
         # for any png files in attachment_imgs/, goes through and replaces instances of the filename with attachment
         used_attachments = []
-        for attachment in (template_base / "attachment_imgs").glob("*.png"):
-            attachment_html_path = str(attachment.relative_to(template_base))
+        for attachment_html_path, data in get_attachments():
             if attachment_html_path not in html:
                 continue
             # it's used in this template, so attach and replace it
-            data = attachment.read_bytes()
             cid, wcid = make_cid(sender_email)
             html = html.replace(attachment_html_path, f"cid:{wcid}")
             used_attachments.append((cid, "image", "png", data))
@@ -57,16 +168,7 @@ def send_smtp_email(sender_name, sender_email, recipient, subject, plain, html,
         for cid, mime_type, mime_subtype, data in used_attachments:
             msg.get_payload()[1].add_related(data, mime_type, mime_subtype, cid=cid)
 
-    with smtplib.SMTP(config["SMTP_HOST"], config["SMTP_PORT"]) as server:
-        server.ehlo()
-        if not config["DEV"]:
-            server.starttls()
-            # stmplib docs recommend calling ehlo() before and after starttls()
-            server.ehlo()
-            server.login(config["SMTP_USERNAME"], config["SMTP_PASSWORD"])
-        server.sendmail(sender_email, recipient, msg.as_string())
-
-    return Email(
+    return msg, Email(
         id=message_id,
         sender_name=sender_name,
         sender_email=sender_email,
@@ -77,3 +179,17 @@ def send_smtp_email(sender_name, sender_email, recipient, subject, plain, html,
         list_unsubscribe_header=list_unsubscribe_header,
         source_data=source_data,
     )
+
+
+def send_smtp_email(sender_name, sender_email, recipient, subject, plain, html, list_unsubscribe_header, source_data):
+    """
+    Sends out the email through SMTP, settings from config.
+
+    Returns a models.Email object that can be straight away added to the database.
+    """
+    msg, email = _build_smtp_email(
+        sender_name, sender_email, recipient, subject, plain, html, list_unsubscribe_header, source_data
+    )
+    with smtp_pool.connection() as server:
+        server.sendmail(sender_email, recipient, msg.as_string())
+    return email
@@ -85,6 +85,7 @@ INVALID_PASSWORD = "Wrong password."
 INVALID_PHONE = "Phone number must be in international format without punctuation."
 INVALID_RECIPIENTS = "Invalid recipients list."
 INVALID_REGION = "Invalid region."
+INVALID_TILE = "Invalid map tile."
 INVALID_TOKEN = "Invalid token."
 INVALID_USERNAME = "Invalid username."
 INVITE_PERMISSION_DENIED = "You're not allowed to invite users."
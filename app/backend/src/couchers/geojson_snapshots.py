@@ -0,0 +1,153 @@
+"""
+In-memory snapshots of the GeoJSON served by GIS.GetCommunities, GetPlaces and GetGuides
+
+These change rarely but are big, so each is built once by postgres, compressed once, and served from memory until a
+community or page edit commits or the snapshot gets too old. The process doing the edit drops its snapshots on commit
+and announces the affected layers on GEOJSON_SNAPSHOTS_NOTIFY_CHANNEL so other API processes can do the same.
+"""
+
+import gzip
+import logging
+from dataclasses import dataclass
+from datetime import timedelta
+from itertools import chain
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+
+from couchers.db import start_notify_listener
+from couchers.models import Node, Page, PageVersion
+from couchers.sql import couchers_select as select
+from couchers.tiles import make_etag
+
+logger = logging.getLogger(__name__)
+
+# edits are announced on this channel, the payload is a comma separated list of layers
+GEOJSON_SNAPSHOTS_NOTIFY_CHANNEL = "geojson_snapshots"
+
+# snapshots are rebuilt at least this often, bounds staleness if a change notification is missed
+GEOJSON_SNAPSHOT_MAX_AGE = timedelta(minutes=10)
+
+_SESSION_INFO_KEY = "geojson_snapshot_changes"
+
+
+@dataclass(frozen=True, kw_only=True)
+class GeoJSONSnapshot:
+    data: bytes
+    gzipped: bytes
+    etag: str
+
+    @property
+    def gzipped_etag(self):
+        # each encoding is a different representation, so gets its own etag
+        return self.etag[:-1] + '-gzip"'
+
+
+class GeoJSONSnapshots:
+    """
+    Layer name -> GeoJSONSnapshot, built on demand
+    """
+
+    def __init__(self, max_age):
+        self._max_age = max_age.total_seconds()
+        self._lock = Lock()
+        # layer -> (valid until, snapshot)
+        self._snapshots = {}
+        # one lock per layer so only one request builds it at a time
+        self._build_locks = {}
+        # bumped on every invalidation, so a snapshot built before a change can't be kept after it
+        self._generation = 0
+
+    def _get_cached(self, layer):
+        with self._lock:
+            entry = self._snapshots.get(layer)
+            if entry and entry[0] >= monotonic():
+                return entry[1]
+            return None
+
+    def get(self, session, layer, build):
+        """
+        Gets the snapshot of layer, calling build(session) for the GeoJSON bytes if there isn't an up to date one
+        """
+        snapshot = self._get_cached(layer)
+        if snapshot:
+            return snapshot
+        with self._lock:
+            build_lock = self._build_locks.setdefault(layer, Lock())
+        with build_lock:
+            # someone else may have built it while we were waiting
+            snapshot = self._get_cached(layer)
+            if snapshot:
+                return snapshot
+            generation = self._generation
+            data = build(session)
+            snapshot = GeoJSONSnapshot(data=data, gzipped=gzip.compress(data), etag=make_etag(data))
+            with self._lock:
+                if generation == self._generation:
+                    self._snapshots[layer] = (monotonic() + self._max_age, snapshot)
+            return snapshot
+
+    def invalidate(self, layers):
+        with self._lock:
+            for layer in layers:
+                self._snapshots.pop(layer, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._snapshots.clear()
+            self._generation += 1
+
+
+geojson_snapshots = GeoJSONSnapshots(GEOJSON_SNAPSHOT_MAX_AGE)
+
+
+def _after_flush(session, flush_context):
+    """
+    Works out which snapshots are affected by what was just flushed, and announces them
+    """
+    layers = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Node):
+            layers.add("communities")
+        elif isinstance(obj, (Page, PageVersion)):
+            layers.update(("places", "guides"))
+    if not layers:
+        return
+    session.execute(select(func.pg_notify(GEOJSON_SNAPSHOTS_NOTIFY_CHANNEL, ",".join(sorted(layers)))))
+    session.info.setdefault(_SESSION_INFO_KEY, set()).update(layers)
+
+
+def _after_commit(session):
+    layers = session.info.pop(_SESSION_INFO_KEY, None)
+    if layers:
+        geojson_snapshots.invalidate(layers)
+
+
+def _after_rollback(session):
+    session.info.pop(_SESSION_INFO_KEY, None)
+
+
+event.listen(Session, "after_flush", _after_flush)
+event.listen(Session, "after_commit", _after_commit)
+event.listen(Session, "after_rollback", _after_rollback)
+
+
+def handle_geojson_snapshots_notify(payload):
+    """
+    Called for each notification on GEOJSON_SNAPSHOTS_NOTIFY_CHANNEL
+    """
+    geojson_snapshots.invalidate(payload.split(","))
+
+
+def start_geojson_snapshots_listener():
+    """
+    Starts a daemon thread that drops snapshots when other processes announce edits
+    """
+    # anything built before we started listening may have missed an edit
+    return start_notify_listener(
+        GEOJSON_SNAPSHOTS_NOTIFY_CHANNEL, handle_geojson_snapshots_notify, geojson_snapshots.clear
+    )
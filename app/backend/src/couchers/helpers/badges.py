@@ -1,6 +1,6 @@
 from sqlalchemy.sql import delete
 
-from couchers.models import UserBadge
+from couchers.models import UserBadge, mark_recommendation_scores_stale
 from couchers.notifications.notify import notify
 from couchers.resources import get_badge_dict
 from proto import notification_data_pb2
@@ -26,6 +26,8 @@ def user_add_badge(session, user_id, badge_id):
 def user_remove_badge(session, user_id, badge_id):
     badge = get_badge_dict()[badge_id]
     session.execute(delete(UserBadge).where(UserBadge.user_id == user_id, UserBadge.badge_id == badge_id))
+    # bulk deletes don't go through the mapper events
+    mark_recommendation_scores_stale(session, [user_id])
     session.flush()
     notify(
         session,
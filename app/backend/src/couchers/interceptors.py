@@ -1,6 +1,4 @@
 import logging
-from copy import deepcopy
-from datetime import timedelta
 from os import getpid
 from threading import get_ident
 from time import perf_counter_ns
@@ -9,26 +7,25 @@ from traceback import format_exception
 import grpc
 import sentry_sdk
 from opentelemetry import trace
-from sqlalchemy.sql import func
 
 from couchers import errors
+from couchers.api_call_log import api_call_log
+from couchers.auth_cache import auth_cache, session_activity
 from couchers.db import session_scope
 from couchers.descriptor_pool import get_descriptor_pool
 from couchers.metrics import observe_in_servicer_duration_histogram
-from couchers.models import APICall, User, UserSession
+from couchers.models import User, UserSession
 from couchers.profiler import CouchersProfiler
 from couchers.sql import couchers_select as select
-from couchers.utils import create_session_cookies, now, parse_api_key, parse_session_cookie, parse_user_id_cookie
+from couchers.utils import create_session_cookies, parse_api_key, parse_session_cookie, parse_user_id_cookie
 from proto import annotations_pb2
 
 logger = logging.getLogger(__name__)
 
 
-def _try_get_and_update_user_details(token, is_api_key):
+def _try_get_user_details(token, is_api_key):
     """
-    Tries to get session and user info corresponding to this token.
-
-    Also updates the user last active time, token last active time, and increments API call count.
+    Tries to get session and user info corresponding to this token from the database.
     """
     if not token:
         return None
@@ -47,16 +44,30 @@ def _try_get_and_update_user_details(token, is_api_key):
             return None
         else:
             user, user_session = result
+            return user.id, user.is_jailed, user.is_superuser, user_session.expiry
 
-            # update user last active time if it's been a while
-            if now() - user.last_active > timedelta(minutes=5):
-                user.last_active = func.now()
 
-            # let's update the token
-            user_session.last_seen = func.now()
-            user_session.api_calls += 1
+def _try_get_and_update_user_details(token, is_api_key):
+    """
+    Tries to get session and user info corresponding to this token, going through the in-process auth cache.
+
+    Also records the call so that the user last active time, token last active time, and API call count are updated
+    with the next session activity flush.
+    """
+    if not token:
+        return None
 
-            return user.id, user.is_jailed, user.is_superuser, user_session.expiry
+    auth_info = auth_cache.get(token, is_api_key)
+    if not auth_info:
+        auth_info = _try_get_user_details(token, is_api_key)
+        if not auth_info:
+            return None
+        auth_cache.put(token, is_api_key, auth_info)
+
+    user_id, _, _, _ = auth_info
+    session_activity.record(token, user_id)
+
+    return auth_info
 
 
 def abort_handler(message, status_code):
@@ -261,73 +272,6 @@ class TracingInterceptor(grpc.ServerInterceptor):
     Measures and logs the time it takes to service each incoming call.
     """
 
-    def _sanitized_bytes(self, proto):
-        """
-        Remove fields marked sensitive and return serialized bytes
-        """
-        if not proto:
-            return None
-
-        new_proto = deepcopy(proto)
-
-        def _sanitize_message(message):
-            for name, descriptor in message.DESCRIPTOR.fields_by_name.items():
-                if descriptor.GetOptions().Extensions[annotations_pb2.sensitive]:
-                    message.ClearField(name)
-                if descriptor.message_type:
-                    submessage = getattr(message, name)
-                    if not submessage:
-                        continue
-                    if descriptor.label == descriptor.LABEL_REPEATED:
-                        for msg in submessage:
-                            _sanitize_message(msg)
-                    else:
-                        _sanitize_message(submessage)
-
-        _sanitize_message(new_proto)
-
-        return new_proto.SerializeToString()
-
-    def _store_log(
-        self,
-        method,
-        status_code,
-        duration,
-        user_id,
-        is_api_key,
-        request,
-        response,
-        traceback,
-        perf_report,
-        ip_address,
-        user_agent,
-    ):
-        req_bytes = self._sanitized_bytes(request)
-        res_bytes = self._sanitized_bytes(response)
-        with session_scope() as session:
-            response_truncated = False
-            truncate_res_bytes_length = 16 * 1024  # 16 kB
-            if res_bytes and len(res_bytes) > truncate_res_bytes_length:
-                res_bytes = res_bytes[:truncate_res_bytes_length]
-                response_truncated = True
-            session.add(
-                APICall(
-                    is_api_key=is_api_key,
-                    method=method,
-                    status_code=status_code,
-                    duration=duration,
-                    user_id=user_id,
-                    request=req_bytes,
-                    response=res_bytes,
-                    response_truncated=response_truncated,
-                    traceback=traceback,
-                    perf_report=perf_report,
-                    ip_address=ip_address,
-                    user_agent=user_agent,
-                )
-            )
-        logger.debug(f"{user_id=}, {method=}, {duration=} ms")
-
     def intercept_service(self, continuation, handler_call_details):
         handler = continuation(handler_call_details)
         prev_func = handler.unary_unary
@@ -346,8 +290,18 @@ class TracingInterceptor(grpc.ServerInterceptor):
                 duration = (finished - start) / 1e6  # ms
                 user_id = getattr(context, "user_id", None)
                 is_api_key = getattr(context, "is_api_key", None)
-                self._store_log(
-                    method, None, duration, user_id, is_api_key, request, res, None, prof.report, ip_address, user_agent
+                api_call_log.log(
+                    method=method,
+                    status_code=None,
+                    duration=duration,
+                    user_id=user_id,
+                    is_api_key=is_api_key,
+                    request=request,
+                    response=res,
+                    traceback=None,
+                    perf_report=prof.report,
+                    ip_address=ip_address,
+                    user_agent=user_agent,
                 )
                 observe_in_servicer_duration_histogram(method, user_id, "", "", duration / 1000)
             except Exception as e:
@@ -357,8 +311,18 @@ class TracingInterceptor(grpc.ServerInterceptor):
                 traceback = "".join(format_exception(type(e), e, e.__traceback__))
                 user_id = getattr(context, "user_id", None)
                 is_api_key = getattr(context, "is_api_key", None)
-                self._store_log(
-                    method, code, duration, user_id, is_api_key, request, None, traceback, None, ip_address, user_agent
+                api_call_log.log(
+                    method=method,
+                    status_code=code,
+                    duration=duration,
+                    user_id=user_id,
+                    is_api_key=is_api_key,
+                    request=request,
+                    response=None,
+                    traceback=traceback,
+                    perf_report=None,
+                    ip_address=ip_address,
+                    user_agent=user_agent,
                 )
                 observe_in_servicer_duration_histogram(method, user_id, code or "", type(e).__name__, duration / 1000)
 
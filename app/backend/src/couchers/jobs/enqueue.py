@@ -3,17 +3,144 @@ Background jobs
 """
 
 import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
 
-from couchers.models import BackgroundJob
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.sql import func, insert
+
+from couchers.models import BackgroundJob, BackgroundJobPriority, BackgroundJobState
+from couchers.sql import couchers_select as select
 
 logger = logging.getLogger(__name__)
 
+# workers LISTEN on this channel to be woken up as soon as a job is queued
+JOBS_NOTIFY_CHANNEL = "background_jobs"
+
+# priority of the job being run in this thread, if any
+_running_job_priority = ContextVar("running_job_priority", default=None)
+
+# lanes in the order they're picked, the later of two is the lower priority
+_PRIORITY_ORDER = list(BackgroundJobPriority)
+
+# job type -> BackgroundJobPriority its jobs are queued with, anything not listed here is normal priority
+JOB_PRIORITIES = {
+    # someone is waiting on these
+    "handle_notification": BackgroundJobPriority.high,
+    "send_raw_push_notification": BackgroundJobPriority.high,
+    "send_raw_push_notifications": BackgroundJobPriority.high,
+    "generate_message_notifications": BackgroundJobPriority.high,
+    "send_email": BackgroundJobPriority.high,
+    # fan-outs and sweeps that can wait
+    "handle_email_digests": BackgroundJobPriority.bulk,
+    "generate_event_create_notifications": BackgroundJobPriority.bulk,
+    "generate_event_update_notifications": BackgroundJobPriority.bulk,
+    "generate_event_cancel_notifications": BackgroundJobPriority.bulk,
+    "generate_event_delete_notifications": BackgroundJobPriority.bulk,
+    "send_onboarding_emails": BackgroundJobPriority.bulk,
+    "send_reference_reminders": BackgroundJobPriority.bulk,
+    "add_users_to_email_list": BackgroundJobPriority.bulk,
+    "enforce_all_community_memberships": BackgroundJobPriority.bulk,
+    "update_recommendation_scores": BackgroundJobPriority.bulk,
+}
+
+
+@contextmanager
+def running_job_priority(priority):
+    """
+    Jobs queued inside this block get at most the given priority, so that e.g. the emails from a bulk fan-out don't
+    jump ahead of other work
+    """
+    token = _running_job_priority.set(priority)
+    try:
+        yield
+    finally:
+        _running_job_priority.reset(token)
+
+
+def job_priority(job_type):
+    """
+    The priority of a newly queued job of job_type: its entry in JOB_PRIORITIES, or that of the job queueing it if lower
+    """
+    priority = JOB_PRIORITIES.get(job_type, BackgroundJobPriority.normal)
+    running = _running_job_priority.get()
+    if running is not None:
+        priority = max(priority, running, key=_PRIORITY_ORDER.index)
+    return priority
 
-def queue_job(session, job_type: str, payload, max_tries=None):
-    job = BackgroundJob(
-        job_type=job_type,
-        payload=payload.SerializeToString(),
-        max_tries=max_tries,
+
+def _skip_duplicates(statement):
+    """
+    Makes an insert into background_jobs skip the rows whose dedup_key is already taken by a waiting job of their type
+    """
+    return statement.on_conflict_do_nothing(
+        index_elements=[BackgroundJob.job_type, BackgroundJob.dedup_key],
+        index_where=(BackgroundJob.dedup_key != None)
+        & ((BackgroundJob.state == BackgroundJobState.pending) | (BackgroundJob.state == BackgroundJobState.error)),
     )
-    session.add(job)
-    return job.id
+
+
+def queue_job(session, job_type: str, payload, max_tries=None, run_at=None, dedup_key=None):
+    """
+    Queues a job, to be run straight away or not before run_at
+
+    If dedup_key is set and a job of the same type with the same dedup_key is still waiting to run (or waiting for a
+    retry), no new job is queued and None is returned
+    """
+    if dedup_key is None:
+        job = BackgroundJob(
+            job_type=job_type,
+            payload=payload.SerializeToString(),
+            max_tries=max_tries,
+            priority=job_priority(job_type),
+        )
+        if run_at is not None:
+            job.next_attempt_after = run_at
+        session.add(job)
+    else:
+        values = dict(
+            job_type=job_type,
+            payload=payload.SerializeToString(),
+            priority=job_priority(job_type),
+            dedup_key=dedup_key,
+        )
+        if max_tries is not None:
+            values["max_tries"] = max_tries
+        if run_at is not None:
+            values["next_attempt_after"] = run_at
+        job_id = session.execute(
+            _skip_duplicates(pg_insert(BackgroundJob).values(**values)).returning(BackgroundJob.id)
+        ).scalar_one_or_none()
+        if job_id is None:
+            logger.debug(f"Job of type {job_type} with {dedup_key=} already queued")
+            return None
+    # delivered when the transaction commits, postgres collapses duplicate notifications within a transaction
+    session.execute(select(func.pg_notify(JOBS_NOTIFY_CHANNEL, "")))
+    return job.id if dedup_key is None else job_id
+
+
+def queue_jobs(session, job_type: str, payloads, max_tries=None, run_at=None, dedup_keys=None):
+    """
+    Queues one job of job_type per payload, with a single multi-row insert
+
+    dedup_keys, if given, has one dedup_key per payload and works like that of queue_job: the payloads whose key is
+    already taken by a waiting job are skipped
+    """
+    if not payloads:
+        return
+    extra = {}
+    if max_tries is not None:
+        extra["max_tries"] = max_tries
+    if run_at is not None:
+        extra["next_attempt_after"] = run_at
+    priority = job_priority(job_type)
+    rows = [
+        dict(job_type=job_type, payload=payload.SerializeToString(), priority=priority, **extra) for payload in payloads
+    ]
+    if dedup_keys is None:
+        session.execute(insert(BackgroundJob), rows)
+    else:
+        for row, dedup_key in zip(rows, dedup_keys, strict=True):
+            row["dedup_key"] = dedup_key
+        session.execute(_skip_duplicates(pg_insert(BackgroundJob).values(rows)))
+    session.execute(select(func.pg_notify(JOBS_NOTIFY_CHANNEL, "")))
@@ -4,18 +4,16 @@ Background job servicers
 
 import logging
 from datetime import date, timedelta
-from math import sqrt
 from types import SimpleNamespace
 from typing import List
 
 import requests
 from google.protobuf import empty_pb2
-from sqlalchemy import Integer
 from sqlalchemy.orm import aliased
-from sqlalchemy.sql import and_, case, cast, delete, distinct, extract, func, literal, not_, or_, select, union_all
-from sqlalchemy.sql.functions import percentile_disc
+from sqlalchemy.sql import and_, delete, func, literal, not_, or_, select, union_all
 
 from couchers.config import config
+from couchers.constants import MISSED_MESSAGES_NOTIFICATION_DELAY
 from couchers.crypto import asym_encrypt, b64decode, simple_decrypt
 from couchers.db import session_scope
 from couchers.email.dev import print_dev_email
@@ -24,13 +22,10 @@ from couchers.helpers.badges import user_add_badge, user_remove_badge
 from couchers.materialized_views import refresh_materialized_views as mv_refresh_materialized_views
 from couchers.models import (
     AccountDeletionToken,
-    Cluster,
-    ClusterRole,
-    ClusterSubscription,
-    Float,
+    BackgroundJob,
+    BackgroundJobState,
     GroupChat,
     GroupChatSubscription,
-    HostingStatus,
     HostRequest,
     Invoice,
     LoginToken,
@@ -44,10 +39,17 @@ from couchers.models import (
     User,
     UserBadge,
 )
-from couchers.notifications.background import handle_email_digests, handle_notification, send_raw_push_notification
+from couchers.notifications.background import (
+    handle_email_digests,
+    handle_notification,
+    send_raw_push_notification,
+    send_raw_push_notifications,
+)
 from couchers.notifications.notify import notify
+from couchers.recommendation_scores import update_all_recommendation_scores
+from couchers.recommendation_scores import update_stale_recommendation_scores as rs_update_stale_recommendation_scores
 from couchers.resources import get_badge_dict, get_static_badge_dict
-from couchers.servicers.api import user_model_to_pb
+from couchers.servicers.api import user_model_to_pb, users_to_pb
 from couchers.servicers.blocking import are_blocked
 from couchers.servicers.conversations import generate_message_notifications
 from couchers.servicers.events import (
@@ -69,6 +71,10 @@ logger = logging.getLogger(__name__)
 handle_notification.PAYLOAD = jobs_pb2.HandleNotificationPayload
 
 send_raw_push_notification.PAYLOAD = jobs_pb2.SendRawPushNotificationPayload
+send_raw_push_notification.QUEUE = "push"
+
+send_raw_push_notifications.PAYLOAD = jobs_pb2.SendRawPushNotificationsPayload
+send_raw_push_notifications.QUEUE = "push"
 
 handle_email_digests.PAYLOAD = empty_pb2.Empty
 handle_email_digests.SCHEDULE = timedelta(minutes=15)
@@ -104,6 +110,7 @@ def send_email(payload):
 
 
 send_email.PAYLOAD = jobs_pb2.SendEmailPayload
+send_email.QUEUE = "email"
 
 
 def purge_login_tokens(payload):
@@ -145,24 +152,26 @@ purge_account_deletion_tokens.SCHEDULE = timedelta(hours=24)
 def send_message_notifications(payload):
     """
     Sends out email notifications for messages that have been unseen for a long enough time
+
+    Queued for each recipient of a group chat message, to run once the message has had time to be seen
     """
-    # very crude and dumb algorithm
-    logger.info("Sending out email notifications for unseen messages")
+    logger.info(f"Sending out email notifications for unseen messages to user {payload.user_id}")
 
     with session_scope() as session:
-        # users who have unnotified messages older than 5 minutes in any group chat
+        # the user, if they have unnotified messages older than the delay in any group chat
         users = (
             session.execute(
                 select(User)
                 .join(GroupChatSubscription, GroupChatSubscription.user_id == User.id)
                 .join(Message, Message.conversation_id == GroupChatSubscription.group_chat_id)
+                .where(User.id == payload.user_id)
                 .where(not_(GroupChatSubscription.is_muted))
                 .where(User.is_visible)
                 .where(Message.time >= GroupChatSubscription.joined)
                 .where(or_(Message.time <= GroupChatSubscription.left, GroupChatSubscription.left == None))
                 .where(Message.id > User.last_notified_message_id)
                 .where(Message.id > GroupChatSubscription.last_seen_message_id)
-                .where(Message.time < now() - timedelta(minutes=5))
+                .where(Message.time <= now() - MISSED_MESSAGES_NOTIFICATION_DELAY)
                 .where(Message.message_type == MessageType.text)  # TODO: only text messages for now
             )
             .scalars()
@@ -170,7 +179,7 @@ def send_message_notifications(payload):
         )
 
         for user in users:
-            # now actually grab all the group chats, not just less than 5 min old
+            # now actually grab all the group chats, not just ones with old enough messages
             subquery = (
                 select(
                     GroupChatSubscription.group_chat_id.label("group_chat_id"),
@@ -206,6 +215,10 @@ def send_message_notifications(payload):
                 else:
                     return f"You missed {count_unseen} message(s) in {group_chat.title}"
 
+            author_pbs = users_to_pb(
+                session, [message.author for _, message, _ in unseen_messages], SimpleNamespace(user_id=user.id)
+            )
+
             notify(
                 session,
                 user_id=user.id,
@@ -213,31 +226,28 @@ def send_message_notifications(payload):
                 data=notification_data_pb2.ChatMissedMessages(
                     messages=[
                         notification_data_pb2.ChatMessage(
-                            author=user_model_to_pb(
-                                message.author,
-                                session,
-                                SimpleNamespace(user_id=user.id),
-                            ),
+                            author=author_pb,
                             message=format_title(message, group_chat, count_unseen),
                             text=message.text,
                             group_chat_id=message.conversation_id,
                         )
-                        for group_chat, message, count_unseen in unseen_messages
+                        for (group_chat, message, count_unseen), author_pb in zip(unseen_messages, author_pbs)
                     ],
                 ),
             )
             session.commit()
 
 
-send_message_notifications.PAYLOAD = empty_pb2.Empty
-send_message_notifications.SCHEDULE = timedelta(minutes=3)
+send_message_notifications.PAYLOAD = jobs_pb2.MissedMessagesPayload
 
 
 def send_request_notifications(payload):
     """
     Sends out email notifications for unseen messages in host requests (as surfer or host)
+
+    Queued for the recipient of each host request message, to run once the message has had time to be seen
     """
-    logger.info("Sending out email notifications for unseen messages in host requests")
+    logger.info(f"Sending out email notifications for unseen messages in host requests to user {payload.user_id}")
 
     with session_scope() as session:
         # requests where this user is surfing
@@ -246,9 +256,10 @@ def send_request_notifications(payload):
             .where(User.is_visible)
             .join(HostRequest, HostRequest.surfer_user_id == User.id)
             .join(Message, Message.conversation_id == HostRequest.conversation_id)
+            .where(User.id == payload.user_id)
             .where(Message.id > HostRequest.surfer_last_seen_message_id)
             .where(Message.id > User.last_notified_request_message_id)
-            .where(Message.time < now() - timedelta(minutes=5))
+            .where(Message.time <= now() - MISSED_MESSAGES_NOTIFICATION_DELAY)
             .where(Message.message_type == MessageType.text)
             .group_by(User, HostRequest)
         ).all()
@@ -259,9 +270,10 @@ def send_request_notifications(payload):
             .where(User.is_visible)
             .join(HostRequest, HostRequest.host_user_id == User.id)
             .join(Message, Message.conversation_id == HostRequest.conversation_id)
+            .where(User.id == payload.user_id)
             .where(Message.id > HostRequest.host_last_seen_message_id)
             .where(Message.id > User.last_notified_request_message_id)
-            .where(Message.time < now() - timedelta(minutes=5))
+            .where(Message.time <= now() - MISSED_MESSAGES_NOTIFICATION_DELAY)
             .where(Message.message_type == MessageType.text)
             .group_by(User, HostRequest)
         ).all()
@@ -301,8 +313,7 @@ def send_request_notifications(payload):
             )
 
 
-send_request_notifications.PAYLOAD = empty_pb2.Empty
-send_request_notifications.SCHEDULE = timedelta(minutes=3)
+send_request_notifications.PAYLOAD = jobs_pb2.MissedMessagesPayload
 
 
 def send_onboarding_emails(payload):
@@ -503,227 +514,51 @@ add_users_to_email_list.SCHEDULE = timedelta(hours=1)
 
 
 def enforce_community_membership(payload):
-    tasks_enforce_community_memberships()
+    """
+    Adds users who moved and new communities since the last completed run, the daily full run picks up anything else
+    (e.g. users who got unbanned)
+    """
+    with session_scope() as session:
+        # when the last run was queued, it can't have seen anything that changed after that
+        since = session.execute(
+            select(func.max(BackgroundJob.queued))
+            .where(BackgroundJob.job_type.in_(["enforce_community_membership", "enforce_all_community_memberships"]))
+            .where(BackgroundJob.state == BackgroundJobState.completed)
+        ).scalar_one_or_none()
+    # with no previous run there's nothing to go on, so go through everyone
+    tasks_enforce_community_memberships(since=since)
 
 
 enforce_community_membership.PAYLOAD = empty_pb2.Empty
 enforce_community_membership.SCHEDULE = timedelta(minutes=15)
+enforce_community_membership.SINGLETON = True
 
 
-def update_recommendation_scores(payload):
-    text_fields = [
-        User.hometown,
-        User.occupation,
-        User.education,
-        User.about_me,
-        User.my_travels,
-        User.things_i_like,
-        User.about_place,
-        User.additional_information,
-        User.pet_details,
-        User.kid_details,
-        User.housemate_details,
-        User.other_host_info,
-        User.sleeping_details,
-        User.area,
-        User.house_rules,
-    ]
-    home_fields = [User.about_place, User.other_host_info, User.sleeping_details, User.area, User.house_rules]
+def enforce_all_community_memberships(payload):
+    tasks_enforce_community_memberships()
 
-    def poor_man_gaussian():
-        """
-        Produces an approximatley std normal random variate
-        """
-        trials = 5
-        return (sum([func.random() for _ in range(trials)]) - trials / 2) / sqrt(trials / 12)
 
-    def int_(stmt):
-        return func.coalesce(cast(stmt, Integer), 0)
+enforce_all_community_memberships.PAYLOAD = empty_pb2.Empty
+enforce_all_community_memberships.SCHEDULE = timedelta(hours=24)
+enforce_all_community_memberships.SINGLETON = True
 
-    def float_(stmt):
-        return func.coalesce(cast(stmt, Float), 0.0)
 
-    with session_scope() as session:
-        # profile
-        profile_text = ""
-        for field in text_fields:
-            profile_text += func.coalesce(field, "")
-        text_length = func.length(profile_text)
-        home_text = ""
-        for field in home_fields:
-            home_text += func.coalesce(field, "")
-        home_length = func.length(home_text)
-
-        has_text = int_(text_length > 500)
-        long_text = int_(text_length > 2000)
-        has_pic = int_(User.avatar_key != None)
-        can_host = int_(User.hosting_status == HostingStatus.can_host)
-        cant_host = int_(User.hosting_status == HostingStatus.cant_host)
-        filled_home = int_(User.last_minute != None) * int_(home_length > 200)
-        profile_points = 2 * has_text + 3 * long_text + 2 * has_pic + 3 * can_host + 2 * filled_home - 5 * cant_host
-
-        # references
-        left_ref_expr = int_(1).label("left_reference")
-        left_refs_subquery = (
-            select(Reference.from_user_id.label("user_id"), left_ref_expr).group_by(Reference.from_user_id).subquery()
-        )
-        left_reference = int_(left_refs_subquery.c.left_reference)
-        has_reference_expr = int_(func.count(Reference.id) >= 1).label("has_reference")
-        ref_count_expr = int_(func.count(Reference.id)).label("ref_count")
-        ref_avg_expr = func.avg(1.4 * (Reference.rating - 0.3)).label("ref_avg")
-        has_multiple_types_expr = int_(func.count(distinct(Reference.reference_type)) >= 2).label("has_multiple_types")
-        has_bad_ref_expr = int_(func.sum(int_((Reference.rating <= 0.2) | (~Reference.was_appropriate))) >= 1).label(
-            "has_bad_ref"
-        )
-        received_ref_subquery = (
-            select(
-                Reference.to_user_id.label("user_id"),
-                has_reference_expr,
-                has_multiple_types_expr,
-                has_bad_ref_expr,
-                ref_count_expr,
-                ref_avg_expr,
-            )
-            .group_by(Reference.to_user_id)
-            .subquery()
-        )
-        has_multiple_types = int_(received_ref_subquery.c.has_multiple_types)
-        has_reference = int_(received_ref_subquery.c.has_reference)
-        has_bad_reference = int_(received_ref_subquery.c.has_bad_ref)
-        rating_score = float_(
-            received_ref_subquery.c.ref_avg
-            * (
-                2 * func.least(received_ref_subquery.c.ref_count, 5)
-                + func.greatest(received_ref_subquery.c.ref_count - 5, 0)
-            )
-        )
-        ref_score = 2 * has_reference + has_multiple_types + left_reference - 5 * has_bad_reference + rating_score
-
-        # activeness
-        recently_active = int_(User.last_active >= now() - timedelta(days=180))
-        very_recently_active = int_(User.last_active >= now() - timedelta(days=14))
-        recently_messaged = int_(func.max(Message.time) > now() - timedelta(days=14))
-        messaged_lots = int_(func.count(Message.id) > 5)
-        messaging_points_subquery = (recently_messaged + messaged_lots).label("messaging_points")
-        messaging_subquery = (
-            select(Message.author_id.label("user_id"), messaging_points_subquery)
-            .where(Message.message_type == MessageType.text)
-            .group_by(Message.author_id)
-            .subquery()
-        )
-        activeness_points = recently_active + 2 * very_recently_active + int_(messaging_subquery.c.messaging_points)
-
-        # verification
-        cb_subquery = (
-            select(ClusterSubscription.user_id.label("user_id"), func.min(Cluster.parent_node_id).label("min_node_id"))
-            .join(Cluster, Cluster.id == ClusterSubscription.cluster_id)
-            .where(ClusterSubscription.role == ClusterRole.admin)
-            .where(Cluster.is_official_cluster)
-            .group_by(ClusterSubscription.user_id)
-            .subquery()
-        )
-        min_node_id = cb_subquery.c.min_node_id
-        cb = int_(min_node_id >= 1)
-        wcb = int_(min_node_id == 1)
-        badge_points = {
-            "founder": 100,
-            "board_member": 20,
-            "past_board_member": 5,
-            "strong_verification": 3,
-            "volunteer": 3,
-            "past_volunteer": 2,
-            "donor": 1,
-            "phone_verified": 1,
-        }
-
-        badge_subquery = (
-            select(
-                UserBadge.user_id.label("user_id"),
-                func.sum(case(badge_points, value=UserBadge.badge_id, else_=0)).label("badge_points"),
-            )
-            .group_by(UserBadge.user_id)
-            .subquery()
-        )
-
-        other_points = 0.0 + 10 * wcb + 5 * cb + int_(badge_subquery.c.badge_points)
+def update_recommendation_scores(payload):
+    update_all_recommendation_scores()
 
-        # response rate
-        t = (
-            select(Message.conversation_id, Message.time)
-            .where(Message.message_type == MessageType.chat_created)
-            .subquery()
-        )
-        s = (
-            select(Message.conversation_id, Message.author_id, func.min(Message.time).label("time"))
-            .group_by(Message.conversation_id, Message.author_id)
-            .subquery()
-        )
-        hr_subquery = (
-            select(
-                HostRequest.host_user_id.label("user_id"),
-                func.avg(s.c.time - t.c.time).label("avg_response_time"),
-                func.count(t.c.time).label("received"),
-                func.count(s.c.time).label("responded"),
-                float_(
-                    extract(
-                        "epoch",
-                        percentile_disc(0.33).within_group(func.coalesce(s.c.time - t.c.time, timedelta(days=1000))),
-                    )
-                    / 60.0
-                ).label("response_time_33p"),
-                float_(
-                    extract(
-                        "epoch",
-                        percentile_disc(0.66).within_group(func.coalesce(s.c.time - t.c.time, timedelta(days=1000))),
-                    )
-                    / 60.0
-                ).label("response_time_66p"),
-            )
-            .join(t, t.c.conversation_id == HostRequest.conversation_id)
-            .outerjoin(
-                s, and_(s.c.conversation_id == HostRequest.conversation_id, s.c.author_id == HostRequest.host_user_id)
-            )
-            .group_by(HostRequest.host_user_id)
-            .subquery()
-        )
-        avg_response_time = hr_subquery.c.avg_response_time
-        avg_response_time_hr = float_(extract("epoch", avg_response_time) / 60.0)
-        received = hr_subquery.c.received
-        responded = hr_subquery.c.responded
-        response_time_33p = hr_subquery.c.response_time_33p
-        response_time_66p = hr_subquery.c.response_time_66p
-        response_rate = float_(responded / (1.0 * func.greatest(received, 1)))
-        # be careful with nulls
-        response_rate_points = -10 * int_(response_time_33p > 60 * 48.0) + 5 * int_(response_time_66p < 60 * 48.0)
-
-        recommendation_score = (
-            profile_points
-            + ref_score
-            + activeness_points
-            + other_points
-            + response_rate_points
-            + 2 * poor_man_gaussian()
-        )
 
-        scores = (
-            select(User.id.label("user_id"), recommendation_score.label("score"))
-            .outerjoin(messaging_subquery, messaging_subquery.c.user_id == User.id)
-            .outerjoin(left_refs_subquery, left_refs_subquery.c.user_id == User.id)
-            .outerjoin(badge_subquery, badge_subquery.c.user_id == User.id)
-            .outerjoin(received_ref_subquery, received_ref_subquery.c.user_id == User.id)
-            .outerjoin(cb_subquery, cb_subquery.c.user_id == User.id)
-            .outerjoin(hr_subquery, hr_subquery.c.user_id == User.id)
-        ).subquery()
+update_recommendation_scores.PAYLOAD = empty_pb2.Empty
+update_recommendation_scores.SCHEDULE = timedelta(hours=24)
+update_recommendation_scores.SINGLETON = True
 
-        session.execute(
-            User.__table__.update().values(recommendation_score=scores.c.score).where(User.id == scores.c.user_id)
-        )
 
-    logger.info("Updated recommendation scores")
+def update_stale_recommendation_scores(payload):
+    rs_update_stale_recommendation_scores()
 
 
-update_recommendation_scores.PAYLOAD = empty_pb2.Empty
-update_recommendation_scores.SCHEDULE = timedelta(hours=24)
+update_stale_recommendation_scores.PAYLOAD = empty_pb2.Empty
+update_stale_recommendation_scores.SCHEDULE = timedelta(minutes=5)
+update_stale_recommendation_scores.SINGLETON = True
 
 
 def refresh_materialized_views(payload):
@@ -732,6 +567,7 @@ def refresh_materialized_views(payload):
 
 refresh_materialized_views.PAYLOAD = empty_pb2.Empty
 refresh_materialized_views.SCHEDULE = timedelta(minutes=5)
+refresh_materialized_views.SINGLETON = True
 
 
 def update_badges(payload):
@@ -775,6 +611,7 @@ def update_badges(payload):
 
 update_badges.PAYLOAD = empty_pb2.Empty
 update_badges.SCHEDULE = timedelta(minutes=15)
+update_badges.SINGLETON = True
 
 
 def finalize_strong_verification(payload):
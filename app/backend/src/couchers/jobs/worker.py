@@ -4,117 +4,505 @@ Background job workers
 
 import logging
 import traceback
+from collections import Counter
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from dataclasses import dataclass
 from datetime import timedelta
+from functools import partial
 from inspect import getmembers, isfunction
 from multiprocessing import Process
 from sched import scheduler
+from select import select as wait_until_readable
+from threading import Event, Lock
 from time import monotonic, perf_counter_ns, sleep
 
 import sentry_sdk
 from google.protobuf import empty_pb2
 from opentelemetry import trace
+from sqlalchemy.sql import exists, tuple_, update
+from sqlalchemy.sql import func as sa_func
 
-from couchers.config import config
-from couchers.db import db_post_fork, session_scope, worker_repeatable_read_session_scope
+from couchers.config import config, get_job_worker_threads
+from couchers.db import _get_base_engine, db_post_fork, session_scope
 from couchers.jobs import handlers
-from couchers.jobs.enqueue import queue_job
-from couchers.metrics import create_prometheus_server, job_process_registry, observe_in_jobs_duration_histogram
-from couchers.models import BackgroundJob, BackgroundJobState
+from couchers.jobs.enqueue import JOBS_NOTIFY_CHANNEL, queue_job, running_job_priority
+from couchers.metrics import (
+    create_prometheus_server,
+    job_process_registry,
+    job_worker_threads_gauge,
+    jobs_concurrency_limit_gauge,
+    jobs_in_progress_gauge,
+    observe_in_jobs_duration_histogram,
+    scheduled_jobs_coalesced_counter,
+    scheduled_jobs_skipped_counter,
+)
+from couchers.models import BackgroundJob, BackgroundJobPriority, BackgroundJobState
+from couchers.notifications.settings import PREFERENCES_NOTIFY_CHANNEL, handle_preferences_changed_notify
 from couchers.sql import couchers_select as select
 from couchers.tracing import setup_tracing
+from couchers.utils import now
 
 logger = logging.getLogger(__name__)
 trace = trace.get_tracer(__name__)
 
+# maximum number of jobs claimed in one go by the worker
+JOB_BATCH_SIZE = 10
+
+# how long the worker waits for a notification before looking for jobs anyway, jobs due for a retry don't notify
+JOB_POLL_INTERVAL = timedelta(seconds=30)
+
+# a claimed job is hidden from other workers for this long, the lease is renewed while the job runs so if the worker
+# dies, the job is claimed again by another one at most this long after
+JOB_LEASE_DURATION = timedelta(minutes=5)
+
+# how often the leases of the jobs a worker process is running are renewed
+JOB_LEASE_RENEW_INTERVAL = timedelta(minutes=1)
+
+# other channels the worker listens on, with the function to call with each notification's payload, e.g. to drop
+# cached data
+CHANNEL_HANDLERS = {
+    PREFERENCES_NOTIFY_CHANNEL: handle_preferences_changed_notify,
+}
+
+# the queue a job type is routed to unless its handler sets QUEUE
+DEFAULT_QUEUE = "default"
+
+# scheduled jobs are queued with this dedup_key, so a new one isn't queued while the last one is still waiting to run
+SCHEDULED_JOB_DEDUP_KEY = "scheduled"
+
+# first key of the advisory locks held while checking whether a singleton job is running, the second key is the hash of
+# the job type
+SINGLETON_JOB_LOCK_ID = 5201
+
+# how long a singleton job waits before trying again if another one of its type is running
+SINGLETON_JOB_RETRY_DELAY = timedelta(minutes=1)
+
+# the scheduler serves its metrics on this port, the workers use 8001 and up
+SCHEDULER_METRICS_PORT = 8100
+
 JOBS = {}
 SCHEDULE = []
+# job type -> name of the queue it's routed to
+QUEUES = {}
+# job types of which at most one runs at a time
+SINGLETONS = set()
 
 for name, func in getmembers(handlers, isfunction):
     if hasattr(func, "PAYLOAD"):
         JOBS[name] = (func.PAYLOAD, func)
+        QUEUES[name] = getattr(func, "QUEUE", DEFAULT_QUEUE)
         if hasattr(func, "SCHEDULE"):
             SCHEDULE.append((name, func.SCHEDULE))
+        if getattr(func, "SINGLETON", False):
+            SINGLETONS.add(name)
 
 
-def process_job():
+def _parse_concurrency_limits(limits):
     """
-    Attempt to process one job from the job queue. Returns False if no job was found, True if a job was processed,
-    regardless of failure/success.
+    Parses a string like "send_raw_push_notification:2,send_email:4" into a dict of job type -> limit
+    """
+    parsed = {}
+    for limit in limits.split(","):
+        if limit.strip():
+            job_type, max_threads = limit.split(":")
+            parsed[job_type.strip()] = int(max_threads)
+    return parsed
+
+
+def get_thread_job_types():
+    """
+    The job types serviced by each of this worker process's threads according to JOB_WORKER_QUEUES, with None for all
+    of them
+    """
+    thread_job_types = []
+    for queue, threads in get_job_worker_threads():
+        if queue is None:
+            job_types = None
+        elif queue in QUEUES.values():
+            job_types = sorted(job_type for job_type, job_queue in QUEUES.items() if job_queue == queue)
+        else:
+            raise ValueError(f"Unknown job queue {queue} in JOB_WORKER_QUEUES")
+        thread_job_types += [job_types] * threads
+    return thread_job_types
+
+
+class JobTypeLimiter:
+    """
+    Keeps track of how many threads in this process are working on each job type, so that a slow job type with a
+    concurrency limit can't tie up every worker thread
+    """
+
+    def __init__(self, limits):
+        # job type -> max number of threads working on it at once
+        self.limits = limits
+        self._lock = Lock()
+        self._running = Counter()
+
+    def claim(self, claim_jobs):
+        """
+        Calls claim_jobs with the list of job types that are at their limit and must not be claimed, and counts the
+        claimed jobs' types as running until release() is called
+
+        Returns the claimed jobs
+        """
+        with self._lock:
+            saturated = sorted(job_type for job_type, limit in self.limits.items() if self._running[job_type] >= limit)
+            jobs = claim_jobs(saturated)
+            self._running.update({job.job_type for job in jobs})
+        return jobs
+
+    def release(self, jobs):
+        with self._lock:
+            self._running.subtract({job.job_type for job in jobs})
+
+
+def _lock_singleton(session, job_type):
+    """
+    Takes the advisory lock of a singleton job type until the end of the transaction, so that only one transaction at a
+    time checks whether one is running and claims one
+    """
+    session.execute(select(sa_func.pg_advisory_xact_lock(SINGLETON_JOB_LOCK_ID, sa_func.hashtext(job_type))))
+
+
+def _is_running(session, job_type):
+    """
+    Whether a worker holds the lease on a job of job_type
     """
-    logger.debug("Looking for a job")
+    return session.execute(
+        select(
+            exists()
+            .where(BackgroundJob.job_type == job_type)
+            .where(BackgroundJob.leased_until != None)
+            .where(BackgroundJob.leased_until >= sa_func.now())
+        )
+    ).scalar_one()
+
 
-    with worker_repeatable_read_session_scope() as session:
-        # a combination of REPEATABLE READ and SELECT ... FOR UPDATE SKIP LOCKED makes sure that only one transaction
-        # will modify the job at a time. SKIP UPDATE means that if the job is locked, then we ignore that row, it's
-        # easier to use SKIP LOCKED vs NOWAIT in the ORM, with NOWAIT you get an ugly exception from deep inside
-        # psycopg2 that's quite annoying to catch and deal with
-        job = (
+@dataclass(frozen=True, kw_only=True)
+class ClaimedJob:
+    id: int
+    job_type: str
+    payload: bytes
+    priority: BackgroundJobPriority
+    # the job's try_count once claimed, if our lease runs out and another worker claims the job it goes up again, so
+    # this tells whether the lease is still ours
+    try_count: int
+    max_tries: int
+
+
+class JobLeases:
+    """
+    The jobs being run by this process, whose leases are renewed until they're done
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # (job id, try_count)
+        self._held = set()
+
+    def add(self, jobs):
+        with self._lock:
+            self._held.update((job.id, job.try_count) for job in jobs)
+
+    def remove(self, jobs):
+        with self._lock:
+            self._held.difference_update((job.id, job.try_count) for job in jobs)
+
+    def renew(self):
+        with self._lock:
+            held = sorted(self._held)
+        if not held:
+            return
+        with session_scope() as session:
             session.execute(
-                select(BackgroundJob).where(BackgroundJob.ready_for_retry).with_for_update(skip_locked=True)
+                update(BackgroundJob)
+                .where(tuple_(BackgroundJob.id, BackgroundJob.try_count).in_(held))
+                .values(leased_until=sa_func.now() + JOB_LEASE_DURATION)
+                .execution_options(synchronize_session=False)
             )
-            .scalars()
-            .first()
+
+
+job_leases = JobLeases()
+
+
+def _fail_abandoned_jobs(session):
+    """
+    Marks as failed the jobs whose worker went away during their last try, no one else will claim them since they're
+    out of tries, and they'd hold on to their dedup_key forever
+    """
+    abandoned = (
+        select(BackgroundJob.id)
+        .where((BackgroundJob.state == BackgroundJobState.pending) | (BackgroundJob.state == BackgroundJobState.error))
+        .where(BackgroundJob.leased_until != None)
+        .where(BackgroundJob.leased_until < sa_func.now())
+        .where(BackgroundJob.try_count >= BackgroundJob.max_tries)
+        .with_for_update(skip_locked=True)
+    )
+    session.execute(
+        update(BackgroundJob)
+        .where(BackgroundJob.id.in_(abandoned.scalar_subquery()))
+        .values(
+            state=BackgroundJobState.failed,
+            leased_until=None,
+            failure_info="Lease expired on the last try, the worker probably died",
         )
+        .execution_options(synchronize_session=False)
+    )
 
-        if not job:
-            logger.debug("No pending jobs")
-            return False
 
-        # we've got a lock for a job now, it's "pending" until we commit or the lock is gone
-        logger.info(f"Job #{job.id} of type {job.job_type} grabbed")
-        job.try_count += 1
+def _finish_job(job, **values):
+    """
+    Records the outcome of a claimed job and releases its lease, unless the lease was lost to another worker
+    """
+    with session_scope() as session:
+        result = session.execute(
+            update(BackgroundJob)
+            .where(BackgroundJob.id == job.id)
+            .where(BackgroundJob.try_count == job.try_count)
+            .values(leased_until=None, **values)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            logger.warning(f"Lease on job #{job.id} was lost, not recording the outcome of try number {job.try_count}")
+
 
-        message_type, func = JOBS[job.job_type]
+def _run_job(job):
+    """
+    Runs a job we hold the lease on, and records the outcome on it
+    """
+    logger.info(f"Job #{job.id} of type {job.job_type} grabbed")
 
-        try:
-            with trace.start_as_current_span(job.job_type) as rollspan:
-                start = perf_counter_ns()
+    message_type, func = JOBS[job.job_type]
+
+    try:
+        with trace.start_as_current_span(job.job_type) as rollspan:
+            start = perf_counter_ns()
+            with (
+                jobs_in_progress_gauge.labels(job.job_type).track_inprogress(),
+                running_job_priority(job.priority),
+            ):
                 ret = func(message_type.FromString(job.payload))
-                finished = perf_counter_ns()
-            job.state = BackgroundJobState.completed
-            observe_in_jobs_duration_histogram(
-                job.job_type, job.state.name, job.try_count, "", (finished - start) / 1e9
-            )
-            logger.info(f"Job #{job.id} complete on try number {job.try_count}")
-        except Exception as e:
             finished = perf_counter_ns()
-            logger.exception(e)
-            sentry_sdk.set_tag("context", "job")
-            sentry_sdk.set_tag("job", job.job_type)
-            sentry_sdk.capture_exception(e)
-
-            if job.try_count >= job.max_tries:
-                # if we already tried max_tries times, it's permanently failed
-                job.state = BackgroundJobState.failed
-                logger.info(f"Job #{job.id} failed on try number {job.try_count}")
-            else:
-                job.state = BackgroundJobState.error
-                # exponential backoff
-                job.next_attempt_after += timedelta(seconds=15 * (2**job.try_count))
-                logger.info(f"Job #{job.id} error on try number {job.try_count}, next try at {job.next_attempt_after}")
-            observe_in_jobs_duration_histogram(
-                job.job_type, job.state.name, job.try_count, type(e).__name__, (finished - start) / 1e9
+        state = BackgroundJobState.completed
+        _finish_job(job, state=state)
+        observe_in_jobs_duration_histogram(job.job_type, state.name, job.try_count, "", (finished - start) / 1e9)
+        logger.info(f"Job #{job.id} complete on try number {job.try_count}")
+    except Exception as e:
+        finished = perf_counter_ns()
+        logger.exception(e)
+        sentry_sdk.set_tag("context", "job")
+        sentry_sdk.set_tag("job", job.job_type)
+        sentry_sdk.capture_exception(e)
+
+        # add some info for debugging
+        failure_info = traceback.format_exc()
+        if job.try_count >= job.max_tries:
+            # if we already tried max_tries times, it's permanently failed
+            state = BackgroundJobState.failed
+            _finish_job(job, state=state, failure_info=failure_info)
+            logger.info(f"Job #{job.id} failed on try number {job.try_count}")
+        else:
+            state = BackgroundJobState.error
+            # exponential backoff
+            next_attempt_after = now() + timedelta(seconds=15 * (2**job.try_count))
+            _finish_job(job, state=state, failure_info=failure_info, next_attempt_after=next_attempt_after)
+            logger.info(f"Job #{job.id} error on try number {job.try_count}, next try at {next_attempt_after}")
+        observe_in_jobs_duration_histogram(
+            job.job_type, state.name, job.try_count, type(e).__name__, (finished - start) / 1e9
+        )
+
+        if config["IN_TEST"]:
+            raise e
+
+
+def process_job_batch(batch_size, job_types=None, limiter=None):
+    """
+    Claims up to batch_size ready jobs of a single job type from the job queue in one short transaction and processes
+    them one after the other. Returns the number of jobs processed, regardless of failure/success.
+
+    Only claims jobs of the given job_types if set, and skips job types that are at their limit in the limiter.
+    """
+    logger.debug("Looking for jobs")
+
+    def claim_jobs(excluded_job_types):
+        # SELECT ... FOR UPDATE SKIP LOCKED makes sure that only one transaction claims a job, SKIP LOCKED means that if
+        # the job is locked, then we ignore that row, it's easier to use SKIP LOCKED vs NOWAIT in the ORM, with NOWAIT
+        # you get an ugly exception from deep inside psycopg2 that's quite annoying to catch and deal with
+        query = (
+            select(BackgroundJob)
+            .where(BackgroundJob.ready_for_retry)
+            .order_by(BackgroundJob.priority, BackgroundJob.next_attempt_after)
+            .with_for_update(skip_locked=True)
+        )
+        if job_types is not None:
+            query = query.where(BackgroundJob.job_type.in_(job_types))
+        if excluded_job_types:
+            query = query.where(BackgroundJob.job_type.not_in(excluded_job_types))
+        while True:
+            first = session.execute(query.limit(1)).scalar_one_or_none()
+            if not first:
+                return []
+            if first.job_type not in SINGLETONS:
+                break
+            _lock_singleton(session, first.job_type)
+            if not _is_running(session, first.job_type):
+                break
+            # doesn't count as a try
+            first.next_attempt_after = sa_func.now() + SINGLETON_JOB_RETRY_DELAY
+            logger.info(f"Job #{first.id} of type {first.job_type} deferred, another one is running")
+            # only one singleton lock per transaction, so that two workers can't deadlock
+            query = query.where(BackgroundJob.job_type.not_in(SINGLETONS))
+
+        # the rest of the batch is of the same job type as the most urgent job, so quick jobs never wait in a batch
+        # behind slow ones, and a job type's concurrency limit holds for every job in the batch
+        jobs = [first]
+        if first.job_type not in SINGLETONS and batch_size > 1:
+            jobs += (
+                session.execute(
+                    query.where(BackgroundJob.job_type == first.job_type)
+                    .where(BackgroundJob.id != first.id)
+                    .limit(batch_size - 1)
+                )
+                .scalars()
+                .all()
             )
-            # add some info for debugging
-            job.failure_info = traceback.format_exc()
 
-            if config["IN_TEST"]:
-                raise e
+        claimed = []
+        for job in jobs:
+            # counted when claimed, so a job that keeps killing its worker still runs out of tries
+            job.try_count += 1
+            job.leased_until = sa_func.now() + JOB_LEASE_DURATION
+            claimed.append(
+                ClaimedJob(
+                    id=job.id,
+                    job_type=job.job_type,
+                    payload=job.payload,
+                    priority=job.priority,
+                    try_count=job.try_count,
+                    max_tries=job.max_tries,
+                )
+            )
+        return claimed
 
-        # exiting ctx manager commits and releases the row lock
-    return True
+    jobs = []
+    try:
+        # the row locks and any advisory locks are released as soon as the claim is committed, the job is kept from
+        # other workers by its lease from then on
+        with session_scope() as session:
+            _fail_abandoned_jobs(session)
+            jobs = limiter.claim(claim_jobs) if limiter else claim_jobs([])
 
+        if not jobs:
+            logger.debug("No pending jobs")
+            return 0
 
-def service_jobs():
+        job_leases.add(jobs)
+        for job in jobs:
+            _run_job(job)
+    finally:
+        job_leases.remove(jobs)
+        if limiter:
+            limiter.release(jobs)
+    return len(jobs)
+
+
+def process_job():
+    """
+    Attempt to process one job from the job queue. Returns False if no job was found, True if a job was processed,
+    regardless of failure/success.
+    """
+    return process_job_batch(1) > 0
+
+
+@contextmanager
+def _listen_for_jobs():
     """
-    Service jobs in an infinite loop
+    Holds a dedicated database connection that LISTENs for newly queued jobs (and on CHANNEL_HANDLERS), yields the
+    underlying psycopg2 connection
     """
-    t = create_prometheus_server(job_process_registry, 8001)
+    connection = _get_base_engine().raw_connection()
     try:
-        while True:
-            # if no job was found, sleep for a second, otherwise query for another job straight away
-            if not process_job():
-                sleep(1)
+        dbapi_connection = connection.driver_connection
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            for channel in [JOBS_NOTIFY_CHANNEL, *CHANNEL_HANDLERS]:
+                cursor.execute(f"LISTEN {channel};")
+        yield dbapi_connection
+    finally:
+        # the connection was switched to autocommit and is listening, so don't hand it back to the pool
+        connection.invalidate()
+
+
+def _wait_for_jobs(dbapi_connection, timeout):
+    """
+    Blocks until a job is queued or the timeout passes
+    """
+    if wait_until_readable([dbapi_connection], [], [], timeout.total_seconds())[0]:
+        _handle_notifies(dbapi_connection)
+
+
+def _handle_notifies(dbapi_connection):
+    """
+    Reads whatever notifications have arrived without blocking, and passes them on to their CHANNEL_HANDLERS
+    """
+    dbapi_connection.poll()
+    for notify in dbapi_connection.notifies:
+        if notify.channel in CHANNEL_HANDLERS:
+            CHANNEL_HANDLERS[notify.channel](notify.payload)
+    # any number of job notifications just means we should look for jobs again
+    dbapi_connection.notifies.clear()
+
+
+def _service_job_queue(job_types, limiter, stop):
+    """
+    Service jobs in a loop until stop is set
+    """
+    with _listen_for_jobs() as dbapi_connection:
+        while not stop.is_set():
+            # if no job was found, wait until one is queued, otherwise query for more straight away. we start
+            # listening before the first query so no notifications are missed in between
+            if not process_job_batch(JOB_BATCH_SIZE, job_types, limiter):
+                _wait_for_jobs(dbapi_connection, JOB_POLL_INTERVAL)
+            else:
+                # keep up with cache invalidations while busy
+                _handle_notifies(dbapi_connection)
+
+
+def _renew_job_leases(stop):
+    """
+    Renews the leases of the jobs this process is running every JOB_LEASE_RENEW_INTERVAL until stop is set
+    """
+    while not stop.wait(JOB_LEASE_RENEW_INTERVAL.total_seconds()):
+        job_leases.renew()
+
+
+def service_jobs(worker_id=0):
+    """
+    Service jobs on the threads set up by JOB_WORKER_QUEUES (or JOB_WORKER_THREADS) until one of them fails
+
+    Each worker process serves its metrics on its own port, 8001 + worker_id
+    """
+    thread_job_types = get_thread_job_types()
+    num_threads = len(thread_job_types)
+    limiter = JobTypeLimiter(_parse_concurrency_limits(config["JOB_CONCURRENCY_LIMITS"]))
+
+    job_worker_threads_gauge.set(num_threads)
+    for job_type, limit in limiter.limits.items():
+        jobs_concurrency_limit_gauge.labels(job_type).set(limit)
+
+    t = create_prometheus_server(job_process_registry, 8001 + worker_id)
+    stop = Event()
+    try:
+        with ThreadPoolExecutor(num_threads + 1, thread_name_prefix="job_worker") as executor:
+            loops = [executor.submit(_service_job_queue, job_types, limiter, stop) for job_types in thread_job_types]
+            loops.append(executor.submit(_renew_job_leases, stop))
+            # the loops only return once stopped, so this waits for the first one to raise
+            done, _ = wait(loops, return_when=FIRST_EXCEPTION)
+            # stop the other threads (they notice within JOB_POLL_INTERVAL) and pass the error on to be restarted
+            stop.set()
+            for loop in done:
+                loop.result()
     finally:
         logger.info("Closing prometheus server")
         t.server_close()
@@ -137,7 +525,13 @@ def _run_job_and_schedule(sched, schedule_id):
 
     # queue the job
     with session_scope() as session:
-        queue_job(session, job_type, empty_pb2.Empty())
+        if job_type in SINGLETONS and _is_running(session, job_type):
+            logger.info(f"Not queueing job of type {job_type}, one is running")
+            scheduled_jobs_skipped_counter.labels(job_type).inc()
+            return
+        if not queue_job(session, job_type, empty_pb2.Empty(), dedup_key=SCHEDULED_JOB_DEDUP_KEY):
+            logger.info(f"Not queueing job of type {job_type}, one is waiting to run")
+            scheduled_jobs_coalesced_counter.labels(job_type).inc()
 
 
 def run_scheduler():
@@ -157,7 +551,12 @@ def run_scheduler():
             ),
         )
 
-    sched.run()
+    t = create_prometheus_server(job_process_registry, SCHEDULER_METRICS_PORT)
+    try:
+        sched.run()
+    finally:
+        logger.info("Closing prometheus server")
+        t.server_close()
 
 
 def _run_forever(func):
@@ -183,7 +582,13 @@ def start_jobs_scheduler():
     return scheduler
 
 
-def start_jobs_worker():
-    worker = Process(target=_run_forever, args=(service_jobs,))
-    worker.start()
-    return worker
+def start_jobs_workers():
+    """
+    Starts JOB_WORKER_PROCESSES worker processes, each servicing jobs on the threads set up by JOB_WORKER_QUEUES
+    """
+    workers = []
+    for worker_id in range(config["JOB_WORKER_PROCESSES"]):
+        worker = Process(target=_run_forever, args=(partial(service_jobs, worker_id),))
+        worker.start()
+        workers.append(worker)
+    return workers
@@ -1,12 +1,13 @@
 import threading
 from datetime import timedelta
+from functools import partial
 
 from prometheus_client import Counter, Gauge, Histogram, exposition
 from prometheus_client.registry import CollectorRegistry
 from sqlalchemy.sql import func
 
 from couchers.db import session_scope
-from couchers.models import User
+from couchers.models import BackgroundJob, BackgroundJobPriority, User
 from couchers.sql import couchers_select as select
 from couchers.utils import now
 
@@ -27,6 +28,46 @@ def observe_in_jobs_duration_histogram(job_type, job_state, try_count, exception
     jobs_duration_histogram.labels(job_type, job_state, str(try_count), exception_name).observe(duration_s)
 
 
+jobs_in_progress_gauge = Gauge(
+    "couchers_background_jobs_in_progress",
+    "Number of background jobs currently being run",
+    labelnames=["job"],
+    registry=job_process_registry,
+)
+
+jobs_concurrency_limit_gauge = Gauge(
+    "couchers_background_jobs_concurrency_limit",
+    "Maximum number of threads per worker process that may run a job type at once",
+    labelnames=["job"],
+    registry=job_process_registry,
+)
+
+job_worker_threads_gauge = Gauge(
+    "couchers_background_job_worker_threads",
+    "Number of threads servicing background jobs in the worker process",
+    registry=job_process_registry,
+)
+
+scheduled_jobs_coalesced_counter = Counter(
+    "couchers_scheduled_jobs_coalesced_total",
+    "Number of scheduled jobs not queued because one of the same type was still waiting to run",
+    labelnames=["job"],
+    registry=job_process_registry,
+)
+
+scheduled_jobs_skipped_counter = Counter(
+    "couchers_scheduled_jobs_skipped_total",
+    "Number of scheduled singleton jobs not queued because one of the same type was running",
+    labelnames=["job"],
+    registry=job_process_registry,
+)
+
+smtp_connections_opened_counter = Counter(
+    "couchers_smtp_connections_opened_total",
+    "Number of connections opened to the SMTP server",
+    registry=job_process_registry,
+)
+
 servicer_duration_histogram = Histogram(
     "couchers_servicer_duration_seconds",
     "Durations of processing gRPC calls",
@@ -39,6 +80,19 @@ def observe_in_servicer_duration_histogram(method, user_id, status_code, excepti
     servicer_duration_histogram.labels(method, user_id is not None, status_code, exception_type).observe(duration_s)
 
 
+api_calls_log_written_counter = Counter(
+    "couchers_api_calls_log_written_total",
+    "Number of API calls written to the API call log",
+    registry=main_process_registry,
+)
+api_calls_log_dropped_counter = Counter(
+    "couchers_api_calls_log_dropped_total",
+    "Number of API calls not written to the API call log",
+    labelnames=["reason"],
+    registry=main_process_registry,
+)
+
+
 def _get_active_users_5m():
     with session_scope() as session:
         return session.execute(
@@ -70,6 +124,43 @@ users_gauge = Gauge(
 users_gauge.set_function(_get_users)
 
 
+def _get_ready_jobs(priority):
+    with session_scope() as session:
+        return session.execute(
+            select(func.count())
+            .select_from(BackgroundJob)
+            .where(BackgroundJob.priority == priority)
+            .where(BackgroundJob.ready_for_retry)
+        ).scalar_one()
+
+
+def _get_oldest_ready_job_age(priority):
+    with session_scope() as session:
+        oldest = session.execute(
+            select(func.min(BackgroundJob.next_attempt_after))
+            .where(BackgroundJob.priority == priority)
+            .where(BackgroundJob.ready_for_retry)
+        ).scalar_one_or_none()
+    return (now() - oldest).total_seconds() if oldest else 0
+
+
+ready_jobs_gauge = Gauge(
+    "couchers_background_jobs_ready",
+    "Number of background jobs ready to be run, by priority lane",
+    labelnames=["priority"],
+    registry=main_process_registry,
+)
+oldest_ready_job_age_gauge = Gauge(
+    "couchers_background_jobs_oldest_ready_age_seconds",
+    "How long the longest waiting ready background job has been ready for, by priority lane",
+    labelnames=["priority"],
+    registry=main_process_registry,
+)
+for priority in BackgroundJobPriority:
+    ready_jobs_gauge.labels(priority.name).set_function(partial(_get_ready_jobs, priority))
+    oldest_ready_job_age_gauge.labels(priority.name).set_function(partial(_get_oldest_ready_job_age, priority))
+
+
 signup_initiations_counter = Counter(
     "couchers_signup_initiations_total",
     "Number of initiated signups",
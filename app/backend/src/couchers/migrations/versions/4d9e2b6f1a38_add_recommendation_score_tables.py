@@ -0,0 +1,53 @@
+"""Add user_recommendation_scores and stale_recommendation_scores
+
+Revision ID: 4d9e2b6f1a38
+Revises: c3f8a1d26e07
+Create Date: 2026-10-18 19:12:54.603117
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "4d9e2b6f1a38"
+down_revision = "c3f8a1d26e07"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        "user_recommendation_scores",
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.Column("profile_points", sa.Float(), nullable=False),
+        sa.Column("reference_points", sa.Float(), nullable=False),
+        sa.Column("activeness_points", sa.Float(), nullable=False),
+        sa.Column("verification_points", sa.Float(), nullable=False),
+        sa.Column("response_rate_points", sa.Float(), nullable=False),
+        sa.Column("reference_count", sa.Integer(), nullable=False),
+        sa.Column("updated", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], name=op.f("fk_user_recommendation_scores_user_id_users")),
+        sa.PrimaryKeyConstraint("user_id", name=op.f("pk_user_recommendation_scores")),
+    )
+    op.create_index(
+        "ix_user_recommendation_scores_has_references",
+        "user_recommendation_scores",
+        ["user_id"],
+        unique=False,
+        postgresql_where=sa.text("reference_count > 0"),
+    )
+    op.create_table(
+        "stale_recommendation_scores",
+        sa.Column("user_id", sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(["user_id"], ["users.id"], name=op.f("fk_stale_recommendation_scores_user_id_users")),
+        sa.PrimaryKeyConstraint("user_id", name=op.f("pk_stale_recommendation_scores")),
+    )
+    # everyone gets their components filled in by the next stale scores run
+    op.execute("INSERT INTO stale_recommendation_scores (user_id) SELECT id FROM users")
+
+
+def downgrade():
+    op.drop_table("stale_recommendation_scores")
+    op.drop_index("ix_user_recommendation_scores_has_references", table_name="user_recommendation_scores")
+    op.drop_table("user_recommendation_scores")
@@ -0,0 +1,68 @@
+"""Add search tsvectors and trigram indexes
+
+Revision ID: 5e1f0b7c9a42
+Revises: 8a2c51f0d3b7
+Create Date: 2026-10-18 13:40:09.518263
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "5e1f0b7c9a42"
+down_revision = "8a2c51f0d3b7"
+branch_labels = None
+depends_on = None
+
+search_tsvs = {
+    "users": "setweight(to_tsvector('english', coalesce(username, '') || ' ' || coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(city, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(about_me, '')), 'C') || "
+    "setweight(to_tsvector('english', coalesce(my_travels, '') || ' ' || coalesce(things_i_like, '') || ' ' || "
+    "coalesce(about_place, '') || ' ' || coalesce(additional_information, '')), 'D')",
+    "clusters": "setweight(to_tsvector('english', coalesce(name, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'C')",
+    "page_versions": "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(address, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(content, '')), 'D')",
+    "events": "setweight(to_tsvector('english', coalesce(title, '')), 'A')",
+    "event_occurrences": "setweight(to_tsvector('english', coalesce(address, '') || ' ' || coalesce(link, '')), 'B') || "
+    "setweight(to_tsvector('english', coalesce(content, '')), 'D')",
+}
+
+search_titles = {
+    "users": "username || ' ' || name",
+    "clusters": "name",
+    "page_versions": "title",
+    "events": "title",
+}
+
+
+def upgrade():
+    # unaccent is only stable (it depends on the dictionary), this pins the dictionary so it can be used in indexes
+    op.execute(
+        """
+    CREATE OR REPLACE FUNCTION immutable_unaccent("text" TEXT)
+    RETURNS TEXT AS $$
+    SELECT public.unaccent('public.unaccent', "text");
+    $$ LANGUAGE SQL STRICT IMMUTABLE PARALLEL SAFE;
+    """
+    )
+    for table, tsv in search_tsvs.items():
+        op.add_column(table, sa.Column("search_tsv", postgresql.TSVECTOR(), sa.Computed(tsv, persisted=True)))
+        op.create_index(f"ix_{table}_search_tsv", table, ["search_tsv"], unique=False, postgresql_using="gin")
+    for table, title in search_titles.items():
+        op.execute(
+            f"CREATE INDEX ix_{table}_search_title_trgm ON {table} USING gin (immutable_unaccent({title}) gin_trgm_ops)"
+        )
+
+
+def downgrade():
+    for table in search_titles:
+        op.drop_index(f"ix_{table}_search_title_trgm", table_name=table)
+    for table in search_tsvs:
+        op.drop_index(f"ix_{table}_search_tsv", table_name=table)
+        op.drop_column(table, "search_tsv")
+    op.execute("DROP FUNCTION immutable_unaccent")
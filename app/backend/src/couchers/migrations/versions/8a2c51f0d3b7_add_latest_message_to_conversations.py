@@ -0,0 +1,40 @@
+"""Add latest message to conversations
+
+Revision ID: 8a2c51f0d3b7
+Revises: 3ac39dcf3b5a
+Create Date: 2026-10-18 10:12:31.284517
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8a2c51f0d3b7"
+down_revision = "3ac39dcf3b5a"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("conversations", sa.Column("latest_message_id", sa.BigInteger(), nullable=True))
+    op.add_column("conversations", sa.Column("latest_message_time", sa.DateTime(timezone=True), nullable=True))
+    op.execute(
+        """
+        UPDATE conversations
+        SET latest_message_id = latest.id, latest_message_time = latest.time
+        FROM (
+            SELECT DISTINCT ON (conversation_id) conversation_id, id, time
+            FROM messages
+            ORDER BY conversation_id, id DESC
+        ) AS latest
+        WHERE conversations.id = latest.conversation_id
+        """
+    )
+    op.create_index(op.f("ix_conversations_latest_message_id"), "conversations", ["latest_message_id"], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_conversations_latest_message_id"), table_name="conversations")
+    op.drop_column("conversations", "latest_message_time")
+    op.drop_column("conversations", "latest_message_id")
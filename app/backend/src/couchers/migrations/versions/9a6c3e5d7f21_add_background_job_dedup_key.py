@@ -0,0 +1,32 @@
+"""Add background_jobs.dedup_key
+
+Revision ID: 9a6c3e5d7f21
+Revises: 4d9e2b6f1a38
+Create Date: 2026-10-18 20:36:02.174859
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9a6c3e5d7f21"
+down_revision = "4d9e2b6f1a38"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("background_jobs", sa.Column("dedup_key", sa.String(), nullable=True))
+    op.create_index(
+        "ix_background_jobs_dedup_key",
+        "background_jobs",
+        ["job_type", "dedup_key"],
+        unique=True,
+        postgresql_where=sa.text("dedup_key IS NOT NULL AND (state = 'pending' OR state = 'error')"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_background_jobs_dedup_key", table_name="background_jobs")
+    op.drop_column("background_jobs", "dedup_key")
@@ -0,0 +1,39 @@
+"""Add trigram indexes for ilike search
+
+Revision ID: b7d4e2a9c153
+Revises: 5e1f0b7c9a42
+Create Date: 2026-10-18 15:02:47.731904
+
+"""
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "b7d4e2a9c153"
+down_revision = "5e1f0b7c9a42"
+branch_labels = None
+depends_on = None
+
+trigram_indexes = [
+    ("events", "title"),
+    ("event_occurrences", "content"),
+    ("event_occurrences", "address"),
+    ("messages", "text"),
+]
+
+
+def upgrade():
+    for table, column in trigram_indexes:
+        op.create_index(
+            f"ix_{table}_{column}_trgm",
+            table,
+            [column],
+            unique=False,
+            postgresql_using="gin",
+            postgresql_ops={column: "gin_trgm_ops"},
+        )
+
+
+def downgrade():
+    for table, column in trigram_indexes:
+        op.drop_index(f"ix_{table}_{column}_trgm", table_name=table)
@@ -0,0 +1,29 @@
+"""Add users.geom_updated
+
+Revision ID: c3f8a1d26e07
+Revises: b7d4e2a9c153
+Create Date: 2026-10-18 17:41:09.218356
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "c3f8a1d26e07"
+down_revision = "b7d4e2a9c153"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column(
+        "users",
+        sa.Column("geom_updated", sa.DateTime(timezone=True), server_default=sa.text("now()"), nullable=False),
+    )
+    op.create_index(op.f("ix_users_geom_updated"), "users", ["geom_updated"], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f("ix_users_geom_updated"), table_name="users")
+    op.drop_column("users", "geom_updated")
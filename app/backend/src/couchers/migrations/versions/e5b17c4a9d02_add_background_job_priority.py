@@ -0,0 +1,46 @@
+"""Add background_jobs.priority
+
+Revision ID: e5b17c4a9d02
+Revises: 9a6c3e5d7f21
+Create Date: 2026-10-18 21:48:37.519204
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "e5b17c4a9d02"
+down_revision = "9a6c3e5d7f21"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    background_job_priority = sa.Enum("high", "normal", "bulk", name="backgroundjobpriority")
+    background_job_priority.create(op.get_bind())
+    op.add_column(
+        "background_jobs",
+        sa.Column("priority", background_job_priority, server_default="normal", nullable=False),
+    )
+    op.drop_index("ix_background_jobs_lookup", table_name="background_jobs")
+    op.create_index(
+        "ix_background_jobs_lookup",
+        "background_jobs",
+        ["priority", "next_attempt_after", (sa.column("max_tries") - sa.column("try_count"))],
+        unique=False,
+        postgresql_where=sa.text("state = 'pending' OR state = 'error'"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_background_jobs_lookup", table_name="background_jobs")
+    op.create_index(
+        "ix_background_jobs_lookup",
+        "background_jobs",
+        ["next_attempt_after", (sa.column("max_tries") - sa.column("try_count"))],
+        unique=False,
+        postgresql_where=sa.text("state = 'pending' OR state = 'error'"),
+    )
+    op.drop_column("background_jobs", "priority")
+    op.execute("DROP TYPE backgroundjobpriority")
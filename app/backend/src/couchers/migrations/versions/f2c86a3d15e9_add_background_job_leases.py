@@ -0,0 +1,32 @@
+"""Add background_jobs.leased_until
+
+Revision ID: f2c86a3d15e9
+Revises: e5b17c4a9d02
+Create Date: 2026-10-18 22:31:14.806352
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "f2c86a3d15e9"
+down_revision = "e5b17c4a9d02"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column("background_jobs", sa.Column("leased_until", sa.DateTime(timezone=True), nullable=True))
+    op.create_index(
+        "ix_background_jobs_leased",
+        "background_jobs",
+        ["job_type"],
+        unique=False,
+        postgresql_where=sa.text("leased_until IS NOT NULL"),
+    )
+
+
+def downgrade():
+    op.drop_index("ix_background_jobs_leased", table_name="background_jobs")
+    op.drop_column("background_jobs", "leased_until")
@@ -10,6 +10,7 @@ from sqlalchemy import (
     Boolean,
     CheckConstraint,
     Column,
+    Computed,
     Date,
     DateTime,
     Enum,
@@ -22,13 +23,16 @@ from sqlalchemy import (
     Sequence,
     String,
     UniqueConstraint,
+    event,
+    inspect,
 )
 from sqlalchemy import LargeBinary as Binary
-from sqlalchemy.dialects.postgresql import TSTZRANGE, ExcludeConstraint
+from sqlalchemy.dialects.postgresql import TSTZRANGE, TSVECTOR, ExcludeConstraint
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 from sqlalchemy.orm import backref, column_property, declarative_base, deferred, relationship
-from sqlalchemy.sql import and_, func, text
+from sqlalchemy.sql import and_, func, or_, text, update
 from sqlalchemy.sql import select as sa_select
 
 from couchers import urls
@@ -58,6 +62,33 @@ meta = MetaData(
 Base = declarative_base(metadata=meta)
 
 
+def _search_tsvector(A, B=(), C=(), D=()):
+    """
+    Builds the SQL for a generated weighted tsvector column from lists of column names for weights A, B, C and D
+
+    The text search config has to be spelled out for the expression to be immutable, it must match
+    couchers.servicers.search.REGCONFIG
+    """
+    parts = []
+    for weight, columns in zip("ABCD", (A, B, C, D)):
+        if columns:
+            doc = " || ' ' || ".join(f"coalesce({column}, '')" for column in columns)
+            parts.append(f"setweight(to_tsvector('english', {doc}), '{weight}')")
+    return " || ".join(parts)
+
+
+def _trigram_index(name, title):
+    """
+    A trigram index on the unaccented title, for searching by word similarity with the <% operator
+    """
+    return Index(
+        name,
+        func.immutable_unaccent(title).label("title"),
+        postgresql_using="gin",
+        postgresql_ops={"title": "gin_trgm_ops"},
+    )
+
+
 class HostingStatus(enum.Enum):
     can_host = enum.auto()
     maybe = enum.auto()
@@ -129,6 +160,8 @@ class User(Base):
     # point describing their location. EPSG4326 is the SRS (spatial ref system, = way to describe a point on earth) used
     # by GPS, it has the WGS84 geoid with lat/lon
     geom = Column(Geometry(geometry_type="POINT", srid=4326), nullable=True)
+    # when geom was last set, so community memberships only need to be redone for users who moved
+    geom_updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now(), index=True)
     # their display location (displayed to other users), in meters
     geom_radius = Column(Float, nullable=True)
     # the display address (text) shown on their profile
@@ -286,7 +319,25 @@ class User(Base):
 
     admin_note = Column(String, nullable=False, server_default=text("''"))
 
+    # full text search document, kept up to date by postgres
+    search_tsv = deferred(
+        Column(
+            TSVECTOR,
+            Computed(
+                _search_tsvector(
+                    ["username", "name"],
+                    ["city"],
+                    ["about_me"],
+                    ["my_travels", "things_i_like", "about_place", "additional_information"],
+                ),
+                persisted=True,
+            ),
+        )
+    )
+
     __table_args__ = (
+        Index("ix_users_search_tsv", search_tsv, postgresql_using="gin"),
+        _trigram_index("ix_users_search_title_trgm", username + " " + name),
         # Verified phone numbers should be unique
         Index(
             "ix_users_unique_phone",
@@ -415,6 +466,14 @@ class User(Base):
         return f"User(id={self.id}, email={self.email}, username={self.username})"
 
 
+@event.listens_for(User.geom, "set")
+def _update_user_geom_updated(user, value, oldvalue, initiator):
+    """
+    Bumps User.geom_updated whenever the location is set
+    """
+    user.geom_updated = func.now()
+
+
 class UserBadge(Base):
     """
     A badge on a user's profile
@@ -435,6 +494,51 @@ class UserBadge(Base):
     user = relationship("User", backref="badges")
 
 
+class UserRecommendationScore(Base):
+    """
+    The parts that make up a user's recommendation score, User.recommendation_score is their sum plus some noise
+
+    Kept up to date by the recommendation score jobs, see couchers.recommendation_scores
+    """
+
+    __tablename__ = "user_recommendation_scores"
+
+    user_id = Column(ForeignKey("users.id"), primary_key=True)
+
+    # how filled out their profile is, and whether they can host
+    profile_points = Column(Float, nullable=False)
+    # how many references they have and how good they are
+    reference_points = Column(Float, nullable=False)
+    # how recently they've been online and messaged people
+    activeness_points = Column(Float, nullable=False)
+    # badges and being a community builder
+    verification_points = Column(Float, nullable=False)
+    # how quickly they answer host requests
+    response_rate_points = Column(Float, nullable=False)
+
+    # number of references received
+    reference_count = Column(Integer, nullable=False)
+
+    updated = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
+
+    user = relationship("User", backref=backref("recommendation_score_components", uselist=False))
+
+    __table_args__ = (
+        # for UserSearch only_with_references
+        Index("ix_user_recommendation_scores_has_references", user_id, postgresql_where=reference_count > 0),
+    )
+
+
+class StaleRecommendationScore(Base):
+    """
+    Users whose recommendation score needs recomputing because something it depends on was written
+    """
+
+    __tablename__ = "stale_recommendation_scores"
+
+    user_id = Column(ForeignKey("users.id"), primary_key=True)
+
+
 class StrongVerificationAttemptStatus(enum.Enum):
     ## full data states
     # completed, this now provides verification for a user
@@ -1040,6 +1144,11 @@ class Conversation(Base):
     # timezone should always be UTC
     created = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
 
+    # the newest message in the conversation, kept up to date as messages are inserted (see below Message) so that
+    # listing conversations doesn't need to look through all of their messages
+    latest_message_id = Column(BigInteger, nullable=True, index=True)
+    latest_message_time = Column(DateTime(timezone=True), nullable=True)
+
     def __repr__(self):
         return f"Conversation(id={self.id}, created={self.created})"
 
@@ -1185,10 +1294,31 @@ class Message(Base):
         """
         return self.message_type == MessageType.text
 
+    __table_args__ = (
+        # for SearchMessages, ilike with a leading wildcard can't use a btree index
+        Index("ix_messages_text_trgm", text, postgresql_using="gin", postgresql_ops={"text": "gin_trgm_ops"}),
+    )
+
     def __repr__(self):
         return f"Message(id={self.id}, time={self.time}, text={self.text}, author={self.author}, conversation={self.conversation})"
 
 
+@event.listens_for(Message, "after_insert")
+def _update_conversation_latest_message(mapper, connection, message):
+    """
+    Points Conversation.latest_message_id/time at a newly inserted message, unless a newer one got there first
+    """
+    connection.execute(
+        update(Conversation)
+        .where(Conversation.id == message.conversation_id)
+        .where(or_(Conversation.latest_message_id == None, Conversation.latest_message_id < message.id))
+        .values(
+            latest_message_id=message.id,
+            latest_message_time=sa_select(Message.time).where(Message.id == message.id).scalar_subquery(),
+        )
+    )
+
+
 class ContentReport(Base):
     """
     A piece of content reported to admins
@@ -1556,7 +1686,12 @@ class Cluster(Base):
         """Whether the cluster is a leaf node in the cluster hierarchy."""
         return len(self.parent_node.child_nodes) == 0
 
+    # full text search document of the cluster itself, the rest is on the main page
+    search_tsv = deferred(Column(TSVECTOR, Computed(_search_tsvector(["name"], [], ["description"]), persisted=True)))
+
     __table_args__ = (
+        Index("ix_clusters_search_tsv", search_tsv, postgresql_using="gin"),
+        _trigram_index("ix_clusters_search_title_trgm", name),
         # Each node can have at most one official cluster
         Index(
             "ix_clusters_owner_parent_node_id_is_official_cluster",
@@ -1705,11 +1840,18 @@ class PageVersion(Base):
 
     slug = column_property(func.slugify(title))
 
+    # full text search document, kept up to date by postgres
+    search_tsv = deferred(
+        Column(TSVECTOR, Computed(_search_tsvector(["title"], ["address"], [], ["content"]), persisted=True))
+    )
+
     page = relationship("Page", backref="versions", order_by="PageVersion.id")
     editor_user = relationship("User", backref="edited_pages")
     photo = relationship("Upload")
 
     __table_args__ = (
+        Index("ix_page_versions_search_tsv", search_tsv, postgresql_using="gin"),
+        _trigram_index("ix_page_versions_search_title_trgm", title),
         # Geom and address must either both be null or both be set
         CheckConstraint(
             "(geom IS NULL) = (address IS NULL)",
@@ -1791,7 +1933,14 @@ class Event(Base):
         foreign_keys="Event.owner_cluster_id",
     )
 
+    # full text search document of the title, the rest is on the occurrences
+    search_tsv = deferred(Column(TSVECTOR, Computed(_search_tsvector(["title"]), persisted=True)))
+
     __table_args__ = (
+        Index("ix_events_search_tsv", search_tsv, postgresql_using="gin"),
+        _trigram_index("ix_events_search_title_trgm", title),
+        # for EventSearch, which matches with ilike rather than word similarity
+        Index("ix_events_title_trgm", title, postgresql_using="gin", postgresql_ops={"title": "gin_trgm_ops"}),
         # Only one of owner_user and owner_cluster should be set
         CheckConstraint(
             "(owner_user_id IS NULL) <> (owner_cluster_id IS NULL)",
@@ -1842,7 +1991,26 @@ class EventOccurrence(Base):
 
     photo = relationship("Upload")
 
+    # full text search document of everything but the title, which is on the event
+    search_tsv = deferred(
+        Column(TSVECTOR, Computed(_search_tsvector([], ["address", "link"], [], ["content"]), persisted=True))
+    )
+
     __table_args__ = (
+        Index("ix_event_occurrences_search_tsv", search_tsv, postgresql_using="gin"),
+        # for EventSearch
+        Index(
+            "ix_event_occurrences_content_trgm",
+            content,
+            postgresql_using="gin",
+            postgresql_ops={"content": "gin_trgm_ops"},
+        ),
+        Index(
+            "ix_event_occurrences_address_trgm",
+            address,
+            postgresql_using="gin",
+            postgresql_ops={"address": "gin_trgm_ops"},
+        ),
         # Geom and address go together
         CheckConstraint(
             # geom and address are either both null or neither of them are null
@@ -2107,6 +2275,15 @@ class BackgroundJobState(enum.Enum):
     failed = enum.auto()
 
 
+class BackgroundJobPriority(enum.Enum):
+    # jobs are picked in this order, postgres sorts enums by the order the values were declared in
+    # things someone is waiting on, e.g. push notifications and emails
+    high = enum.auto()
+    normal = enum.auto()
+    # fan-outs and periodic batch work, and everything they queue
+    bulk = enum.auto()
+
+
 class BackgroundJob(Base):
     """
     This table implements a queue of background jobs.
@@ -2120,10 +2297,13 @@ class BackgroundJob(Base):
     job_type = Column(String, nullable=False)
     state = Column(Enum(BackgroundJobState), nullable=False, default=BackgroundJobState.pending)
 
+    # ready jobs are picked in order of priority, then next_attempt_after
+    priority = Column(Enum(BackgroundJobPriority), nullable=False, server_default=BackgroundJobPriority.normal.name)
+
     # time queued
     queued = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
 
-    # time at which we may next attempt it, for implementing exponential backoff
+    # time at which we may next attempt it, for delayed jobs and for implementing exponential backoff
     next_attempt_after = Column(DateTime(timezone=True), nullable=False, server_default=func.now())
 
     # used to count number of retries for failed jobs
@@ -2137,21 +2317,45 @@ class BackgroundJob(Base):
     # if the job failed, we write that info here
     failure_info = Column(String, nullable=True)
 
+    # queueing a job with the same job_type and dedup_key as one that hasn't run yet does nothing
+    dedup_key = Column(String, nullable=True)
+
+    # set while a worker is running the job, other workers may claim it again once this has passed
+    leased_until = Column(DateTime(timezone=True), nullable=True)
+
     __table_args__ = (
         # used in looking up background jobs to attempt
-        # create index on background_jobs(next_attempt_after, (max_tries - try_count)) where state = 'pending' OR state = 'error';
+        # create index on background_jobs(priority, next_attempt_after, (max_tries - try_count)) where state = 'pending' OR state = 'error';
         Index(
             "ix_background_jobs_lookup",
+            priority,
             next_attempt_after,
             (max_tries - try_count),
             postgresql_where=((state == BackgroundJobState.pending) | (state == BackgroundJobState.error)),
         ),
+        # at most one job waiting to run per dedup key
+        Index(
+            "ix_background_jobs_dedup_key",
+            job_type,
+            dedup_key,
+            unique=True,
+            postgresql_where=(
+                (dedup_key != None) & ((state == BackgroundJobState.pending) | (state == BackgroundJobState.error))
+            ),
+        ),
+        # used in looking up running jobs
+        Index(
+            "ix_background_jobs_leased",
+            job_type,
+            postgresql_where=(leased_until != None),
+        ),
     )
 
     @hybrid_property
     def ready_for_retry(self):
         return (
             (self.next_attempt_after <= func.now())
+            & ((self.leased_until == None) | (self.leased_until < func.now()))
             & (self.try_count < self.max_tries)
             & ((self.state == BackgroundJobState.pending) | (self.state == BackgroundJobState.error))
         )
@@ -2505,3 +2709,76 @@ class AccountDeletionReason(Base):
     reason = Column(String, nullable=True)
 
     user = relationship("User")
+
+
+def mark_recommendation_scores_stale(connection, user_ids):
+    """
+    Adds users to StaleRecommendationScore, connection can be a Connection or a Session
+    """
+    user_ids = {user_id for user_id in user_ids if user_id is not None}
+    if user_ids:
+        connection.execute(
+            pg_insert(StaleRecommendationScore)
+            .values([{"user_id": user_id} for user_id in sorted(user_ids)])
+            .on_conflict_do_nothing()
+        )
+
+
+# the columns of User that go into the profile part of the recommendation score
+_RECOMMENDATION_SCORE_USER_ATTRIBUTES = [
+    "hometown",
+    "occupation",
+    "education",
+    "about_me",
+    "my_travels",
+    "things_i_like",
+    "about_place",
+    "additional_information",
+    "pet_details",
+    "kid_details",
+    "housemate_details",
+    "other_host_info",
+    "sleeping_details",
+    "area",
+    "house_rules",
+    "avatar_key",
+    "hosting_status",
+    "last_minute",
+]
+
+
+@event.listens_for(User, "after_insert")
+def _mark_new_user_recommendation_score_stale(mapper, connection, user):
+    mark_recommendation_scores_stale(connection, [user.id])
+
+
+@event.listens_for(User, "after_update")
+def _mark_user_recommendation_score_stale(mapper, connection, user):
+    state = inspect(user)
+    if any(state.attrs[name].history.has_changes() for name in _RECOMMENDATION_SCORE_USER_ATTRIBUTES):
+        mark_recommendation_scores_stale(connection, [user.id])
+
+
+@event.listens_for(Reference, "after_insert")
+@event.listens_for(Reference, "after_update")
+def _mark_reference_recommendation_scores_stale(mapper, connection, reference):
+    mark_recommendation_scores_stale(connection, [reference.from_user_id, reference.to_user_id])
+
+
+@event.listens_for(Message, "after_insert")
+def _mark_message_recommendation_score_stale(mapper, connection, message):
+    mark_recommendation_scores_stale(connection, [message.author_id])
+
+
+@event.listens_for(HostRequest, "after_insert")
+def _mark_host_request_recommendation_score_stale(mapper, connection, host_request):
+    mark_recommendation_scores_stale(connection, [host_request.host_user_id])
+
+
+@event.listens_for(UserBadge, "after_insert")
+@event.listens_for(UserBadge, "after_delete")
+@event.listens_for(ClusterSubscription, "after_insert")
+@event.listens_for(ClusterSubscription, "after_update")
+@event.listens_for(ClusterSubscription, "after_delete")
+def _mark_user_recommendation_score_stale_for_row(mapper, connection, row):
+    mark_recommendation_scores_stale(connection, [row.user_id])
@@ -1,14 +1,14 @@
 import logging
-from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 from google.protobuf import empty_pb2
-from jinja2 import Environment, FileSystemLoader
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, insert, update
 
 from couchers import urls
 from couchers.config import config
 from couchers.db import session_scope
 from couchers.email import queue_email
+from couchers.jobs.enqueue import queue_jobs
 from couchers.models import (
     Notification,
     NotificationDelivery,
@@ -27,18 +27,17 @@ from couchers.notifications.unsubscribe import (
     generate_unsub_topic_key,
 )
 from couchers.sql import couchers_select as select
-from couchers.templates.v2 import add_filters
+from couchers.templates.v2 import render_email
 from couchers.utils import get_tz_as_text, now
 from proto.internal import jobs_pb2
 
 logger = logging.getLogger(__name__)
 
-template_folder = Path(__file__).parent / ".." / ".." / ".." / "templates" / "v2"
+# number of pushes from one send_raw_push_notifications job that are delivered at once
+PUSH_BATCH_CONCURRENCY = 8
 
-loader = FileSystemLoader(template_folder)
-env = Environment(loader=loader, trim_blocks=True)
-
-add_filters(env)
+# push services reject larger payloads
+MAX_PUSH_DATA_LENGTH = 3072
 
 
 def _send_email_notification(session, user: User, notification: Notification):
@@ -77,10 +76,7 @@ def _send_email_notification(session, user: User, notification: Notification):
         plain_unsub_section += f"\n\nDo not email me (disables hosting): <{dne_link}>"
         html_unsub_section += f'<br /><a href="{dne_link}">Do not email me (disables hosting)</a>.'
 
-    plain_tmplt = (template_folder / f"{rendered.email_template_name}.txt").read_text()
-    plain = env.from_string(plain_tmplt + plain_unsub_section).render(template_args)
-    html_tmplt = (template_folder / "generated_html" / f"{rendered.email_template_name}.html").read_text()
-    html = env.from_string(html_tmplt.replace("___UNSUB_SECTION___", html_unsub_section)).render(template_args)
+    plain, html = render_email(rendered.email_template_name, template_args, plain_unsub_section, html_unsub_section)
 
     if not rendered.is_critical:
         if user.do_not_email:
@@ -180,7 +176,7 @@ def send_raw_push_notification(payload: jobs_pb2.SendRawPushNotificationPayload)
         logger.info("Not sending push notification due to push notifications disabled")
 
     with session_scope() as session:
-        if len(payload.data) > 3072:
+        if len(payload.data) > MAX_PUSH_DATA_LENGTH:
             raise Exception(f"Data too long for push notification to sub {payload.push_notification_subscription_id}")
         sub = session.execute(
             select(PushNotificationSubscription).where(
@@ -220,6 +216,104 @@ def send_raw_push_notification(payload: jobs_pb2.SendRawPushNotificationPayload)
             raise Exception(f"Failed to deliver push to {sub.id}, code: {resp.status_code}. Response: {resp.text}")
 
 
+def send_raw_push_notifications(payload: jobs_pb2.SendRawPushNotificationsPayload):
+    """
+    Delivers a batch of pushes concurrently, reusing connections to each push service
+
+    No transaction is held while the pushes are being sent. Pushes that fail are queued on their own as
+    send_raw_push_notification jobs to be retried
+    """
+    if not config["PUSH_NOTIFICATIONS_ENABLED"]:
+        logger.info("Not sending push notifications due to push notifications disabled")
+
+    with session_scope() as session:
+        subs = {
+            sub.id: sub
+            for sub in session.execute(
+                select(
+                    PushNotificationSubscription.id,
+                    PushNotificationSubscription.user_id,
+                    PushNotificationSubscription.endpoint,
+                    PushNotificationSubscription.auth_key,
+                    PushNotificationSubscription.p256dh_key,
+                    PushNotificationSubscription.disabled_at,
+                ).where(
+                    PushNotificationSubscription.id.in_(
+                        [push.push_notification_subscription_id for push in payload.pushes]
+                    )
+                )
+            ).all()
+        }
+
+    to_send = []
+    for push in payload.pushes:
+        sub = subs.get(push.push_notification_subscription_id)
+        if not sub:
+            logger.error(f"Tried to send push to missing subscription: {push.push_notification_subscription_id}")
+        elif len(push.data) > MAX_PUSH_DATA_LENGTH:
+            logger.error(f"Data too long for push notification to sub {sub.id}, dropping it")
+        elif sub.disabled_at < now():
+            logger.error(f"Tried to send push to disabled subscription: {sub.id}. Disabled at {sub.disabled_at}.")
+        else:
+            to_send.append((push, sub))
+
+    with ThreadPoolExecutor(max_workers=PUSH_BATCH_CONCURRENCY) as executor:
+        futures = [
+            executor.submit(
+                send_push,
+                push.data,
+                sub.endpoint,
+                sub.auth_key,
+                sub.p256dh_key,
+                config["PUSH_NOTIFICATIONS_VAPID_SUBJECT"],
+                config["PUSH_NOTIFICATIONS_VAPID_PRIVATE_KEY"],
+                ttl=push.ttl,
+            )
+            for push, sub in to_send
+        ]
+
+    failed = []
+    attempts = []
+    gone_sub_ids = []
+    for (push, sub), future in zip(to_send, futures):
+        try:
+            resp = future.result()
+        except Exception as e:
+            logger.exception(f"Failed to deliver push to {sub.id}, retrying separately", exc_info=e)
+            failed.append(push)
+            continue
+        success = resp.status_code in [200, 201, 202]
+        attempts.append(
+            dict(
+                push_notification_subscription_id=sub.id,
+                success=success,
+                status_code=resp.status_code,
+                response=resp.text,
+            )
+        )
+        if success:
+            logger.debug(f"Successfully sent push to sub {sub.id} for user {sub.user_id}")
+        elif resp.status_code == 410:
+            # gone
+            logger.info(f"Push sub {sub.id} for user {sub.user_id} is gone! Disabling.")
+            gone_sub_ids.append(sub.id)
+        else:
+            logger.warning(f"Failed to deliver push to {sub.id}, code: {resp.status_code}, retrying separately")
+            failed.append(push)
+
+    with session_scope() as session:
+        if attempts:
+            session.execute(insert(PushNotificationDeliveryAttempt), attempts)
+        if gone_sub_ids:
+            session.execute(
+                update(PushNotificationSubscription)
+                .where(PushNotificationSubscription.id.in_(gone_sub_ids))
+                .values(disabled_at=func.now())
+                .execution_options(synchronize_session=False)
+            )
+        queue_jobs(session, "send_raw_push_notification", failed)
+
+
 def handle_email_digests(payload: empty_pb2.Empty):
     """
     Sends out email digests
@@ -0,0 +1,55 @@
+"""
+Scheduling of the jobs that notify users about messages they haven't seen in a while
+"""
+
+from datetime import datetime, timedelta, timezone
+
+from couchers.constants import MISSED_MESSAGES_NOTIFICATION_DELAY
+from couchers.jobs.enqueue import queue_job, queue_jobs
+from proto.internal import jobs_pb2
+
+# messages sent to a user within the same interval of this length share one check
+MISSED_MESSAGES_CHECK_INTERVAL = timedelta(minutes=1)
+
+
+def _check_interval(message_time):
+    """
+    The interval message_time falls in, and the time its check runs at
+    """
+    interval_seconds = MISSED_MESSAGES_CHECK_INTERVAL.total_seconds()
+    interval = int(message_time.timestamp() // interval_seconds)
+    interval_end = datetime.fromtimestamp((interval + 1) * interval_seconds, tz=timezone.utc)
+    return interval, interval_end + MISSED_MESSAGES_NOTIFICATION_DELAY
+
+
+def queue_missed_messages_check(session, job_type, user_id, message_time):
+    """
+    Makes sure a job_type job (send_message_notifications or send_request_notifications) for user_id runs once the
+    message sent at message_time is MISSED_MESSAGES_NOTIFICATION_DELAY old
+
+    Messages are grouped by the interval they were sent in, and the check for an interval runs once all of its messages
+    are old enough. So a burst of messages queues a single job, and that job can't already be running when one of the
+    messages it stands for is sent.
+    """
+    interval, run_at = _check_interval(message_time)
+    queue_job(
+        session,
+        job_type,
+        jobs_pb2.MissedMessagesPayload(user_id=user_id),
+        run_at=run_at,
+        dedup_key=f"{user_id}:{interval}",
+    )
+
+
+def queue_missed_messages_checks(session, job_type, user_ids, message_time):
+    """
+    Same as queue_missed_messages_check for each of user_ids, in a constant number of statements
+    """
+    interval, run_at = _check_interval(message_time)
+    queue_jobs(
+        session,
+        job_type,
+        [jobs_pb2.MissedMessagesPayload(user_id=user_id) for user_id in user_ids],
+        run_at=run_at,
+        dedup_keys=[f"{user_id}:{interval}" for user_id in user_ids],
+    )
@@ -1,8 +1,9 @@
 import logging
 
 from google.protobuf import empty_pb2
+from sqlalchemy.sql import insert
 
-from couchers.jobs.enqueue import queue_job
+from couchers.jobs.enqueue import queue_jobs
 from couchers.models import Notification
 from couchers.notifications.utils import enum_from_topic_action
 from proto.internal import jobs_pb2
@@ -33,21 +34,46 @@ def notify(
     Each different notification type should have its own action.
     """
     logger.info(f"Generating notification of type {topic_action} for user {user_id}")
+    notify_many(session, user_data=[(user_id, data)], topic_action=topic_action, key=key)
+
+
+def notify_many(
+    session,
+    *,
+    user_data,
+    topic_action,
+    key="",
+):
+    """
+    Queues the same kind of notification for many users at once, e.g. when fanning out an event or a group chat message.
+
+    user_data is a list of (user_id, data) tuples, see notify() for the other arguments. This does one insert for all
+    the notifications and one for all their handle_notification jobs, instead of a few statements per user.
+    """
+    if not user_data:
+        return
+
+    logger.info(f"Generating notifications of type {topic_action} for {len(user_data)} users")
     topic, action = topic_action.split(":")
+    topic_action_enum = enum_from_topic_action[topic, action]
 
-    notification = Notification(
-        user_id=user_id,
-        topic_action=enum_from_topic_action[topic, action],
-        key=key,
-        data=(data or empty_pb2.Empty()).SerializeToString(),
-    )
-    session.add(notification)
-    session.flush()
+    notification_ids = session.scalars(
+        insert(Notification).returning(Notification.id, sort_by_parameter_order=True),
+        [
+            dict(
+                user_id=user_id,
+                topic_action=topic_action_enum,
+                key=key,
+                data=(data or empty_pb2.Empty()).SerializeToString(),
+            )
+            for user_id, data in user_data
+        ],
+    ).all()
 
-    queue_job(
+    queue_jobs(
         session,
         job_type="handle_notification",
-        payload=jobs_pb2.HandleNotificationPayload(
-            notification_id=notification.id,
-        ),
+        payloads=[
+            jobs_pb2.HandleNotificationPayload(notification_id=notification_id) for notification_id in notification_ids
+        ],
     )
@@ -17,8 +17,7 @@ def get_vapid_public_key():
     return get_vapid_public_key_from_private_key(config["PUSH_NOTIFICATIONS_VAPID_PRIVATE_KEY"])
 
 
-def push_to_subscription(
-    session,
+def _push_payload(
     push_notification_subscription_id: int,
     *,
     title: str,
@@ -27,24 +26,44 @@ def push_to_subscription(
     url: str = None,
     ttl: int = 0,
 ):
+    return jobs_pb2.SendRawPushNotificationPayload(
+        data=json.dumps(
+            {
+                "title": title[:500],
+                "body": body[:2000],
+                "icon": icon or urls.icon_url(),
+                "url": url,
+            }
+        ).encode("utf8"),
+        push_notification_subscription_id=push_notification_subscription_id,
+        ttl=ttl,
+    )
+
+
+def push_to_subscription(session, push_notification_subscription_id: int, **kwargs):
     queue_job(
         session,
         job_type="send_raw_push_notification",
-        payload=jobs_pb2.SendRawPushNotificationPayload(
-            data=json.dumps(
-                {
-                    "title": title[:500],
-                    "body": body[:2000],
-                    "icon": icon or urls.icon_url(),
-                    "url": url,
-                }
-            ).encode("utf8"),
-            push_notification_subscription_id=push_notification_subscription_id,
-            ttl=ttl,
-        ),
+        payload=_push_payload(push_notification_subscription_id, **kwargs),
     )
 
 
+def push_to_subscriptions(session, push_notification_subscription_ids, **kwargs):
+    """
+    Same as above but for many subscriptions, which are delivered concurrently by one job
+    """
+    if len(push_notification_subscription_ids) == 1:
+        push_to_subscription(session, push_notification_subscription_ids[0], **kwargs)
+    elif push_notification_subscription_ids:
+        queue_job(
+            session,
+            job_type="send_raw_push_notifications",
+            payload=jobs_pb2.SendRawPushNotificationsPayload(
+                pushes=[_push_payload(sub_id, **kwargs) for sub_id in push_notification_subscription_ids]
+            ),
+        )
+
+
 def _push_to_user(session, user_id, **kwargs):
     """
     Same as above but for a given user
@@ -58,8 +77,7 @@ def _push_to_user(session, user_id, **kwargs):
         .scalars()
         .all()
     )
-    for sub_id in sub_ids:
-        push_to_subscription(session, sub_id, **kwargs)
+    push_to_subscriptions(session, sub_ids, **kwargs)
 
 
 def push_to_user(session, user_id, **kwargs):
@@ -1,4 +1,7 @@
+import functools
 import logging
+from datetime import timedelta
+from threading import Lock
 from time import time
 from urllib.parse import urlparse
 
@@ -7,11 +10,29 @@ import requests
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import ec
 from py_vapid import Vapid
+from requests.adapters import HTTPAdapter
 
 from couchers.crypto import b64decode_unpadded, b64encode_unpadded
 
 logger = logging.getLogger(__name__)
 
+# how long the signed VAPID claims are valid for, push services reject anything over 24 hours
+VAPID_CLAIM_TTL = timedelta(hours=12)
+
+# signed claims are reused until they're this close to expiring
+VAPID_CLAIM_REFRESH_MARGIN = timedelta(hours=1)
+
+# maximum number of keep-alive connections kept open to each push service
+PUSH_HTTP_POOL_SIZE = 16
+
+_vapid_authorization_lock = Lock()
+# (audience, vapid_sub, vapid_private_key) -> (expiry, authorization header)
+_vapid_authorizations = {}
+
+_http_sessions_lock = Lock()
+# push service origin -> requests.Session
+_http_sessions = {}
+
 
 def gen_vapid_keys():
     prv_key = ec.generate_private_key(ec.SECP256R1())
@@ -28,14 +49,60 @@ def get_vapid_public_key_from_private_key(private):
     )
 
 
-def generate_vapid_authorization(endpoint, vapid_sub, vapid_private_key):
+@functools.lru_cache(maxsize=4)
+def _get_vapid(vapid_private_key):
+    return Vapid.from_string(private_key=vapid_private_key)
+
+
+def _get_origin(endpoint):
     url = urlparse(endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
+
+def generate_vapid_authorization(endpoint, vapid_sub, vapid_private_key):
+    """
+    Gets the VAPID authorization header for the push service of the given endpoint
+
+    The signed claim only depends on the push service, so it's reused until it gets close to expiry
+    """
+    audience = _get_origin(endpoint)
+    key = (audience, vapid_sub, vapid_private_key)
+    with _vapid_authorization_lock:
+        cached = _vapid_authorizations.get(key)
+    if cached and cached[0] - time() > VAPID_CLAIM_REFRESH_MARGIN.total_seconds():
+        return cached[1]
+
+    expiry = int(time() + VAPID_CLAIM_TTL.total_seconds())
     vapid_claim = {
         "sub": vapid_sub,
-        "aud": f"{url.scheme}://{url.netloc}",
-        "exp": int(time()) + (12 * 60 * 60),
+        "aud": audience,
+        "exp": expiry,
     }
-    return Vapid.from_string(private_key=vapid_private_key).sign(vapid_claim)["Authorization"]
+    authorization = _get_vapid(vapid_private_key).sign(vapid_claim)["Authorization"]
+    with _vapid_authorization_lock:
+        _vapid_authorizations[key] = (expiry, authorization)
+    return authorization
+
+
+def _get_http_session(endpoint):
+    """
+    Gets a requests.Session that keeps connections to the endpoint's push service open between pushes
+    """
+    origin = _get_origin(endpoint)
+    with _http_sessions_lock:
+        if origin not in _http_sessions:
+            http_session = requests.Session()
+            http_session.mount(origin, HTTPAdapter(pool_connections=1, pool_maxsize=PUSH_HTTP_POOL_SIZE))
+            _http_sessions[origin] = http_session
+        return _http_sessions[origin]
+
+
+def close_http_sessions():
+    with _http_sessions_lock:
+        http_sessions = list(_http_sessions.values())
+        _http_sessions.clear()
+    for http_session in http_sessions:
+        http_session.close()
 
 
 def send_push(data, endpoint, auth_key, receiver_key, vapid_sub, vapid_private_key, ttl=0):
@@ -46,6 +113,7 @@ def send_push(data, endpoint, auth_key, receiver_key, vapid_sub, vapid_private_k
         "ttl": str(ttl),
     }
 
+    # aes128gcm needs a new ephemeral key for every message, so this one can't be cached
     encrypted = http_ece.encrypt(
         data,
         private_key=ec.generate_private_key(ec.SECP256R1()),
@@ -53,7 +121,7 @@ def send_push(data, endpoint, auth_key, receiver_key, vapid_sub, vapid_private_k
         dh=receiver_key,
     )
 
-    return requests.post(
+    return _get_http_session(endpoint).post(
         endpoint,
         timeout=20,
         data=encrypted,
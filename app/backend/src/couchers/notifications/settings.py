@@ -1,9 +1,14 @@
 import logging
+from datetime import timedelta
+from threading import Lock
+from time import monotonic
 from typing import List
 
+from sqlalchemy import event
+from sqlalchemy.sql import func
+
 from couchers.db import session_scope
 from couchers.models import (
-    NotificationDelivery,
     NotificationDeliveryType,
     NotificationPreference,
     NotificationTopicAction,
@@ -14,26 +19,134 @@ from proto import notifications_pb2
 
 logger = logging.getLogger(__name__)
 
+# changes to preferences are announced on this channel so background workers can drop their cached copy
+PREFERENCES_NOTIFY_CHANNEL = "notification_preferences"
+
+# how long a user's preferences are cached, bounds staleness if a change notification is missed
+PREFERENCE_CACHE_TTL = timedelta(minutes=5)
+
+
+class PreferenceCache:
+    """
+    A TTL cache of user_id -> the user's preference overrides, as a dict of (topic_action, delivery_type) -> deliver
+
+    Most users never change their preferences, so the snapshot is usually empty
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl.total_seconds()
+        self._lock = Lock()
+        # user_id -> (cached until, overrides)
+        self._entries = {}
+        # bumped on every invalidation, so a snapshot loaded before a change can't be cached after it
+        self._generation = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if not entry:
+                return None
+            cached_until, overrides = entry
+            if cached_until < monotonic():
+                del self._entries[user_id]
+                return None
+            return overrides
+
+    def put(self, user_id, overrides, generation):
+        with self._lock:
+            if generation == self._generation:
+                self._entries[user_id] = (monotonic() + self._ttl, overrides)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+
+preference_cache = PreferenceCache(PREFERENCE_CACHE_TTL)
+
+
+def handle_preferences_changed_notify(payload):
+    """
+    Called by background workers for each notification on PREFERENCES_NOTIFY_CHANNEL, the payload is the user id
+    """
+    preference_cache.invalidate(int(payload))
+
+
+def _preferences_changed(session, user_id):
+    session.execute(select(func.pg_notify(PREFERENCES_NOTIFY_CHANNEL, str(user_id))))
+    event.listen(session, "after_commit", lambda _: preference_cache.invalidate(user_id), once=True)
+
+
+def _get_overrides(session, user_ids, use_cache):
+    """
+    Returns a dict of user_id -> dict of (topic_action, delivery_type) -> deliver, loading everything not in the cache
+    in one query
+    """
+    overrides = {}
+    if use_cache:
+        for user_id in user_ids:
+            cached = preference_cache.get(user_id)
+            if cached is not None:
+                overrides[user_id] = cached
+
+    missing = [user_id for user_id in user_ids if user_id not in overrides]
+    if missing:
+        generation = preference_cache.generation
+        loaded = {user_id: {} for user_id in missing}
+        for user_id, topic_action, delivery_type, deliver in session.execute(
+            select(
+                NotificationPreference.user_id,
+                NotificationPreference.topic_action,
+                NotificationPreference.delivery_type,
+                NotificationPreference.deliver,
+            ).where(NotificationPreference.user_id.in_(missing))
+        ).all():
+            loaded[user_id][topic_action, delivery_type] = deliver
+        for user_id, user_overrides in loaded.items():
+            if use_cache:
+                preference_cache.put(user_id, user_overrides, generation)
+            overrides[user_id] = user_overrides
+    return overrides
+
+
+def get_preferences(
+    session, user_topic_actions, use_cache=True
+) -> dict[tuple[int, NotificationTopicAction], List[NotificationDeliveryType]]:
+    """
+    Bulk version of get_preference: resolves a list of (user_id, topic_action) pairs in at most one query
+
+    Returns a dict of (user_id, topic_action) -> list of delivery types
+    """
+    overrides = _get_overrides(session, list({user_id for user_id, _ in user_topic_actions}), use_cache)
+    return {
+        (user_id, topic_action): [
+            dt
+            for dt in NotificationDeliveryType
+            if overrides[user_id].get((topic_action, dt), dt in topic_action.defaults)
+        ]
+        for user_id, topic_action in user_topic_actions
+    }
+
 
 def get_preference(session, user_id: int, topic_action: NotificationTopicAction) -> List[NotificationDeliveryType]:
     """
     Gets the user's preference from the DB or otherwise falls back to defaults
 
-    Must be done in session scope
+    Must be done in session scope. The user's preferences are cached, see PreferenceCache
 
     Returns list of delivery types
     """
-    overrides = {
-        res.delivery_type: res.deliver
-        for res in session.execute(
-            select(NotificationPreference)
-            .where(NotificationPreference.user_id == user_id)
-            .where(NotificationPreference.topic_action == topic_action)
-        )
-        .scalars()
-        .all()
-    }
-    return [dt for dt in NotificationDeliveryType if overrides.get(dt, dt in topic_action.defaults)]
+    return get_preferences(session, [(user_id, topic_action)])[user_id, topic_action]
 
 
 def reset_preference(session, user_id, topic_action, delivery_type):
@@ -41,11 +154,12 @@ def reset_preference(session, user_id, topic_action, delivery_type):
         select(NotificationPreference)
         .where(NotificationPreference.user_id == user_id)
         .where(NotificationPreference.topic_action == topic_action)
-        .where(NotificationDelivery.delivery_type == delivery_type)
+        .where(NotificationPreference.delivery_type == delivery_type)
     ).scalar_one_or_none()
     if current_pref:
         session.delete(current_pref)
         session.flush()
+        _preferences_changed(session, user_id)
 
 
 class PreferenceNotUserEditableError(Exception):
@@ -73,6 +187,7 @@ def set_preference(session, user_id, topic_action: NotificationTopicAction, deli
             )
         )
     session.flush()
+    _preferences_changed(session, user_id)
 
 
 settings_layout = [
@@ -268,6 +383,10 @@ check_settings()
 
 def get_user_setting_groups(user_id) -> List[notifications_pb2.NotificationGroup]:
     with session_scope() as session:
+        # the user is looking at their settings, so read them fresh
+        preferences = get_preferences(
+            session, [(user_id, topic_action) for topic_action in NotificationTopicAction], use_cache=False
+        )
         groups = []
         for heading, group in settings_layout:
             topics = []
@@ -275,7 +394,7 @@ def get_user_setting_groups(user_id) -> List[notifications_pb2.NotificationGroup
                 actions = []
                 for action, description in items:
                     topic_action = enum_from_topic_action[topic, action]
-                    delivery_types = get_preference(session, user_id, topic_action)
+                    delivery_types = preferences[user_id, topic_action]
                     actions.append(
                         notifications_pb2.NotificationItem(
                             action=action,
@@ -0,0 +1,370 @@
+"""
+Recommendation scores, used to order UserSearch results
+
+A user's score is made up of a few parts (profile, references, activeness, verification, response rate) which are
+kept in UserRecommendationScore, and User.recommendation_score is their sum plus some noise so the order gets shuffled
+a bit every time it's recomputed.
+
+Writes that can change someone's score (see the mapper events in couchers.models) add them to StaleRecommendationScore,
+and update_stale_recommendation_scores recomputes just those users, a batch at a time. Parts of the score depend on
+time as well (e.g. how recently someone was active), so update_all_recommendation_scores goes through everyone once a
+day to pick up that drift.
+"""
+
+import logging
+from datetime import timedelta
+from math import sqrt
+
+from sqlalchemy import Integer
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import and_, case, cast, delete, distinct, extract, func, update
+from sqlalchemy.sql.functions import percentile_disc
+
+from couchers.db import session_scope
+from couchers.models import (
+    Cluster,
+    ClusterRole,
+    ClusterSubscription,
+    Float,
+    HostingStatus,
+    HostRequest,
+    Message,
+    MessageType,
+    Reference,
+    StaleRecommendationScore,
+    User,
+    UserBadge,
+    UserRecommendationScore,
+)
+from couchers.sql import couchers_select as select
+from couchers.utils import now
+
+logger = logging.getLogger(__name__)
+
+# number of users whose scores are recomputed in one transaction
+RECOMMENDATION_SCORE_BATCH_SIZE = 1000
+
+_TEXT_FIELDS = [
+    User.hometown,
+    User.occupation,
+    User.education,
+    User.about_me,
+    User.my_travels,
+    User.things_i_like,
+    User.about_place,
+    User.additional_information,
+    User.pet_details,
+    User.kid_details,
+    User.housemate_details,
+    User.other_host_info,
+    User.sleeping_details,
+    User.area,
+    User.house_rules,
+]
+_HOME_FIELDS = [User.about_place, User.other_host_info, User.sleeping_details, User.area, User.house_rules]
+
+_BADGE_POINTS = {
+    "founder": 100,
+    "board_member": 20,
+    "past_board_member": 5,
+    "strong_verification": 3,
+    "volunteer": 3,
+    "past_volunteer": 2,
+    "donor": 1,
+    "phone_verified": 1,
+}
+
+
+def _poor_man_gaussian():
+    """
+    Produces an approximatley std normal random variate
+    """
+    trials = 5
+    return (sum([func.random() for _ in range(trials)]) - trials / 2) / sqrt(trials / 12)
+
+
+def _int(stmt):
+    return func.coalesce(cast(stmt, Integer), 0)
+
+
+def _float(stmt):
+    return func.coalesce(cast(stmt, Float), 0.0)
+
+
+def _score_components(user_ids):
+    """
+    A select of the score components of the given users, with columns named like those of UserRecommendationScore
+
+    Every aggregate is restricted to the given users so a small batch only reads their rows
+    """
+    # profile
+    profile_text = ""
+    for field in _TEXT_FIELDS:
+        profile_text += func.coalesce(field, "")
+    text_length = func.length(profile_text)
+    home_text = ""
+    for field in _HOME_FIELDS:
+        home_text += func.coalesce(field, "")
+    home_length = func.length(home_text)
+
+    has_text = _int(text_length > 500)
+    long_text = _int(text_length > 2000)
+    has_pic = _int(User.avatar_key != None)
+    can_host = _int(User.hosting_status == HostingStatus.can_host)
+    cant_host = _int(User.hosting_status == HostingStatus.cant_host)
+    filled_home = _int(User.last_minute != None) * _int(home_length > 200)
+    profile_points = 2 * has_text + 3 * long_text + 2 * has_pic + 3 * can_host + 2 * filled_home - 5 * cant_host
+
+    # references
+    left_ref_expr = _int(1).label("left_reference")
+    left_refs_subquery = (
+        select(Reference.from_user_id.label("user_id"), left_ref_expr)
+        .where(Reference.from_user_id.in_(user_ids))
+        .group_by(Reference.from_user_id)
+        .subquery()
+    )
+    left_reference = _int(left_refs_subquery.c.left_reference)
+    has_reference_expr = _int(func.count(Reference.id) >= 1).label("has_reference")
+    ref_count_expr = _int(func.count(Reference.id)).label("ref_count")
+    ref_avg_expr = func.avg(1.4 * (Reference.rating - 0.3)).label("ref_avg")
+    has_multiple_types_expr = _int(func.count(distinct(Reference.reference_type)) >= 2).label("has_multiple_types")
+    has_bad_ref_expr = _int(func.sum(_int((Reference.rating <= 0.2) | (~Reference.was_appropriate))) >= 1).label(
+        "has_bad_ref"
+    )
+    received_ref_subquery = (
+        select(
+            Reference.to_user_id.label("user_id"),
+            has_reference_expr,
+            has_multiple_types_expr,
+            has_bad_ref_expr,
+            ref_count_expr,
+            ref_avg_expr,
+        )
+        .where(Reference.to_user_id.in_(user_ids))
+        .group_by(Reference.to_user_id)
+        .subquery()
+    )
+    has_multiple_types = _int(received_ref_subquery.c.has_multiple_types)
+    has_reference = _int(received_ref_subquery.c.has_reference)
+    has_bad_reference = _int(received_ref_subquery.c.has_bad_ref)
+    rating_score = _float(
+        received_ref_subquery.c.ref_avg
+        * (
+            2 * func.least(received_ref_subquery.c.ref_count, 5)
+            + func.greatest(received_ref_subquery.c.ref_count - 5, 0)
+        )
+    )
+    reference_points = 2 * has_reference + has_multiple_types + left_reference - 5 * has_bad_reference + rating_score
+
+    # activeness
+    recently_active = _int(User.last_active >= now() - timedelta(days=180))
+    very_recently_active = _int(User.last_active >= now() - timedelta(days=14))
+    recently_messaged = _int(func.max(Message.time) > now() - timedelta(days=14))
+    messaged_lots = _int(func.count(Message.id) > 5)
+    messaging_points_subquery = (recently_messaged + messaged_lots).label("messaging_points")
+    messaging_subquery = (
+        select(Message.author_id.label("user_id"), messaging_points_subquery)
+        .where(Message.message_type == MessageType.text)
+        .where(Message.author_id.in_(user_ids))
+        .group_by(Message.author_id)
+        .subquery()
+    )
+    activeness_points = recently_active + 2 * very_recently_active + _int(messaging_subquery.c.messaging_points)
+
+    # verification
+    cb_subquery = (
+        select(ClusterSubscription.user_id.label("user_id"), func.min(Cluster.parent_node_id).label("min_node_id"))
+        .join(Cluster, Cluster.id == ClusterSubscription.cluster_id)
+        .where(ClusterSubscription.role == ClusterRole.admin)
+        .where(Cluster.is_official_cluster)
+        .where(ClusterSubscription.user_id.in_(user_ids))
+        .group_by(ClusterSubscription.user_id)
+        .subquery()
+    )
+    min_node_id = cb_subquery.c.min_node_id
+    cb = _int(min_node_id >= 1)
+    wcb = _int(min_node_id == 1)
+
+    badge_subquery = (
+        select(
+            UserBadge.user_id.label("user_id"),
+            func.sum(case(_BADGE_POINTS, value=UserBadge.badge_id, else_=0)).label("badge_points"),
+        )
+        .where(UserBadge.user_id.in_(user_ids))
+        .group_by(UserBadge.user_id)
+        .subquery()
+    )
+
+    verification_points = 0.0 + 10 * wcb + 5 * cb + _int(badge_subquery.c.badge_points)
+
+    # response rate
+    host_conversations = (
+        select(HostRequest.conversation_id, HostRequest.host_user_id)
+        .where(HostRequest.host_user_id.in_(user_ids))
+        .subquery()
+    )
+    t = (
+        select(Message.conversation_id, Message.time)
+        .join(host_conversations, host_conversations.c.conversation_id == Message.conversation_id)
+        .where(Message.message_type == MessageType.chat_created)
+        .subquery()
+    )
+    s = (
+        select(Message.conversation_id, Message.author_id, func.min(Message.time).label("time"))
+        .join(
+            host_conversations,
+            and_(
+                host_conversations.c.conversation_id == Message.conversation_id,
+                host_conversations.c.host_user_id == Message.author_id,
+            ),
+        )
+        .group_by(Message.conversation_id, Message.author_id)
+        .subquery()
+    )
+    hr_subquery = (
+        select(
+            HostRequest.host_user_id.label("user_id"),
+            func.avg(s.c.time - t.c.time).label("avg_response_time"),
+            func.count(t.c.time).label("received"),
+            func.count(s.c.time).label("responded"),
+            _float(
+                extract(
+                    "epoch",
+                    percentile_disc(0.33).within_group(func.coalesce(s.c.time - t.c.time, timedelta(days=1000))),
+                )
+                / 60.0
+            ).label("response_time_33p"),
+            _float(
+                extract(
+                    "epoch",
+                    percentile_disc(0.66).within_group(func.coalesce(s.c.time - t.c.time, timedelta(days=1000))),
+                )
+                / 60.0
+            ).label("response_time_66p"),
+        )
+        .join(t, t.c.conversation_id == HostRequest.conversation_id)
+        .outerjoin(
+            s, and_(s.c.conversation_id == HostRequest.conversation_id, s.c.author_id == HostRequest.host_user_id)
+        )
+        .where(HostRequest.host_user_id.in_(user_ids))
+        .group_by(HostRequest.host_user_id)
+        .subquery()
+    )
+    response_time_33p = hr_subquery.c.response_time_33p
+    response_time_66p = hr_subquery.c.response_time_66p
+    # be careful with nulls
+    response_rate_points = -10 * _int(response_time_33p > 60 * 48.0) + 5 * _int(response_time_66p < 60 * 48.0)
+
+    return (
+        select(
+            User.id.label("user_id"),
+            profile_points.label("profile_points"),
+            reference_points.label("reference_points"),
+            activeness_points.label("activeness_points"),
+            verification_points.label("verification_points"),
+            response_rate_points.label("response_rate_points"),
+            _int(received_ref_subquery.c.ref_count).label("reference_count"),
+        )
+        .outerjoin(messaging_subquery, messaging_subquery.c.user_id == User.id)
+        .outerjoin(left_refs_subquery, left_refs_subquery.c.user_id == User.id)
+        .outerjoin(badge_subquery, badge_subquery.c.user_id == User.id)
+        .outerjoin(received_ref_subquery, received_ref_subquery.c.user_id == User.id)
+        .outerjoin(cb_subquery, cb_subquery.c.user_id == User.id)
+        .outerjoin(hr_subquery, hr_subquery.c.user_id == User.id)
+        .where(User.id.in_(user_ids))
+    )
+
+
+_COMPONENT_COLUMNS = [
+    "profile_points",
+    "reference_points",
+    "activeness_points",
+    "verification_points",
+    "response_rate_points",
+]
+
+
+def update_recommendation_scores_for_users(session, user_ids):
+    """
+    Recomputes the score components and User.recommendation_score of the given users
+    """
+    columns = ["user_id", *_COMPONENT_COLUMNS, "reference_count"]
+    statement = insert(UserRecommendationScore).from_select(columns, _score_components(user_ids))
+    session.execute(
+        statement.on_conflict_do_update(
+            index_elements=["user_id"],
+            set_={
+                **{name: statement.excluded[name] for name in columns if name != "user_id"},
+                "updated": func.now(),
+            },
+        )
+    )
+    session.execute(
+        update(User)
+        .where(User.id == UserRecommendationScore.user_id)
+        .where(UserRecommendationScore.user_id.in_(user_ids))
+        .values(
+            recommendation_score=sum(getattr(UserRecommendationScore, name) for name in _COMPONENT_COLUMNS)
+            + 2 * _poor_man_gaussian()
+        )
+        .execution_options(synchronize_session=False)
+    )
+
+
+def update_stale_recommendation_scores(batch_size=RECOMMENDATION_SCORE_BATCH_SIZE):
+    """
+    Recomputes the scores of everyone in StaleRecommendationScore, batch_size users per transaction
+
+    Returns the number of users updated
+    """
+    updated = 0
+    while True:
+        with session_scope() as session:
+            # users marked stale again while we're at it stay in the table and get picked up next time
+            batch = (
+                select(StaleRecommendationScore.user_id)
+                .order_by(StaleRecommendationScore.user_id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )
+            user_ids = (
+                session.execute(
+                    delete(StaleRecommendationScore)
+                    .where(StaleRecommendationScore.user_id.in_(batch.scalar_subquery()))
+                    .returning(StaleRecommendationScore.user_id)
+                )
+                .scalars()
+                .all()
+            )
+            if user_ids:
+                update_recommendation_scores_for_users(session, user_ids)
+        updated += len(user_ids)
+        if len(user_ids) < batch_size:
+            break
+    logger.info(f"Updated {updated} stale recommendation scores")
+    return updated
+
+
+def update_all_recommendation_scores(batch_size=RECOMMENDATION_SCORE_BATCH_SIZE):
+    """
+    Recomputes everyone's score, batch_size users per transaction so the users table is never locked as a whole
+
+    Leaves StaleRecommendationScore alone, anyone in there gets recomputed again by the next stale run, which is cheap
+    """
+    last_user_id = 0
+    updated = 0
+    while True:
+        with session_scope() as session:
+            user_ids = (
+                session.execute(select(User.id).where(User.id > last_user_id).order_by(User.id).limit(batch_size))
+                .scalars()
+                .all()
+            )
+            if user_ids:
+                update_recommendation_scores_for_users(session, user_ids)
+        updated += len(user_ids)
+        if len(user_ids) < batch_size:
+            break
+        last_user_id = user_ids[-1]
+    logger.info(f"Updated {updated} recommendation scores")
+    return updated
@@ -90,19 +90,15 @@ def mod_note_to_pb(note: ModNote):
     )
 
 
-def get_strong_verification_fields(session, db_user):
+def strong_verification_fields_for_attempt(db_user, attempt):
+    """
+    Computes the strong verification fields of a user's profile given their latest valid attempt (or None)
+    """
     out = dict(
         birthdate_verification_status=api_pb2.BIRTHDATE_VERIFICATION_STATUS_UNVERIFIED,
         gender_verification_status=api_pb2.GENDER_VERIFICATION_STATUS_UNVERIFIED,
         has_strong_verification=False,
     )
-    attempt = session.execute(
-        select(StrongVerificationAttempt)
-        .where(StrongVerificationAttempt.user_id == db_user.id)
-        .where(StrongVerificationAttempt.is_valid)
-        .order_by(StrongVerificationAttempt.passport_expiry_datetime.desc())
-        .limit(1)
-    ).scalar_one_or_none()
     if attempt:
         assert attempt.is_valid
         if attempt.matches_birthdate(db_user):
@@ -124,6 +120,32 @@ def get_strong_verification_fields(session, db_user):
     return out
 
 
+def get_strong_verification_fields(session, db_user):
+    attempt = session.execute(
+        select(StrongVerificationAttempt)
+        .where(StrongVerificationAttempt.user_id == db_user.id)
+        .where(StrongVerificationAttempt.is_valid)
+        .order_by(StrongVerificationAttempt.passport_expiry_datetime.desc())
+        .limit(1)
+    ).scalar_one_or_none()
+    return strong_verification_fields_for_attempt(db_user, attempt)
+
+
+def get_latest_strong_verification_attempts(session, user_ids):
+    """
+    Batched version of the lookup in get_strong_verification_fields: returns a dict of user_id -> latest valid attempt
+    for those of user_ids that have one, in a single query
+    """
+    attempts = session.execute(
+        select(StrongVerificationAttempt)
+        .where(StrongVerificationAttempt.user_id.in_(user_ids))
+        .where(StrongVerificationAttempt.is_valid)
+        .order_by(StrongVerificationAttempt.user_id, StrongVerificationAttempt.passport_expiry_datetime.desc())
+        .distinct(StrongVerificationAttempt.user_id)
+    ).scalars()
+    return {attempt.user_id: attempt for attempt in attempts}
+
+
 def abort_on_invalid_password(password, context):
     """
     Internal utility function: given a password, aborts if password is unforgivably insecure
@@ -8,6 +8,7 @@ from shapely.geometry import shape
 from sqlalchemy.sql import or_, select, update
 
 from couchers import errors, urls
+from couchers.auth_cache import invalidate_user_auth_on_commit
 from couchers.db import session_scope
 from couchers.helpers.badges import user_add_badge, user_remove_badge
 from couchers.helpers.clusters import create_cluster, create_node
@@ -27,7 +28,8 @@ from couchers.models import (
 )
 from couchers.notifications.notify import notify
 from couchers.resources import get_badge_dict
-from couchers.servicers.api import get_strong_verification_fields, user_model_to_pb
+from couchers.servicers.account import get_strong_verification_fields
+from couchers.servicers.api import user_model_to_pb
 from couchers.servicers.auth import create_session
 from couchers.servicers.communities import community_to_pb
 from couchers.servicers.events import get_users_to_notify_for_new_event
@@ -193,6 +195,7 @@ class Admin(admin_pb2_grpc.AdminServicer):
                 context.abort(grpc.StatusCode.NOT_FOUND, errors.USER_NOT_FOUND)
             append_admin_note(session, context, user, request.admin_note)
             user.is_banned = True
+            invalidate_user_auth_on_commit(session, user.id)
             return _user_to_details(session, user)
 
     def UnbanUser(self, request, context):
@@ -255,6 +258,7 @@ class Admin(admin_pb2_grpc.AdminServicer):
                 )
             )
             session.flush()
+            invalidate_user_auth_on_commit(session, user.id)
 
             if not request.do_not_notify:
                 notify(
@@ -271,6 +275,7 @@ class Admin(admin_pb2_grpc.AdminServicer):
             if not user:
                 context.abort(grpc.StatusCode.NOT_FOUND, errors.USER_NOT_FOUND)
             user.is_deleted = True
+            invalidate_user_auth_on_commit(session, user.id)
             return _user_to_details(session, user)
 
     def CreateApiKey(self, request, context):
@@ -1,9 +1,9 @@
+from collections import defaultdict
 from datetime import timedelta
 from urllib.parse import urlencode
 
 import grpc
 from google.protobuf import empty_pb2
-from sqlalchemy.orm import aliased
 from sqlalchemy.sql import and_, delete, func, intersect, or_, union
 
 from couchers import errors, urls
@@ -13,26 +13,30 @@ from couchers.db import session_scope
 from couchers.models import (
     FriendRelationship,
     FriendStatus,
-    GroupChatSubscription,
     HostingStatus,
-    HostRequest,
     InitiatedUpload,
     LanguageAbility,
     LanguageFluency,
     MeetupStatus,
-    Message,
     ParkingDetails,
     Reference,
+    Region,
     RegionLived,
     RegionVisited,
     SleepingArrangement,
     SmokingLocation,
+    Upload,
     User,
+    UserBadge,
 )
 from couchers.notifications.notify import notify
 from couchers.resources import language_is_allowed, region_is_allowed
-from couchers.servicers.account import get_strong_verification_fields
+from couchers.servicers.account import (
+    get_latest_strong_verification_attempts,
+    strong_verification_fields_for_attempt,
+)
 from couchers.sql import couchers_select as select
+from couchers.unread_counts import get_unread_counts
 from couchers.utils import Timestamp_from_datetime, create_coordinate, is_valid_name, now
 from proto import api_pb2, api_pb2_grpc, media_pb2, notification_data_pb2
 
@@ -133,59 +137,14 @@ class API(api_pb2_grpc.APIServicer):
             # auth ought to make sure the user exists
             user = session.execute(select(User).where(User.id == context.user_id)).scalar_one()
 
-            # gets only the max message by self-joining messages which have a greater id
-            # if it doesn't have a greater id, it's the biggest
-            message_2 = aliased(Message)
-            unseen_sent_host_request_count = session.execute(
-                select(func.count())
-                .select_from(Message)
-                .join(HostRequest, Message.conversation_id == HostRequest.conversation_id)
-                .outerjoin(
-                    message_2, and_(Message.conversation_id == message_2.conversation_id, Message.id < message_2.id)
-                )
-                .where(HostRequest.surfer_user_id == context.user_id)
-                .where_users_column_visible(context, HostRequest.host_user_id)
-                .where(message_2.id == None)
-                .where(HostRequest.surfer_last_seen_message_id < Message.id)
-            ).scalar_one()
-
-            unseen_received_host_request_count = session.execute(
-                select(func.count())
-                .select_from(Message)
-                .join(HostRequest, Message.conversation_id == HostRequest.conversation_id)
-                .outerjoin(
-                    message_2, and_(Message.conversation_id == message_2.conversation_id, Message.id < message_2.id)
-                )
-                .where_users_column_visible(context, HostRequest.surfer_user_id)
-                .where(HostRequest.host_user_id == context.user_id)
-                .where(message_2.id == None)
-                .where(HostRequest.host_last_seen_message_id < Message.id)
-            ).scalar_one()
-
-            unseen_message_count = session.execute(
-                select(func.count())
-                .select_from(Message)
-                .outerjoin(GroupChatSubscription, GroupChatSubscription.group_chat_id == Message.conversation_id)
-                .where(GroupChatSubscription.user_id == context.user_id)
-                .where(Message.time >= GroupChatSubscription.joined)
-                .where(or_(Message.time <= GroupChatSubscription.left, GroupChatSubscription.left == None))
-                .where(Message.id > GroupChatSubscription.last_seen_message_id)
-            ).scalar_one()
-
-            pending_friend_request_count = session.execute(
-                select(func.count())
-                .select_from(FriendRelationship)
-                .where(FriendRelationship.to_user_id == context.user_id)
-                .where_users_column_visible(context, FriendRelationship.from_user_id)
-                .where(FriendRelationship.status == FriendStatus.pending)
-            ).scalar_one()
+            counts = get_unread_counts(session, context)
 
             return api_pb2.PingRes(
                 user=user_model_to_pb(user, session, context),
-                unseen_message_count=unseen_message_count,
-                unseen_sent_host_request_count=unseen_sent_host_request_count,
-                unseen_received_host_request_count=unseen_received_host_request_count,
-                pending_friend_request_count=pending_friend_request_count,
+                unseen_message_count=counts.unseen_message_count,
+                unseen_sent_host_request_count=counts.unseen_sent_host_request_count,
+                unseen_received_host_request_count=counts.unseen_received_host_request_count,
+                pending_friend_request_count=counts.pending_friend_request_count,
             )
 
     def GetUser(self, request, context):
@@ -734,69 +693,185 @@ class API(api_pb2_grpc.APIServicer):
         )
 
 
+def _get_user_pb_details(session, db_users):
+    """
+    Loads everything needed to serialize the given users that does not depend on who is looking at them, in a constant
+    number of queries regardless of how many users there are
+
+    Returns a dict of field -> dict of user_id -> value
+    """
+    user_ids = list({db_user.id for db_user in db_users})
+    avatar_keys = list({db_user.avatar_key for db_user in db_users if db_user.avatar_key})
+
+    num_references = dict(
+        session.execute(
+            select(Reference.to_user_id, func.count())
+            .join(User, User.id == Reference.from_user_id)
+            .where(User.is_visible)
+            .where(Reference.to_user_id.in_(user_ids))
+            .group_by(Reference.to_user_id)
+        ).all()
+    )
+
+    # the timezone is a deferred column, this stops it from being lazy loaded one user at a time
+    timezones = dict(session.execute(select(User.id, User.timezone).where(User.id.in_(user_ids))).all())
+
+    language_abilities = defaultdict(list)
+    for ability in session.execute(
+        select(LanguageAbility).where(LanguageAbility.user_id.in_(user_ids)).order_by(LanguageAbility.id)
+    ).scalars():
+        language_abilities[ability.user_id].append(ability)
+
+    regions_visited = defaultdict(list)
+    for user_id, region_code in session.execute(
+        select(RegionVisited.user_id, Region.code)
+        .join(Region, Region.code == RegionVisited.region_code)
+        .where(RegionVisited.user_id.in_(user_ids))
+        .order_by(Region.name)
+    ).all():
+        regions_visited[user_id].append(region_code)
+
+    regions_lived = defaultdict(list)
+    for user_id, region_code in session.execute(
+        select(RegionLived.user_id, Region.code)
+        .join(Region, Region.code == RegionLived.region_code)
+        .where(RegionLived.user_id.in_(user_ids))
+        .order_by(Region.name)
+    ).all():
+        regions_lived[user_id].append(region_code)
+
+    badges = defaultdict(list)
+    for user_id, badge_id in session.execute(
+        select(UserBadge.user_id, UserBadge.badge_id).where(UserBadge.user_id.in_(user_ids)).order_by(UserBadge.id)
+    ).all():
+        badges[user_id].append(badge_id)
+
+    avatars = {}
+    if avatar_keys:
+        avatars = {
+            upload.key: upload
+            for upload in session.execute(select(Upload).where(Upload.key.in_(avatar_keys))).scalars().all()
+        }
+
+    return dict(
+        num_references=num_references,
+        timezones=timezones,
+        language_abilities=language_abilities,
+        regions_visited=regions_visited,
+        regions_lived=regions_lived,
+        badges=badges,
+        avatars=avatars,
+        strong_verification_attempts=get_latest_strong_verification_attempts(session, user_ids),
+    )
+
+
+def _get_friend_relationships(session, user_id, other_user_ids):
+    """
+    Gets the accepted or pending friend relationships between user_id and each of other_user_ids (in either direction)
+
+    Returns a dict of other_user_id -> FriendRelationship
+    """
+    friend_relationships = session.execute(
+        select(FriendRelationship)
+        .where(
+            or_(
+                and_(
+                    FriendRelationship.from_user_id == user_id,
+                    FriendRelationship.to_user_id.in_(other_user_ids),
+                ),
+                and_(
+                    FriendRelationship.from_user_id.in_(other_user_ids),
+                    FriendRelationship.to_user_id == user_id,
+                ),
+            )
+        )
+        .where(
+            or_(
+                FriendRelationship.status == FriendStatus.accepted,
+                FriendRelationship.status == FriendStatus.pending,
+            )
+        )
+    ).scalars()
+    return {
+        (
+            friend_relationship.to_user_id
+            if friend_relationship.from_user_id == user_id
+            else friend_relationship.from_user_id
+        ): friend_relationship
+        for friend_relationship in friend_relationships
+    }
+
+
+def users_to_pb(session, db_users, context):
+    """
+    Serializes a list of users as seen by context.user_id, in a constant number of queries
+
+    Use this instead of calling user_model_to_pb in a loop
+    """
+    if not db_users:
+        return []
+    details = _get_user_pb_details(session, db_users)
+    friend_relationships = _get_friend_relationships(session, context.user_id, [db_user.id for db_user in db_users])
+    return [
+        _user_to_pb(db_user, details, context.user_id, friend_relationships.get(db_user.id)) for db_user in db_users
+    ]
+
+
+def user_to_pb_for_viewers(session, db_user, viewer_user_ids):
+    """
+    Serializes one user as seen by each of viewer_user_ids in a constant number of queries, e.g. for notification
+    fan-out
+
+    Returns a dict of viewer_user_id -> api_pb2.User
+    """
+    if not viewer_user_ids:
+        return {}
+    details = _get_user_pb_details(session, [db_user])
+    friend_relationships = _get_friend_relationships(session, db_user.id, viewer_user_ids)
+    return {
+        viewer_user_id: _user_to_pb(db_user, details, viewer_user_id, friend_relationships.get(viewer_user_id))
+        for viewer_user_id in viewer_user_ids
+    }
+
+
 def user_model_to_pb(db_user, session, context):
-    num_references = session.execute(
-        select(func.count())
-        .select_from(Reference)
-        .join(User, User.id == Reference.from_user_id)
-        .where(User.is_visible)
-        .where(Reference.to_user_id == db_user.id)
-    ).scalar_one()
+    return users_to_pb(session, [db_user], context)[0]
+
 
+def _user_to_pb(db_user, details, viewer_user_id, friend_relationship):
     # returns (lat, lng)
     # we put people without coords on null island
     # https://en.wikipedia.org/wiki/Null_Island
     lat, lng = db_user.coordinates or (0, 0)
 
     pending_friend_request = None
-    if db_user.id == context.user_id:
+    if db_user.id == viewer_user_id:
         friends_status = api_pb2.User.FriendshipStatus.NA
-    else:
-        friend_relationship = session.execute(
-            select(FriendRelationship)
-            .where(
-                or_(
-                    and_(
-                        FriendRelationship.from_user_id == context.user_id,
-                        FriendRelationship.to_user_id == db_user.id,
-                    ),
-                    and_(
-                        FriendRelationship.from_user_id == db_user.id,
-                        FriendRelationship.to_user_id == context.user_id,
-                    ),
+    elif friend_relationship:
+        if friend_relationship.status == FriendStatus.accepted:
+            friends_status = api_pb2.User.FriendshipStatus.FRIENDS
+        else:
+            friends_status = api_pb2.User.FriendshipStatus.PENDING
+            if friend_relationship.from_user_id == viewer_user_id:
+                # we sent it
+                pending_friend_request = api_pb2.FriendRequest(
+                    friend_request_id=friend_relationship.id,
+                    state=api_pb2.FriendRequest.FriendRequestStatus.PENDING,
+                    user_id=friend_relationship.to_user_id,
+                    sent=True,
                 )
-            )
-            .where(
-                or_(
-                    FriendRelationship.status == FriendStatus.accepted,
-                    FriendRelationship.status == FriendStatus.pending,
+            else:
+                # we received it
+                pending_friend_request = api_pb2.FriendRequest(
+                    friend_request_id=friend_relationship.id,
+                    state=api_pb2.FriendRequest.FriendRequestStatus.PENDING,
+                    user_id=friend_relationship.from_user_id,
+                    sent=False,
                 )
-            )
-        ).scalar_one_or_none()
+    else:
+        friends_status = api_pb2.User.FriendshipStatus.NOT_FRIENDS
 
-        if friend_relationship:
-            if friend_relationship.status == FriendStatus.accepted:
-                friends_status = api_pb2.User.FriendshipStatus.FRIENDS
-            else:
-                friends_status = api_pb2.User.FriendshipStatus.PENDING
-                if friend_relationship.from_user_id == context.user_id:
-                    # we sent it
-                    pending_friend_request = api_pb2.FriendRequest(
-                        friend_request_id=friend_relationship.id,
-                        state=api_pb2.FriendRequest.FriendRequestStatus.PENDING,
-                        user_id=friend_relationship.to_user.id,
-                        sent=True,
-                    )
-                else:
-                    # we received it
-                    pending_friend_request = api_pb2.FriendRequest(
-                        friend_request_id=friend_relationship.id,
-                        state=api_pb2.FriendRequest.FriendRequestStatus.PENDING,
-                        user_id=friend_relationship.from_user.id,
-                        sent=False,
-                    )
-        else:
-            friends_status = api_pb2.User.FriendshipStatus.NOT_FRIENDS
+    avatar = details["avatars"].get(db_user.avatar_key)
 
     verification_score = 0.0
     if db_user.phone_verification_verified:
@@ -808,13 +883,13 @@ def user_model_to_pb(db_user, session, context):
         name=db_user.name,
         city=db_user.city,
         hometown=db_user.hometown,
-        timezone=db_user.timezone,
+        timezone=details["timezones"].get(db_user.id),
         lat=lat,
         lng=lng,
         radius=db_user.geom_radius,
         verification=verification_score,
         community_standing=db_user.community_standing,
-        num_references=num_references,
+        num_references=details["num_references"].get(db_user.id, 0),
         gender=db_user.gender,
         pronouns=db_user.pronouns,
         age=db_user.age,
@@ -830,20 +905,20 @@ def user_model_to_pb(db_user, session, context):
         about_place=db_user.about_place,
         language_abilities=[
             api_pb2.LanguageAbility(code=ability.language_code, fluency=fluency2api[ability.fluency])
-            for ability in db_user.language_abilities
+            for ability in details["language_abilities"][db_user.id]
         ],
-        regions_visited=[region.code for region in db_user.regions_visited],
-        regions_lived=[region.code for region in db_user.regions_lived],
+        regions_visited=details["regions_visited"][db_user.id],
+        regions_lived=details["regions_lived"][db_user.id],
         additional_information=db_user.additional_information,
         friends=friends_status,
         pending_friend_request=pending_friend_request,
         smoking_allowed=smokinglocation2api[db_user.smoking_allowed],
         sleeping_arrangement=sleepingarrangement2api[db_user.sleeping_arrangement],
         parking_details=parkingdetails2api[db_user.parking_details],
-        avatar_url=db_user.avatar.full_url if db_user.avatar else None,
-        avatar_thumbnail_url=db_user.avatar.thumbnail_url if db_user.avatar else None,
-        badges=[badge.badge_id for badge in db_user.badges],
-        **get_strong_verification_fields(session, db_user),
+        avatar_url=avatar.full_url if avatar else None,
+        avatar_thumbnail_url=avatar.thumbnail_url if avatar else None,
+        badges=details["badges"][db_user.id],
+        **strong_verification_fields_for_attempt(db_user, details["strong_verification_attempts"].get(db_user.id)),
     )
 
     if db_user.max_guests is not None:
@@ -6,6 +6,7 @@ from google.protobuf import empty_pb2
 from sqlalchemy.sql import delete, func
 
 from couchers import errors
+from couchers.auth_cache import invalidate_token_auth_on_commit, invalidate_user_auth_on_commit
 from couchers.constants import GUIDELINES_VERSION, TOS_VERSION, UNDELETE_DAYS
 from couchers.crypto import cookiesafe_secure_token, hash_password, urlsafe_secure_token, verify_password
 from couchers.db import session_scope
@@ -113,6 +114,7 @@ def delete_session(token):
         ).scalar_one_or_none()
         if user_session:
             user_session.deleted = func.now()
+            invalidate_token_auth_on_commit(session, token)
             session.commit()
             return True
         else:
@@ -528,6 +530,7 @@ class Auth(auth_pb2_grpc.AuthServicer):
             user.is_deleted = True
             user.undelete_until = now() + timedelta(days=UNDELETE_DAYS)
             user.undelete_token = urlsafe_secure_token()
+            invalidate_user_auth_on_commit(session, user.id)
 
             session.flush()
 
@@ -23,6 +23,15 @@ def are_blocked(session, user1_id, user2_id):
     return session.execute(select(union(blocked_users, blocking_users).subquery())).first() is not None
 
 
+def get_blocked_user_ids(session, user_id):
+    """
+    Gets the set of users that user_id has blocked or been blocked by, i.e. everyone are_blocked() is true for
+    """
+    blocked_users = select(UserBlock.blocked_user_id).where(UserBlock.blocking_user_id == user_id)
+    blocking_users = select(UserBlock.blocking_user_id).where(UserBlock.blocked_user_id == user_id)
+    return set(session.execute(union(blocked_users, blocking_users)).scalars().all())
+
+
 class Blocking(blocking_pb2_grpc.BlockingServicer):
     def BlockUser(self, request, context):
         with session_scope() as session:
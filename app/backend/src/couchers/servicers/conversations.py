@@ -1,10 +1,10 @@
 import logging
+from collections import defaultdict
 from datetime import timedelta
-from types import SimpleNamespace
 
 import grpc
 from google.protobuf import empty_pb2
-from sqlalchemy.sql import func, not_, or_, select
+from sqlalchemy.sql import and_, case, func, not_, or_, select
 
 from couchers import errors
 from couchers.constants import DATETIME_INFINITY, DATETIME_MINUS_INFINITY
@@ -12,9 +12,10 @@ from couchers.db import session_scope
 from couchers.jobs.enqueue import queue_job
 from couchers.metrics import sent_messages_counter
 from couchers.models import Conversation, GroupChat, GroupChatRole, GroupChatSubscription, Message, MessageType, User
-from couchers.notifications.notify import notify
-from couchers.servicers.api import user_model_to_pb
-from couchers.servicers.blocking import are_blocked
+from couchers.notifications.missed_messages import queue_missed_messages_checks
+from couchers.notifications.notify import notify_many
+from couchers.servicers.api import user_to_pb_for_viewers
+from couchers.servicers.blocking import get_blocked_user_ids
 from couchers.sql import couchers_select as select
 from couchers.utils import Timestamp_from_datetime, now
 from proto import conversations_pb2, conversations_pb2_grpc, notification_data_pb2
@@ -79,45 +80,46 @@ def _message_to_pb(message: Message):
         )
 
 
-def _get_visible_members_for_subscription(subscription):
+def _get_visible_members_and_admins(session, subscriptions):
     """
-    If a user leaves a group chat, they shouldn't be able to see who's added
-    after they left
-    """
-    if not subscription.left:
-        # still in the chat, we see everyone with a current subscription
-        return [sub.user_id for sub in subscription.group_chat.subscriptions.where(GroupChatSubscription.left == None)]
-    else:
-        # not in chat anymore, see everyone who was in chat when we left
-        return [
-            sub.user_id
-            for sub in subscription.group_chat.subscriptions.where(
-                GroupChatSubscription.joined <= subscription.left
-            ).where(or_(GroupChatSubscription.left >= subscription.left, GroupChatSubscription.left == None))
-        ]
-
+    Works out who the owner of each subscription can see in its group chat, in one query for all of them
 
-def _get_visible_admins_for_subscription(subscription):
-    """
     If a user leaves a group chat, they shouldn't be able to see who's added
     after they left
+
+    Returns a dict of subscription id -> (member user ids, admin user ids)
     """
-    if not subscription.left:
-        # still in the chat, we see everyone with a current subscription
-        return [
-            sub.user_id
-            for sub in subscription.group_chat.subscriptions.where(GroupChatSubscription.left == None).where(
-                GroupChatSubscription.role == GroupChatRole.admin
-            )
-        ]
-    else:
-        # not in chat anymore, see everyone who was in chat when we left
-        return [
-            sub.user_id
-            for sub in subscription.group_chat.subscriptions.where(GroupChatSubscription.role == GroupChatRole.admin)
-            .where(GroupChatSubscription.joined <= subscription.left)
-            .where(or_(GroupChatSubscription.left >= subscription.left, GroupChatSubscription.left == None))
-        ]
+    all_subs = defaultdict(list)
+    for sub in session.execute(
+        select(
+            GroupChatSubscription.group_chat_id,
+            GroupChatSubscription.user_id,
+            GroupChatSubscription.role,
+            GroupChatSubscription.joined,
+            GroupChatSubscription.left,
+        )
+        .where(GroupChatSubscription.group_chat_id.in_({subscription.group_chat_id for subscription in subscriptions}))
+        .order_by(GroupChatSubscription.id)
+    ).all():
+        all_subs[sub.group_chat_id].append(sub)
+
+    visible = {}
+    for subscription in subscriptions:
+        if not subscription.left:
+            # still in the chat, we see everyone with a current subscription
+            visible_subs = [sub for sub in all_subs[subscription.group_chat_id] if sub.left is None]
+        else:
+            # not in chat anymore, see everyone who was in chat when we left
+            visible_subs = [
+                sub
+                for sub in all_subs[subscription.group_chat_id]
+                if sub.joined <= subscription.left and (sub.left is None or sub.left >= subscription.left)
+            ]
+        visible[subscription.id] = (
+            [sub.user_id for sub in visible_subs],
+            [sub.user_id for sub in visible_subs if sub.role == GroupChatRole.admin],
+        )
+    return visible
 
 
 def generate_message_notifications(payload: jobs_pb2.GenerateMessageNotificationsPayload):
@@ -157,25 +159,37 @@ def generate_message_notifications(payload: jobs_pb2.GenerateMessageNotification
         else:
             msg = f"{message.author.name} sent a message in {group_chat.title}"
 
-        for subscription in subscriptions:
-            if are_blocked(session, subscription.user_id, message.author.id):
-                continue
-            notify(
-                session,
-                user_id=subscription.user_id,
-                topic_action="chat:message",
-                key=message.conversation_id,
-                data=notification_data_pb2.ChatMessage(
-                    author=user_model_to_pb(
-                        message.author,
-                        session,
-                        SimpleNamespace(user_id=subscription.user_id),
+        author_pbs = user_to_pb_for_viewers(
+            session, message.author, [subscription.user_id for subscription in subscriptions]
+        )
+
+        blocked_user_ids = get_blocked_user_ids(session, message.author_id)
+
+        notify_many(
+            session,
+            user_data=[
+                (
+                    subscription.user_id,
+                    notification_data_pb2.ChatMessage(
+                        author=author_pbs[subscription.user_id],
+                        message=msg,
+                        text=message.text,
+                        group_chat_id=message.conversation_id,
                     ),
-                    message=msg,
-                    text=message.text,
-                    group_chat_id=message.conversation_id,
-                ),
-            )
+                )
+                for subscription in subscriptions
+                if subscription.user_id not in blocked_user_ids
+            ],
+            topic_action="chat:message",
+            key=message.conversation_id,
+        )
+
+        queue_missed_messages_checks(
+            session,
+            "send_message_notifications",
+            [subscription.user_id for subscription in subscriptions],
+            message.time,
+        )
 
 
 def _add_message_to_subscription(session, subscription, **kwargs):
@@ -202,14 +216,42 @@ def _add_message_to_subscription(session, subscription, **kwargs):
     return message
 
 
-def _unseen_message_count(session, subscription_id):
-    return session.execute(
-        select(func.count())
-        .select_from(Message)
-        .join(GroupChatSubscription, GroupChatSubscription.group_chat_id == Message.conversation_id)
-        .where(GroupChatSubscription.id == subscription_id)
-        .where(Message.id > GroupChatSubscription.last_seen_message_id)
-    ).scalar_one()
+def _latest_visible_message_id():
+    """
+    The id of the latest message in a subscription's group chat that the subscriber can see, for queries that join
+    GroupChatSubscription and Conversation
+
+    Current members can see the conversation's latest message, past members only up to when they left
+    """
+    return case(
+        (
+            and_(GroupChatSubscription.left == None, Conversation.latest_message_time >= GroupChatSubscription.joined),
+            Conversation.latest_message_id,
+        ),
+        else_=(
+            select(func.max(Message.id))
+            .where(Message.conversation_id == GroupChatSubscription.group_chat_id)
+            .where(Message.time >= GroupChatSubscription.joined)
+            .where(or_(Message.time <= GroupChatSubscription.left, GroupChatSubscription.left == None))
+            .scalar_subquery()
+        ),
+    )
+
+
+def _unseen_message_counts(session, subscription_ids):
+    """
+    Returns a dict of subscription id -> number of messages after its last seen message, in one query
+    """
+    counts = dict(
+        session.execute(
+            select(GroupChatSubscription.id, func.count())
+            .join(Message, Message.conversation_id == GroupChatSubscription.group_chat_id)
+            .where(GroupChatSubscription.id.in_(subscription_ids))
+            .where(Message.id > GroupChatSubscription.last_seen_message_id)
+            .group_by(GroupChatSubscription.id)
+        ).all()
+    )
+    return {subscription_id: counts.get(subscription_id, 0) for subscription_id in subscription_ids}
 
 
 def _mute_info(subscription):
@@ -220,6 +262,35 @@ def _mute_info(subscription):
     )
 
 
+def _group_chats_to_pb(session, results):
+    """
+    Serializes group chats as seen through the user's subscriptions, in a constant number of queries
+
+    results are rows with GroupChat, Conversation, GroupChatSubscription and the latest visible Message
+    """
+    if not results:
+        return []
+    subscriptions = [result.GroupChatSubscription for result in results]
+    visible = _get_visible_members_and_admins(session, subscriptions)
+    unseen_message_counts = _unseen_message_counts(session, [subscription.id for subscription in subscriptions])
+    return [
+        conversations_pb2.GroupChat(
+            group_chat_id=result.GroupChat.conversation_id,
+            title=result.GroupChat.title,  # TODO: proper title for DMs, etc
+            member_user_ids=visible[result.GroupChatSubscription.id][0],
+            admin_user_ids=visible[result.GroupChatSubscription.id][1],
+            only_admins_invite=result.GroupChat.only_admins_invite,
+            is_dm=result.GroupChat.is_dm,
+            created=Timestamp_from_datetime(result.Conversation.created),
+            unseen_message_count=unseen_message_counts[result.GroupChatSubscription.id],
+            last_seen_message_id=result.GroupChatSubscription.last_seen_message_id,
+            latest_message=_message_to_pb(result.Message) if result.Message else None,
+            mute_info=_mute_info(result.GroupChatSubscription),
+        )
+        for result in results
+    ]
+
+
 class Conversations(conversations_pb2_grpc.ConversationsServicer):
     def ListGroupChats(self, request, context):
         with session_scope() as session:
@@ -233,44 +304,27 @@ class Conversations(conversations_pb2_grpc.ConversationsServicer):
                 select(
                     GroupChatSubscription.group_chat_id.label("group_chat_id"),
                     func.max(GroupChatSubscription.id).label("group_chat_subscriptions_id"),
-                    func.max(Message.id).label("message_id"),
+                    func.max(_latest_visible_message_id()).label("message_id"),
                 )
-                .join(Message, Message.conversation_id == GroupChatSubscription.group_chat_id)
+                .join(Conversation, Conversation.id == GroupChatSubscription.group_chat_id)
                 .where(GroupChatSubscription.user_id == context.user_id)
-                .where(Message.time >= GroupChatSubscription.joined)
-                .where(or_(Message.time <= GroupChatSubscription.left, GroupChatSubscription.left == None))
                 .group_by(GroupChatSubscription.group_chat_id)
-                .order_by(func.max(Message.id).desc())
                 .subquery()
             )
 
             results = session.execute(
-                select(t, GroupChat, GroupChatSubscription, Message)
+                select(t, GroupChat, Conversation, GroupChatSubscription, Message)
                 .join(Message, Message.id == t.c.message_id)
                 .join(GroupChatSubscription, GroupChatSubscription.id == t.c.group_chat_subscriptions_id)
                 .join(GroupChat, GroupChat.conversation_id == t.c.group_chat_id)
+                .join(Conversation, Conversation.id == t.c.group_chat_id)
                 .where(or_(t.c.message_id < request.last_message_id, request.last_message_id == 0))
                 .order_by(t.c.message_id.desc())
                 .limit(page_size + 1)
             ).all()
 
             return conversations_pb2.ListGroupChatsRes(
-                group_chats=[
-                    conversations_pb2.GroupChat(
-                        group_chat_id=result.GroupChat.conversation_id,
-                        title=result.GroupChat.title,  # TODO: proper title for DMs, etc
-                        member_user_ids=_get_visible_members_for_subscription(result.GroupChatSubscription),
-                        admin_user_ids=_get_visible_admins_for_subscription(result.GroupChatSubscription),
-                        only_admins_invite=result.GroupChat.only_admins_invite,
-                        is_dm=result.GroupChat.is_dm,
-                        created=Timestamp_from_datetime(result.GroupChat.conversation.created),
-                        unseen_message_count=_unseen_message_count(session, result.GroupChatSubscription.id),
-                        last_seen_message_id=result.GroupChatSubscription.last_seen_message_id,
-                        latest_message=_message_to_pb(result.Message) if result.Message else None,
-                        mute_info=_mute_info(result.GroupChatSubscription),
-                    )
-                    for result in results[:page_size]
-                ],
+                group_chats=_group_chats_to_pb(session, results[:page_size]),
                 last_message_id=(
                     min(g.Message.id if g.Message else 1 for g in results[:page_size]) if len(results) > 0 else 0
                 ),  # TODO
@@ -280,9 +334,10 @@ class Conversations(conversations_pb2_grpc.ConversationsServicer):
     def GetGroupChat(self, request, context):
         with session_scope() as session:
             result = session.execute(
-                select(GroupChat, GroupChatSubscription, Message)
+                select(GroupChat, Conversation, GroupChatSubscription, Message)
                 .join(Message, Message.conversation_id == GroupChatSubscription.group_chat_id)
                 .join(GroupChat, GroupChat.conversation_id == GroupChatSubscription.group_chat_id)
+                .join(Conversation, Conversation.id == GroupChatSubscription.group_chat_id)
                 .where(GroupChatSubscription.user_id == context.user_id)
                 .where(GroupChatSubscription.group_chat_id == request.group_chat_id)
                 .where(Message.time >= GroupChatSubscription.joined)
@@ -293,19 +348,7 @@ class Conversations(conversations_pb2_grpc.ConversationsServicer):
             if not result:
                 context.abort(grpc.StatusCode.NOT_FOUND, errors.CHAT_NOT_FOUND)
 
-            return conversations_pb2.GroupChat(
-                group_chat_id=result.GroupChat.conversation_id,
-                title=result.GroupChat.title,
-                member_user_ids=_get_visible_members_for_subscription(result.GroupChatSubscription),
-                admin_user_ids=_get_visible_admins_for_subscription(result.GroupChatSubscription),
-                only_admins_invite=result.GroupChat.only_admins_invite,
-                is_dm=result.GroupChat.is_dm,
-                created=Timestamp_from_datetime(result.GroupChat.conversation.created),
-                unseen_message_count=_unseen_message_count(session, result.GroupChatSubscription.id),
-                last_seen_message_id=result.GroupChatSubscription.last_seen_message_id,
-                latest_message=_message_to_pb(result.Message) if result.Message else None,
-                mute_info=_mute_info(result.GroupChatSubscription),
-            )
+            return _group_chats_to_pb(session, [result])[0]
 
     def GetDirectMessage(self, request, context):
         with session_scope() as session:
@@ -327,8 +370,9 @@ class Conversations(conversations_pb2_grpc.ConversationsServicer):
             )
 
             result = session.execute(
-                select(subquery, GroupChat, GroupChatSubscription, Message)
+                select(subquery, GroupChat, Conversation, GroupChatSubscription, Message)
                 .join(subquery, subquery.c.group_chat_id == GroupChat.conversation_id)
+                .join(Conversation, Conversation.id == GroupChat.conversation_id)
                 .join(Message, Message.conversation_id == GroupChat.conversation_id)
                 .where(GroupChatSubscription.user_id == context.user_id)
                 .where(GroupChatSubscription.group_chat_id == GroupChat.conversation_id)
@@ -340,19 +384,7 @@ class Conversations(conversations_pb2_grpc.ConversationsServicer):
             if not result:
                 context.abort(grpc.StatusCode.NOT_FOUND, errors.CHAT_NOT_FOUND)
 
-            return conversations_pb2.GroupChat(
-                group_chat_id=result.GroupChat.conversation_id,
-                title=result.GroupChat.title,
-                member_user_ids=_get_visible_members_for_subscription(result.GroupChatSubscription),
-                admin_user_ids=_get_visible_admins_for_subscription(result.GroupChatSubscription),
-                only_admins_invite=result.GroupChat.only_admins_invite,
-                is_dm=result.GroupChat.is_dm,
-                created=Timestamp_from_datetime(result.GroupChat.conversation.created),
-                unseen_message_count=_unseen_message_count(session, result.GroupChatSubscription.id),
-                last_seen_message_id=result.GroupChatSubscription.last_seen_message_id,
-                latest_message=_message_to_pb(result.Message) if result.Message else None,
-                mute_info=_mute_info(result.GroupChatSubscription),
-            )
+            return _group_chats_to_pb(session, [result])[0]
 
     def GetUpdates(self, request, context):
         with session_scope() as session:
@@ -566,11 +598,15 @@ class Conversations(conversations_pb2_grpc.ConversationsServicer):
 
             session.flush()
 
+            member_user_ids, admin_user_ids = _get_visible_members_and_admins(session, [your_subscription])[
+                your_subscription.id
+            ]
+
             return conversations_pb2.GroupChat(
                 group_chat_id=group_chat.conversation_id,
                 title=group_chat.title,
-                member_user_ids=_get_visible_members_for_subscription(your_subscription),
-                admin_user_ids=_get_visible_admins_for_subscription(your_subscription),
+                member_user_ids=member_user_ids,
+                admin_user_ids=admin_user_ids,
                 only_admins_invite=group_chat.only_admins_invite,
                 is_dm=group_chat.is_dm,
                 created=Timestamp_from_datetime(group_chat.conversation.created),
@@ -25,9 +25,9 @@ from couchers.models import (
     Upload,
     User,
 )
-from couchers.notifications.notify import notify
-from couchers.servicers.api import user_model_to_pb
-from couchers.servicers.blocking import are_blocked
+from couchers.notifications.notify import notify, notify_many
+from couchers.servicers.api import user_model_to_pb, user_to_pb_for_viewers
+from couchers.servicers.blocking import get_blocked_user_ids
 from couchers.servicers.threads import thread_to_pb
 from couchers.sql import couchers_select as select
 from couchers.tasks import send_event_community_invite_request_email
@@ -262,23 +262,35 @@ def generate_event_create_notifications(payload: jobs_pb2.GenerateEventCreateNot
             logger.error(f"Inviting user {payload.inviting_user_id} is gone while trying to send event notification?")
             return
 
+        inviting_user_pbs = user_to_pb_for_viewers(session, inviting_user, [user.id for user in users])
+        blocked_user_ids = get_blocked_user_ids(session, creator.id)
+
+        user_data = []
         for user in users:
-            if are_blocked(session, user.id, creator.id):
+            if user.id in blocked_user_ids:
                 continue
             context = SimpleNamespace(user_id=user.id)
-            notify(
-                session,
-                user_id=user.id,
-                topic_action="event:create_approved" if payload.approved else "event:create_any",
-                key=payload.occurrence_id,
-                data=notification_data_pb2.EventCreate(
-                    event=event_to_pb(session, occurrence, context),
-                    inviting_user=user_model_to_pb(inviting_user, session, context),
-                    nearby=True if node_id is None else None,
-                    in_community=community_to_pb(session, event.parent_node, context) if node_id is not None else None,
-                ),
+            user_data.append(
+                (
+                    user.id,
+                    notification_data_pb2.EventCreate(
+                        event=event_to_pb(session, occurrence, context),
+                        inviting_user=inviting_user_pbs[user.id],
+                        nearby=True if node_id is None else None,
+                        in_community=(
+                            community_to_pb(session, event.parent_node, context) if node_id is not None else None
+                        ),
+                    ),
+                )
             )
 
+        notify_many(
+            session,
+            user_data=user_data,
+            topic_action="event:create_approved" if payload.approved else "event:create_any",
+            key=payload.occurrence_id,
+        )
+
 
 def generate_event_update_notifications(payload: jobs_pb2.GenerateEventUpdateNotificationsPayload):
     with session_scope() as session:
@@ -289,22 +301,27 @@ def generate_event_update_notifications(payload: jobs_pb2.GenerateEventUpdateNot
         subscribed_user_ids = [user.id for user in event.subscribers]
         attending_user_ids = [user.user_id for user in occurrence.attendances]
 
-        for user_id in set(subscribed_user_ids + attending_user_ids):
-            logger.info(user_id)
-            if are_blocked(session, user_id, updating_user.id):
-                continue
-            context = SimpleNamespace(user_id=user_id)
-            notify(
-                session,
-                user_id=user_id,
-                topic_action="event:update",
-                key=payload.occurrence_id,
-                data=notification_data_pb2.EventUpdate(
-                    event=event_to_pb(session, occurrence, context),
-                    updating_user=user_model_to_pb(updating_user, session, context),
-                    updated_items=payload.updated_items,
-                ),
-            )
+        user_ids = set(subscribed_user_ids + attending_user_ids)
+        updating_user_pbs = user_to_pb_for_viewers(session, updating_user, list(user_ids))
+        blocked_user_ids = get_blocked_user_ids(session, updating_user.id)
+
+        notify_many(
+            session,
+            user_data=[
+                (
+                    user_id,
+                    notification_data_pb2.EventUpdate(
+                        event=event_to_pb(session, occurrence, SimpleNamespace(user_id=user_id)),
+                        updating_user=updating_user_pbs[user_id],
+                        updated_items=payload.updated_items,
+                    ),
+                )
+                for user_id in user_ids
+                if user_id not in blocked_user_ids
+            ],
+            topic_action="event:update",
+            key=payload.occurrence_id,
+        )
 
 
 def generate_event_cancel_notifications(payload: jobs_pb2.GenerateEventCancelNotificationsPayload):
@@ -318,21 +335,26 @@ def generate_event_cancel_notifications(payload: jobs_pb2.GenerateEventCancelNot
         subscribed_user_ids = [user.id for user in event.subscribers]
         attending_user_ids = [user.user_id for user in occurrence.attendances]
 
-        for user_id in set(subscribed_user_ids + attending_user_ids):
-            logger.info(user_id)
-            if are_blocked(session, user_id, cancelling_user.id):
-                continue
-            context = SimpleNamespace(user_id=user_id)
-            notify(
-                session,
-                user_id=user_id,
-                topic_action="event:cancel",
-                key=payload.occurrence_id,
-                data=notification_data_pb2.EventCancel(
-                    event=event_to_pb(session, occurrence, context),
-                    cancelling_user=user_model_to_pb(cancelling_user, session, context),
-                ),
-            )
+        user_ids = set(subscribed_user_ids + attending_user_ids)
+        cancelling_user_pbs = user_to_pb_for_viewers(session, cancelling_user, list(user_ids))
+        blocked_user_ids = get_blocked_user_ids(session, cancelling_user.id)
+
+        notify_many(
+            session,
+            user_data=[
+                (
+                    user_id,
+                    notification_data_pb2.EventCancel(
+                        event=event_to_pb(session, occurrence, SimpleNamespace(user_id=user_id)),
+                        cancelling_user=cancelling_user_pbs[user_id],
+                    ),
+                )
+                for user_id in user_ids
+                if user_id not in blocked_user_ids
+            ],
+            topic_action="event:cancel",
+            key=payload.occurrence_id,
+        )
 
 
 def generate_event_delete_notifications(payload: jobs_pb2.GenerateEventDeleteNotificationsPayload):
@@ -344,18 +366,20 @@ def generate_event_delete_notifications(payload: jobs_pb2.GenerateEventDeleteNot
         subscribed_user_ids = [user.id for user in event.subscribers]
         attending_user_ids = [user.user_id for user in occurrence.attendances]
 
-        for user_id in set(subscribed_user_ids + attending_user_ids):
-            logger.info(user_id)
-            context = SimpleNamespace(user_id=user_id)
-            notify(
-                session,
-                user_id=user_id,
-                topic_action="event:delete",
-                key=payload.occurrence_id,
-                data=notification_data_pb2.EventDelete(
-                    event=event_to_pb(session, occurrence, context),
-                ),
-            )
+        notify_many(
+            session,
+            user_data=[
+                (
+                    user_id,
+                    notification_data_pb2.EventDelete(
+                        event=event_to_pb(session, occurrence, SimpleNamespace(user_id=user_id)),
+                    ),
+                )
+                for user_id in set(subscribed_user_ids + attending_user_ids)
+            ],
+            topic_action="event:delete",
+            key=payload.occurrence_id,
+        )
 
 
 class Events(events_pb2_grpc.EventsServicer):
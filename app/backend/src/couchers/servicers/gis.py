@@ -1,17 +1,32 @@
-import json
 import logging
 
+import grpc
 from sqlalchemy.dialects.postgresql import JSON
 from sqlalchemy.sql import func
+from sqlalchemy.types import Text
 
+from couchers import errors
 from couchers.db import session_scope
-from couchers.models import Node, Page, PageType, PageVersion, User
+from couchers.geojson_snapshots import geojson_snapshots
+from couchers.models import Node, PageType, User
 from couchers.sql import couchers_select as select
+from couchers.tiles import (
+    TILE_CACHE_TTL,
+    get_hidden_user_ids,
+    get_tile,
+    is_valid_tile,
+    latest_page_version_features,
+)
 from proto import gis_pb2_grpc
 from proto.google.api import httpbody_pb2
 
 logger = logging.getLogger(__name__)
 
+# the proxy turns responses with this header into a 304 Not Modified
+NOT_MODIFIED_HEADER = "x-couchers-not-modified"
+
+MVT_CONTENT_TYPE = "application/vnd.mapbox-vector-tile"
+
 
 def _build_geojson_select(statement):
     """
@@ -26,15 +41,92 @@ def _build_geojson_select(statement):
     )
 
 
+def _statement_to_geojson(session, statement):
+    # the JSON text straight from postgres, it's valid as is so there's no point parsing and serializing it again
+    return session.execute(select(_build_geojson_select(statement).cast(Text))).scalar_one().encode("utf8")
+
+
 def _statement_to_geojson_response(session, statement):
-    json_dict = session.execute(select(_build_geojson_select(statement))).scalar_one_or_none()
-    return httpbody_pb2.HttpBody(
-        content_type="application/json",
-        # json.dumps escapes non-ascii characters
-        data=json.dumps(json_dict).encode("ascii"),
+    return httpbody_pb2.HttpBody(content_type="application/json", data=_statement_to_geojson(session, statement))
+
+
+def _build_communities_geojson(session):
+    return _statement_to_geojson(session, select(Node).where(Node.geom != None))
+
+
+def _build_places_geojson(session):
+    return _statement_to_geojson(session, latest_page_version_features(PageType.place))
+
+
+def _build_guides_geojson(session):
+    return _statement_to_geojson(session, latest_page_version_features(PageType.guide))
+
+
+def _etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # compression in the proxy weakens the etag, that doesn't matter for us
+    return etag in [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+
+
+def _accepts_gzip(accept_encoding):
+    if not accept_encoding:
+        return False
+    for coding in accept_encoding.split(","):
+        name, _, params = coding.partition(";")
+        if name.strip() == "gzip":
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+def _cacheable_http_body(context, content_type, data, etag, max_age, extra_metadata=()):
+    """
+    Returns the data with an ETag, or nothing at all if the client already has it
+
+    With max_age=None the client revalidates with the ETag on every request
+    """
+    headers = dict(context.invocation_metadata())
+    cache_control = "private, no-cache" if max_age is None else f"private, max-age={int(max_age.total_seconds())}"
+    metadata = [("etag", etag), ("cache-control", cache_control), *extra_metadata]
+    if _etag_matches(headers.get("if-none-match"), etag):
+        context.send_initial_metadata(metadata + [(NOT_MODIFIED_HEADER, "1")])
+        return httpbody_pb2.HttpBody(content_type=content_type)
+    context.send_initial_metadata(metadata)
+    return httpbody_pb2.HttpBody(content_type=content_type, data=data)
+
+
+def _geojson_snapshot_response(context, snapshot):
+    headers = dict(context.invocation_metadata())
+    if _accepts_gzip(headers.get("accept-encoding")):
+        return _cacheable_http_body(
+            context,
+            "application/json",
+            snapshot.gzipped,
+            snapshot.gzipped_etag,
+            None,
+            [("content-encoding", "gzip"), ("vary", "accept-encoding")],
+        )
+    return _cacheable_http_body(
+        context,
+        "application/json",
+        snapshot.data,
+        snapshot.etag,
+        None,
+        [("vary", "accept-encoding")],
     )
 
 
+def _tile_response(context, layer, request):
+    if not is_valid_tile(request.z, request.x, request.y):
+        context.abort(grpc.StatusCode.INVALID_ARGUMENT, errors.INVALID_TILE)
+    with session_scope() as session:
+        hidden_user_ids = get_hidden_user_ids(session, context.user_id) if layer == "users" else frozenset()
+        tile = get_tile(session, layer, request.z, request.x, request.y, hidden_user_ids)
+    return _cacheable_http_body(context, MVT_CONTENT_TYPE, tile.data, tile.etag, TILE_CACHE_TTL)
+
+
 class GIS(gis_pb2_grpc.GISServicer):
     def GetUsers(self, request, context):
         with session_scope() as session:
@@ -44,43 +136,27 @@ class GIS(gis_pb2_grpc.GISServicer):
 
     def GetCommunities(self, request, context):
         with session_scope() as session:
-            statement = select(Node).where(Node.geom != None)
-
-            return _statement_to_geojson_response(session, statement)
+            snapshot = geojson_snapshots.get(session, "communities", _build_communities_geojson)
+        return _geojson_snapshot_response(context, snapshot)
 
     def GetPlaces(self, request, context):
         with session_scope() as session:
-            # need to do a subquery here so we get pages without a geom, not just versions without geom
-            latest_pages = (
-                select(func.max(PageVersion.id).label("id"))
-                .join(Page, Page.id == PageVersion.page_id)
-                .where(Page.type == PageType.place)
-                .group_by(PageVersion.page_id)
-                .subquery()
-            )
-
-            statement = (
-                select(PageVersion.page_id.label("id"), PageVersion.slug.label("slug"), PageVersion.geom)
-                .join(latest_pages, latest_pages.c.id == PageVersion.id)
-                .where(PageVersion.geom != None)
-            )
-
-            return _statement_to_geojson_response(session, statement)
+            snapshot = geojson_snapshots.get(session, "places", _build_places_geojson)
+        return _geojson_snapshot_response(context, snapshot)
 
     def GetGuides(self, request, context):
         with session_scope() as session:
-            latest_pages = (
-                select(func.max(PageVersion.id).label("id"))
-                .join(Page, Page.id == PageVersion.page_id)
-                .where(Page.type == PageType.guide)
-                .group_by(PageVersion.page_id)
-                .subquery()
-            )
-
-            statement = (
-                select(PageVersion.page_id.label("id"), PageVersion.slug.label("slug"), PageVersion.geom)
-                .join(latest_pages, latest_pages.c.id == PageVersion.id)
-                .where(PageVersion.geom != None)
-            )
+            snapshot = geojson_snapshots.get(session, "guides", _build_guides_geojson)
+        return _geojson_snapshot_response(context, snapshot)
 
-            return _statement_to_geojson_response(session, statement)
+    def GetUserTile(self, request, context):
+        return _tile_response(context, "users", request)
+
+    def GetCommunityTile(self, request, context):
+        return _tile_response(context, "communities", request)
+
+    def GetPlaceTile(self, request, context):
+        return _tile_response(context, "places", request)
+
+    def GetGuideTile(self, request, context):
+        return _tile_response(context, "guides", request)
@@ -3,6 +3,7 @@ import logging
 import grpc
 
 from couchers import errors
+from couchers.auth_cache import invalidate_user_auth_on_commit
 from couchers.constants import GUIDELINES_VERSION, TOS_VERSION
 from couchers.db import session_scope
 from couchers.models import ModNote, User
@@ -60,6 +61,7 @@ class Jail(jail_pb2_grpc.JailServicer):
                 context.abort(grpc.StatusCode.FAILED_PRECONDITION, errors.CANT_UNACCEPT_TOS)
 
             user.accepted_tos = TOS_VERSION
+            invalidate_user_auth_on_commit(session, user.id)
             session.commit()
 
             return _get_jail_info(session, user)
@@ -74,6 +76,7 @@ class Jail(jail_pb2_grpc.JailServicer):
             user.city = request.city
             user.geom = create_coordinate(request.lat, request.lng)
             user.geom_radius = request.radius
+            invalidate_user_auth_on_commit(session, user.id)
 
             session.commit()
 
@@ -87,6 +90,7 @@ class Jail(jail_pb2_grpc.JailServicer):
                 context.abort(grpc.StatusCode.FAILED_PRECONDITION, errors.CANT_UNACCEPT_COMMUNITY_GUIDELINES)
 
             user.accepted_community_guidelines = GUIDELINES_VERSION
+            invalidate_user_auth_on_commit(session, user.id)
             session.commit()
 
             return _get_jail_info(session, user)
@@ -109,6 +113,7 @@ class Jail(jail_pb2_grpc.JailServicer):
                 context.abort(grpc.StatusCode.FAILED_PRECONDITION, errors.MOD_NOTE_NEED_TO_ACKNOWELDGE)
 
             note.acknowledged = now()
+            invalidate_user_auth_on_commit(session, user.id)
             session.flush()
 
             return _get_jail_info(session, user)
@@ -4,8 +4,7 @@ from datetime import timedelta
 import grpc
 from google.protobuf import empty_pb2
 from sqlalchemy import Float
-from sqlalchemy.orm import aliased
-from sqlalchemy.sql import and_, func, or_
+from sqlalchemy.sql import func, or_
 from sqlalchemy.sql.functions import percentile_disc
 
 from couchers import errors
@@ -18,6 +17,7 @@ from couchers.metrics import (
     sent_messages_counter,
 )
 from couchers.models import Conversation, HostRequest, HostRequestStatus, Message, MessageType, User
+from couchers.notifications.missed_messages import queue_missed_messages_check
 from couchers.notifications.notify import notify
 from couchers.servicers.api import user_model_to_pb
 from couchers.sql import couchers_select as select
@@ -210,6 +210,7 @@ class Requests(requests_pb2_grpc.RequestsServicer):
                     text=request.text,
                 ),
             )
+            queue_missed_messages_check(session, "send_request_notifications", host_request.host_user_id, now())
 
             user = session.execute(select(User).where(User.id == context.user_id)).scalar_one()
             host_requests_sent_counter.labels(user.gender, host.gender).inc()
@@ -243,21 +244,15 @@ class Requests(requests_pb2_grpc.RequestsServicer):
             pagination = request.number if request.number > 0 else DEFAULT_PAGINATION_LENGTH
             pagination = min(pagination, MAX_PAGE_SIZE)
 
-            # By outer joining messages on itself where the second id is bigger, only the highest IDs will have
-            # none as message_2.id. So just filter for these ones to get highest messages only.
-            # See https://stackoverflow.com/a/27802817/6115336
-            message_2 = aliased(Message)
+            # host requests are ordered by their latest message, which is kept on the conversation
             statement = (
                 select(Message, HostRequest, Conversation)
-                .outerjoin(
-                    message_2, and_(Message.conversation_id == message_2.conversation_id, Message.id < message_2.id)
-                )
-                .join(HostRequest, HostRequest.conversation_id == Message.conversation_id)
+                .select_from(HostRequest)
                 .join(Conversation, Conversation.id == HostRequest.conversation_id)
+                .join(Message, Message.id == Conversation.latest_message_id)
                 .where_users_column_visible(context, HostRequest.surfer_user_id)
                 .where_users_column_visible(context, HostRequest.host_user_id)
-                .where(message_2.id == None)
-                .where(or_(Message.id < request.last_request_id, request.last_request_id == 0))
+                .where(or_(Conversation.latest_message_id < request.last_request_id, request.last_request_id == 0))
             )
 
             if request.only_sent:
@@ -282,7 +277,7 @@ class Requests(requests_pb2_grpc.RequestsServicer):
                 )
                 statement = statement.where(HostRequest.end_time <= func.now())
 
-            statement = statement.order_by(Message.id.desc()).limit(pagination + 1)
+            statement = statement.order_by(Conversation.latest_message_id.desc()).limit(pagination + 1)
             results = session.execute(statement).all()
 
             host_requests = [
@@ -471,6 +466,14 @@ class Requests(requests_pb2_grpc.RequestsServicer):
                 host_request.surfer_last_seen_message_id = latest_message.id
             else:
                 host_request.host_last_seen_message_id = latest_message.id
+
+            if request.text:
+                other_user_id = (
+                    host_request.host_user_id
+                    if host_request.surfer_user_id == context.user_id
+                    else host_request.surfer_user_id
+                )
+                queue_missed_messages_check(session, "send_request_notifications", other_user_id, now())
             session.commit()
 
             return empty_pb2.Empty()
@@ -558,6 +561,7 @@ class Requests(requests_pb2_grpc.RequestsServicer):
                         am_host=True,
                     ),
                 )
+                queue_missed_messages_check(session, "send_request_notifications", host_request.host_user_id, now())
 
             else:
                 host_request.host_last_seen_message_id = message.id
@@ -574,6 +578,7 @@ class Requests(requests_pb2_grpc.RequestsServicer):
                         am_host=False,
                     ),
                 )
+                queue_missed_messages_check(session, "send_request_notifications", host_request.surfer_user_id, now())
 
             session.commit()
 
@@ -2,12 +2,19 @@
 See //docs/search.md for overview.
 """
 
+import logging
+from concurrent.futures import CancelledError, ThreadPoolExecutor, wait
 from datetime import timedelta
+from time import monotonic
 
 import grpc
-from sqlalchemy.sql import and_, func, or_
+from psycopg2.errors import QueryCanceled
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.sql import and_, func, or_, union
 
 from couchers import errors
+from couchers.constants import SEARCH_THREADS
 from couchers.crypto import decrypt_page_token, encrypt_page_token
 from couchers.db import session_scope
 from couchers.models import (
@@ -22,8 +29,8 @@ from couchers.models import (
     Page,
     PageType,
     PageVersion,
-    Reference,
     User,
+    UserRecommendationScore,
 )
 from couchers.servicers.account import has_strong_verification
 from couchers.servicers.api import (
@@ -32,7 +39,7 @@ from couchers.servicers.api import (
     parkingdetails2sql,
     sleepingarrangement2sql,
     smokinglocation2sql,
-    user_model_to_pb,
+    users_to_pb,
 )
 from couchers.servicers.communities import community_to_pb
 from couchers.servicers.events import event_to_pb
@@ -49,9 +56,15 @@ from couchers.utils import (
 )
 from proto import search_pb2, search_pb2_grpc
 
+logger = logging.getLogger(__name__)
+
 # searches are a bit expensive, we'd rather send back a bunch of results at once than lots of small pages
 MAX_PAGINATION_LENGTH = 50
 
+# Search returns whatever it has found by then, and cancels the rest
+SEARCH_TIMEOUT = timedelta(seconds=5)
+
+# the stored search_tsv columns are built with this config, see couchers.models._search_tsvector
 REGCONFIG = "english"
 TRI_SIMILARITY_THRESHOLD = 0.6
 TRI_SIMILARITY_WEIGHT = 5
@@ -67,29 +80,6 @@ def _join_with_space(coalesces):
     return out
 
 
-def _build_tsv(A, B=None, C=None, D=None):
-    """
-    Given lists for A, B, C, and D, builds a tsvector from them.
-    """
-    B = B or []
-    C = C or []
-    D = D or []
-    tsv = func.setweight(func.to_tsvector(REGCONFIG, _join_with_space([func.coalesce(bit, "") for bit in A])), "A")
-    if B:
-        tsv = tsv.concat(
-            func.setweight(func.to_tsvector(REGCONFIG, _join_with_space([func.coalesce(bit, "") for bit in B])), "B")
-        )
-    if C:
-        tsv = tsv.concat(
-            func.setweight(func.to_tsvector(REGCONFIG, _join_with_space([func.coalesce(bit, "") for bit in C])), "C")
-        )
-    if D:
-        tsv = tsv.concat(
-            func.setweight(func.to_tsvector(REGCONFIG, _join_with_space([func.coalesce(bit, "") for bit in D])), "D")
-        )
-    return tsv
-
-
 def _build_doc(A, B=None, C=None, D=None):
     """
     Builds the raw document (without to_tsvector and weighting), used for extracting snippet
@@ -107,19 +97,33 @@ def _build_doc(A, B=None, C=None, D=None):
     return doc
 
 
-def _similarity(statement, text):
-    return func.word_similarity(func.unaccent(statement), func.unaccent(text))
+def _similarity(statement, title):
+    return func.word_similarity(func.immutable_unaccent(statement), func.immutable_unaccent(title))
 
 
-def _gen_search_elements(statement, title_only, next_rank, page_size, A, B=None, C=None, D=None):
+def _is_similar(statement, title):
+    """
+    Same as _similarity(statement, title) >= pg_trgm.word_similarity_threshold, but can use the trigram index on the title
     """
-    Given an sql statement and four sets of fields, (A, B, C, D), generates a bunch of postgres expressions for full text search.
+    return func.immutable_unaccent(statement).op("<%")(func.immutable_unaccent(title))
+
+
+def _set_similarity_threshold(session):
+    # makes sure _is_similar doesn't filter out anything that passes TRI_SIMILARITY_THRESHOLD, only lasts for the
+    # current transaction
+    session.execute(select(func.set_config("pg_trgm.word_similarity_threshold", str(TRI_SIMILARITY_THRESHOLD), True)))
+
 
-    The four sets are in decreasing order of "importance" for ranking.
+def _gen_search_elements(statement, title_only, next_rank, page_size, title, tsv, A, B=None, C=None, D=None):
+    """
+    Given an sql statement, the title expression, the stored tsvector, and four sets of fields, (A, B, C, D), generates a
+    bunch of postgres expressions for full text search.
 
-    A should be the "title", the others can be anything.
+    The title must be an expression with a trigram index (see couchers.models._trigram_index) and tsv should be the
+    search_tsv column(s) of the searched tables, which are built from the same fields as A, B, C, and D. Those are in
+    decreasing order of "importance" for ranking, and are only used to generate the snippet.
 
-    If title_only=True, we only perform a trigram search against A only
+    If title_only=True, we only perform a trigram search against the title
     """
     B = B or []
     C = C or []
@@ -128,14 +132,9 @@ def _gen_search_elements(statement, title_only, next_rank, page_size, A, B=None,
         # a postgres tsquery object that can be used to match against a tsvector
         tsq = func.websearch_to_tsquery(REGCONFIG, statement)
 
-        # the tsvector object that we want to search against with our tsquery
-        tsv = _build_tsv(A, B, C, D)
-
         # document to generate snippet from
         doc = _build_doc(A, B, C, D)
 
-        title = _build_doc(A)
-
         # trigram based text similarity between title and sql statement string
         sim = _similarity(statement, title)
 
@@ -149,16 +148,17 @@ def _gen_search_elements(statement, title_only, next_rank, page_size, A, B=None,
             """
             Does the right search filtering, limiting, and ordering for the initial statement
             """
+            _set_similarity_threshold(session)
             return session.execute(
-                orig_statement.where(or_(tsv.op("@@")(tsq), sim > TRI_SIMILARITY_THRESHOLD))
+                orig_statement.where(
+                    or_(tsv.op("@@")(tsq), and_(_is_similar(statement, title), sim > TRI_SIMILARITY_THRESHOLD))
+                )
                 .where(rank <= next_rank if next_rank is not None else True)
                 .order_by(rank.desc())
                 .limit(page_size + 1)
             ).all()
 
     else:
-        title = _build_doc(A)
-
         # trigram based text similarity between title and sql statement string
         sim = _similarity(statement, title)
 
@@ -176,8 +176,10 @@ def _gen_search_elements(statement, title_only, next_rank, page_size, A, B=None,
             """
             Does the right search filtering, limiting, and ordering for the initial statement
             """
+            _set_similarity_threshold(session)
             return session.execute(
-                orig_statement.where(sim > TRI_SIMILARITY_THRESHOLD)
+                orig_statement.where(_is_similar(statement, title))
+                .where(sim > TRI_SIMILARITY_THRESHOLD)
                 .where(rank <= next_rank if next_rank is not None else True)
                 .order_by(rank.desc())
                 .limit(page_size + 1)
@@ -194,6 +196,8 @@ def _search_users(session, search_statement, title_only, next_rank, page_size, c
         title_only,
         next_rank,
         page_size,
+        User.username + " " + User.name,
+        User.search_tsv,
         [User.username, User.name],
         [User.city],
         [User.about_me],
@@ -201,14 +205,15 @@ def _search_users(session, search_statement, title_only, next_rank, page_size, c
     )
 
     users = execute_search_statement(session, select(User, rank, snippet).where_users_visible(context))
+    user_pbs = users_to_pb(session, [user for user, _, _ in users], context)
 
     return [
         search_pb2.Result(
             rank=rank,
-            user=user_model_to_pb(page, session, context),
+            user=user_pb,
             snippet=snippet,
         )
-        for page, rank, snippet in users
+        for (_, rank, snippet), user_pb in zip(users, user_pbs)
     ]
 
 
@@ -218,6 +223,8 @@ def _search_pages(session, search_statement, title_only, next_rank, page_size, c
         title_only,
         next_rank,
         page_size,
+        PageVersion.title,
+        PageVersion.search_tsv,
         [PageVersion.title],
         [PageVersion.address],
         [],
@@ -263,6 +270,8 @@ def _search_events(session, search_statement, title_only, next_rank, page_size,
         title_only,
         next_rank,
         page_size,
+        Event.title,
+        Event.search_tsv.concat(EventOccurrence.search_tsv),
         [Event.title],
         [EventOccurrence.address, EventOccurrence.link],
         [],
@@ -297,6 +306,11 @@ def _search_clusters(
         title_only,
         next_rank,
         page_size,
+        Cluster.name,
+        # the main page's title and address are weighted B here rather than A and B as when searching pages
+        Cluster.search_tsv.concat(func.setweight(func.ts_filter(PageVersion.search_tsv, "{a,b}"), "B")).concat(
+            func.ts_filter(PageVersion.search_tsv, "{d}")
+        ),
         [Cluster.name],
         [PageVersion.address, PageVersion.title],
         [Cluster.description],
@@ -336,56 +350,82 @@ def _search_clusters(
     ]
 
 
+_search_executor = ThreadPoolExecutor(SEARCH_THREADS, thread_name_prefix="search")
+
+
+def _run_sub_search(deadline, search, *args):
+    """
+    Runs one of the _search_* functions in its own session, the database cancels its queries if they run past deadline,
+    and no more are started once it's passed
+    """
+
+    def remaining_ms():
+        # a statement_timeout of 0 would disable the timeout altogether
+        timeout_ms = int((deadline - monotonic()) * 1000)
+        if timeout_ms < 1:
+            raise TimeoutError("Search deadline passed")
+        return timeout_ms
+
+    def set_statement_timeout(conn, cursor, statement, parameters, context, executemany):
+        # statement_timeout is per statement, so it's set again to what's left of the deadline before each one
+        cursor.execute("SET LOCAL statement_timeout = %s", (remaining_ms(),))
+
+    remaining_ms()
+    with session_scope() as session:
+        connection = session.connection()
+        event.listen(connection, "before_cursor_execute", set_statement_timeout)
+        try:
+            return search(session, *args)
+        finally:
+            event.remove(connection, "before_cursor_execute", set_statement_timeout)
+
+
 class Search(search_pb2_grpc.SearchServicer):
     def Search(self, request, context):
         page_size = min(MAX_PAGINATION_LENGTH, request.page_size or MAX_PAGINATION_LENGTH)
         # this is not an ideal page token, some results have equal rank (unlikely)
         next_rank = float(request.page_token) if request.page_token else None
-        with session_scope() as session:
-            all_results = (
-                _search_users(
-                    session,
-                    request.query,
-                    request.title_only,
-                    next_rank,
-                    page_size,
-                    context,
-                    request.include_users,
-                )
-                + _search_pages(
-                    session,
-                    request.query,
-                    request.title_only,
-                    next_rank,
-                    page_size,
-                    context,
-                    request.include_places,
-                    request.include_guides,
-                )
-                + _search_events(
-                    session,
-                    request.query,
-                    request.title_only,
-                    next_rank,
-                    page_size,
-                    context,
-                )
-                + _search_clusters(
-                    session,
-                    request.query,
-                    request.title_only,
-                    next_rank,
-                    page_size,
-                    context,
-                    request.include_communities,
-                    request.include_groups,
-                )
-            )
-            all_results.sort(key=lambda result: result.rank, reverse=True)
-            return search_pb2.SearchRes(
-                results=all_results[:page_size],
-                next_page_token=str(all_results[page_size].rank) if len(all_results) > page_size else None,
-            )
+        deadline = monotonic() + SEARCH_TIMEOUT.total_seconds()
+        args = (request.query, request.title_only, next_rank, page_size, context)
+        # each kind of result is searched for in parallel, in its own session
+        futures = [
+            _search_executor.submit(_run_sub_search, deadline, _search_users, *args, request.include_users),
+            _search_executor.submit(
+                _run_sub_search, deadline, _search_pages, *args, request.include_places, request.include_guides
+            ),
+            _search_executor.submit(_run_sub_search, deadline, _search_events, *args),
+            _search_executor.submit(
+                _run_sub_search,
+                deadline,
+                _search_clusters,
+                *args,
+                request.include_communities,
+                request.include_groups,
+            ),
+        ]
+        wait(futures, timeout=max(deadline - monotonic(), 0))
+
+        all_results = []
+        partial_results = False
+        for future in futures:
+            try:
+                all_results += future.result(timeout=0)
+            except (TimeoutError, CancelledError) as e:
+                future.cancel()
+                logger.warning(f"Sub-search timed out: {e!r}")
+                partial_results = True
+            except OperationalError as e:
+                if not isinstance(e.orig, QueryCanceled):
+                    raise
+                logger.warning(f"Sub-search cancelled: {e!r}")
+                partial_results = True
+
+        all_results.sort(key=lambda result: result.rank, reverse=True)
+        return search_pb2.SearchRes(
+            results=all_results[:page_size],
+            next_page_token=str(all_results[page_size].rank) if len(all_results) > page_size else None,
+            partial_results=partial_results,
+        )
 
     def UserSearch(self, request, context):
         with session_scope() as session:
@@ -515,7 +555,11 @@ class Search(search_pb2_grpc.SearchServicer):
                 statement = statement.where(func.ST_Contains(node.geom, User.geom))
 
             if request.only_with_references:
-                statement = statement.join(Reference, Reference.to_user_id == User.id)
+                statement = statement.where(
+                    User.id.in_(
+                        select(UserRecommendationScore.user_id).where(UserRecommendationScore.reference_count > 0)
+                    )
+                )
 
             # TODO:
             # google.protobuf.StringValue language = 11;
@@ -537,9 +581,9 @@ class Search(search_pb2_grpc.SearchServicer):
                 results=[
                     search_pb2.Result(
                         rank=1,
-                        user=user_model_to_pb(user, session, context),
+                        user=user_pb,
                     )
-                    for user in users[:page_size]
+                    for user_pb in users_to_pb(session, users[:page_size], context)
                 ],
                 next_page_token=(
                     encrypt_page_token(str(users[-1].recommendation_score)) if len(users) > page_size else None
@@ -558,13 +602,20 @@ class Search(search_pb2_grpc.SearchServicer):
                 if request.query_title_only:
                     statement = statement.where(Event.title.ilike(f"%{request.query.value}%"))
                 else:
-                    statement = statement.where(
-                        or_(
-                            Event.title.ilike(f"%{request.query.value}%"),
-                            EventOccurrence.content.ilike(f"%{request.query.value}%"),
-                            EventOccurrence.address.ilike(f"%{request.query.value}%"),
-                        )
+                    # matched separately per table so each side can use its trigram indexes, which can't be done for
+                    # an or across the join
+                    matching_occurrence_ids = union(
+                        select(EventOccurrence.id)
+                        .join(Event, Event.id == EventOccurrence.event_id)
+                        .where(Event.title.ilike(f"%{request.query.value}%")),
+                        select(EventOccurrence.id).where(
+                            or_(
+                                EventOccurrence.content.ilike(f"%{request.query.value}%"),
+                                EventOccurrence.address.ilike(f"%{request.query.value}%"),
+                            )
+                        ),
                     )
+                    statement = statement.where(EventOccurrence.id.in_(matching_occurrence_ids))
 
             if request.only_online:
                 statement = statement.where(EventOccurrence.geom == None)
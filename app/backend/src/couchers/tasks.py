@@ -1,6 +1,7 @@
 import logging
 
-from sqlalchemy.sql import func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql import func, literal
 
 from couchers import email, urls
 from couchers.config import config
@@ -134,33 +135,43 @@ def send_account_deletion_report_email(session, reason):
     )
 
 
-def enforce_community_memberships():
+def _add_community_memberships(session, statement):
     """
-    Go through all communities and make sure every user in the polygon is also a member
+    Subscribes the (user id, node id) pairs selected by statement to the official cluster of the node, skipping users
+    who are already members. Returns the number of memberships added.
     """
+    pairs = statement.subquery()
+    return session.execute(
+        insert(ClusterSubscription)
+        .from_select(
+            ["user_id", "cluster_id", "role"],
+            select(pairs.c.user_id, Cluster.id, literal(ClusterRole.member, ClusterSubscription.role.type))
+            .join(Cluster, Cluster.parent_node_id == pairs.c.node_id)
+            .where(Cluster.is_official_cluster),
+        )
+        .on_conflict_do_nothing(index_elements=["user_id", "cluster_id"])
+    ).rowcount
+
+
+def enforce_community_memberships(since=None):
+    """
+    Make sure every user in the polygon of a community is also a member
+
+    With since, only looks at users whose location was set and communities created at or after that time, otherwise
+    goes through everyone. Both are one INSERT ... SELECT each, so nothing is loaded into python.
+    """
+    users_in_nodes = (
+        select(User.id.label("user_id"), Node.id.label("node_id"))
+        .join(Node, func.ST_Contains(Node.geom, User.geom))
+        .where(User.is_visible)
+    )
     with session_scope() as session:
-        for node in session.execute(select(Node)).scalars().all():
-            existing_users = select(ClusterSubscription.user_id).where(
-                ClusterSubscription.cluster == node.official_cluster
-            )
-            users_needing_adding = (
-                session.execute(
-                    select(User)
-                    .where(User.is_visible)
-                    .where(func.ST_Contains(node.geom, User.geom))
-                    .where(~User.id.in_(existing_users))
-                )
-                .scalars()
-                .all()
-            )
-            for user in users_needing_adding:
-                node.official_cluster.cluster_subscriptions.append(
-                    ClusterSubscription(
-                        user=user,
-                        role=ClusterRole.member,
-                    )
-                )
-            session.commit()
+        if since is None:
+            added = _add_community_memberships(session, users_in_nodes)
+        else:
+            added = _add_community_memberships(session, users_in_nodes.where(User.geom_updated >= since))
+            added += _add_community_memberships(session, users_in_nodes.where(Node.created >= since))
+    logger.info(f"Added {added} community memberships")
 
 
 def enforce_community_memberships_for_user(session, user):
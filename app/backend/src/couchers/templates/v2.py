@@ -6,6 +6,7 @@ import logging
 from datetime import date
 from html import escape
 from pathlib import Path
+from threading import Lock
 from zoneinfo import ZoneInfo
 
 import phonenumbers
@@ -89,6 +90,45 @@ def add_filters(env):
 
 add_filters(env)
 
+# template_name -> (plain template, html template)
+_email_templates = {}
+_email_templates_lock = Lock()
+
+
+def _load_email_templates(template_name):
+    # the unsubscribe section goes at the end of the plain text and in place of ___UNSUB_SECTION___ in the html
+    plain_tmplt = (template_folder / f"{template_name}.txt").read_text()
+    html_tmplt = (template_folder / "generated_html" / f"{template_name}.html").read_text()
+    return (
+        env.from_string(plain_tmplt + "{{ _plain_unsub_section }}"),
+        env.from_string(html_tmplt.replace("___UNSUB_SECTION___", "{{ _html_unsub_section }}")),
+    )
+
+
+def get_email_templates(template_name):
+    """
+    Gets the compiled (plain, html) templates for an email, they are parsed once and cached unless
+    EMAIL_TEMPLATE_AUTO_RELOAD is set for editing templates in development
+    """
+    if config["EMAIL_TEMPLATE_AUTO_RELOAD"]:
+        return _load_email_templates(template_name)
+    with _email_templates_lock:
+        if template_name not in _email_templates:
+            _email_templates[template_name] = _load_email_templates(template_name)
+        return _email_templates[template_name]
+
+
+def render_email(template_name, template_args, plain_unsub_section, html_unsub_section):
+    """
+    Renders the plain and html versions of an email with the given unsubscribe sections
+    """
+    plain_template, html_template = get_email_templates(template_name)
+    unsub_args = {"_plain_unsub_section": plain_unsub_section, "_html_unsub_section": html_unsub_section}
+    return (
+        plain_template.render(template_args, **unsub_args),
+        html_template.render(template_args, **unsub_args),
+    )
+
 
 def send_simple_pretty_email(session, recipient, subject, template_name, template_args):
     """
@@ -102,10 +142,7 @@ def send_simple_pretty_email(session, recipient, subject, template_name, templat
     plain_unsub_section = "\n\n---\n\nThis is a security email, you cannot unsubscribe from it."
     html_unsub_section = "This is a security email, you cannot unsubscribe from it."
 
-    plain_tmplt = (template_folder / f"{template_name}.txt").read_text()
-    plain = env.from_string(plain_tmplt + plain_unsub_section).render(template_args)
-    html_tmplt = (template_folder / "generated_html" / f"{template_name}.html").read_text()
-    html = env.from_string(html_tmplt.replace("___UNSUB_SECTION___", html_unsub_section)).render(template_args)
+    plain, html = render_email(template_name, template_args, plain_unsub_section, html_unsub_section)
 
     queue_email(
         session,
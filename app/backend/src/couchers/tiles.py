@@ -0,0 +1,196 @@
+"""
+Mapbox vector tiles of users, communities, places and guides for the map
+
+Tiles are built by postgis with ST_AsMVT and kept in an in-process cache, so the map only ever fetches what's in view
+instead of one huge GeoJSON document. At low zoom levels points are clustered on a grid, so a tile of the whole world
+stays small.
+"""
+
+import hashlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import timedelta
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy.sql import func, union
+
+from couchers.models import Node, Page, PageType, PageVersion, User, UserBlock
+from couchers.sql import couchers_select as select
+
+MAX_TILE_ZOOM = 20
+
+# resolution of the tile geometry, the default for ST_AsMVT
+TILE_EXTENT = 4096
+
+# points are clustered at zoom levels below this
+TILE_CLUSTER_MAX_ZOOM = 10
+
+# points in the same cell of a grid of this many cells across the tile are clustered together
+TILE_CLUSTER_GRID = 64
+
+# width of the world in web mercator (EPSG:3857) meters
+WEB_MERCATOR_WIDTH = 40075016.68557849
+
+# how long a tile is served from the cache, bounds how long it takes for changes to show up on the map
+TILE_CACHE_TTL = timedelta(minutes=5)
+
+# the least recently used tiles are dropped after this many
+TILE_CACHE_MAX_TILES = 10_000
+
+
+@dataclass(frozen=True, kw_only=True)
+class Tile:
+    data: bytes
+    etag: str
+
+
+def make_etag(data):
+    return f'"{hashlib.sha1(data).hexdigest()}"'
+
+
+class TileCache:
+    """
+    An LRU cache of key -> Tile, where entries also expire after ttl
+    """
+
+    def __init__(self, ttl, max_tiles):
+        self._ttl = ttl.total_seconds()
+        self._max_tiles = max_tiles
+        self._lock = Lock()
+        # key -> (cached until, tile)
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry:
+                return None
+            cached_until, tile = entry
+            if cached_until < monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return tile
+
+    def put(self, key, tile):
+        with self._lock:
+            self._entries[key] = (monotonic() + self._ttl, tile)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_tiles:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+tile_cache = TileCache(TILE_CACHE_TTL, TILE_CACHE_MAX_TILES)
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= MAX_TILE_ZOOM and 0 <= x < 2**z and 0 <= y < 2**z
+
+
+def get_hidden_user_ids(session, user_id):
+    """
+    The users that user_id has blocked or been blocked by, these are left out of their user tiles
+    """
+    return frozenset(
+        session.execute(
+            union(
+                select(UserBlock.blocked_user_id).where(UserBlock.blocking_user_id == user_id),
+                select(UserBlock.blocking_user_id).where(UserBlock.blocked_user_id == user_id),
+            )
+        ).scalars()
+    )
+
+
+def latest_page_version_features(page_type):
+    """
+    The id, slug and geom of each page of the given type that has a location in its latest version
+    """
+    # need to do a subquery here so we get pages without a geom, not just versions without geom
+    latest_pages = (
+        select(func.max(PageVersion.id).label("id"))
+        .join(Page, Page.id == PageVersion.page_id)
+        .where(Page.type == page_type)
+        .group_by(PageVersion.page_id)
+        .subquery()
+    )
+    return (
+        select(PageVersion.page_id.label("id"), PageVersion.slug.label("slug"), PageVersion.geom.label("geom"))
+        .join(latest_pages, latest_pages.c.id == PageVersion.id)
+        .where(PageVersion.geom != None)
+    )
+
+
+def _users_layer(hidden_user_ids):
+    statement = select(User.id, User.username, User.geom.label("geom")).where(User.is_visible).where(User.geom != None)
+    if hidden_user_ids:
+        statement = statement.where(~User.id.in_(hidden_user_ids))
+    return statement, User.geom
+
+
+def _communities_layer(hidden_user_ids):
+    return select(Node.id, Node.parent_node_id, Node.geom.label("geom")), Node.geom
+
+
+def _places_layer(hidden_user_ids):
+    return latest_page_version_features(PageType.place), PageVersion.geom
+
+
+def _guides_layer(hidden_user_ids):
+    return latest_page_version_features(PageType.guide), PageVersion.geom
+
+
+# layer name -> (function giving the statement of features and the geom column to filter on, whether to cluster points)
+_LAYERS = {
+    "users": (_users_layer, True),
+    "communities": (_communities_layer, False),
+    "places": (_places_layer, True),
+    "guides": (_guides_layer, True),
+}
+
+
+def _build_tile(session, layer, z, x, y, hidden_user_ids):
+    get_layer, cluster_points = _LAYERS[layer]
+    statement, geom = get_layer(hidden_user_ids)
+
+    # the tile in web mercator, features are stored as EPSG:4326
+    envelope = func.ST_TileEnvelope(z, x, y)
+    in_tile = statement.where(geom.op("&&")(func.ST_Transform(envelope, 4326))).subquery()
+    mercator_geom = func.ST_Transform(in_tile.c.geom, 3857)
+
+    if cluster_points and z < TILE_CLUSTER_MAX_ZOOM:
+        cell_size = WEB_MERCATOR_WIDTH / 2**z / TILE_CLUSTER_GRID
+        features = select(
+            func.ST_AsMVTGeom(func.ST_Centroid(func.ST_Collect(mercator_geom)), envelope, TILE_EXTENT).label("geom"),
+            func.count().label("count"),
+        ).group_by(func.ST_SnapToGrid(mercator_geom, cell_size))
+    else:
+        features = select(
+            *[column for column in in_tile.c if column.name != "geom"],
+            func.ST_AsMVTGeom(mercator_geom, envelope, TILE_EXTENT).label("geom"),
+        )
+    features = features.subquery("features")
+
+    data = session.execute(
+        select(func.ST_AsMVT(features.table_valued(), layer, TILE_EXTENT, "geom")).select_from(features)
+    ).scalar_one()
+    return bytes(data or b"")
+
+
+def get_tile(session, layer, z, x, y, hidden_user_ids=frozenset()):
+    """
+    Gets a tile of the given layer, from the cache if possible
+
+    hidden_user_ids are left out of user tiles, everyone who has blocked nobody shares the same tiles
+    """
+    key = (layer, z, x, y, hidden_user_ids)
+    tile = tile_cache.get(key)
+    if not tile:
+        data = _build_tile(session, layer, z, x, y, hidden_user_ids)
+        tile = Tile(data=data, etag=make_etag(data))
+        tile_cache.put(key, tile)
+    return tile
@@ -0,0 +1,254 @@
+"""
+In-process cache of the unseen message, host request and friend request counts returned by API.Ping
+
+Ping is polled constantly but the counts only change when something is written, so they are computed once per user and
+served from memory until a write that could change them commits. Writes are picked up from the ORM flush: the process
+doing the write drops its cached counts on commit, and announces the affected users on UNREAD_COUNTS_NOTIFY_CHANNEL so
+other API processes can do the same.
+"""
+
+import logging
+from dataclasses import dataclass
+from datetime import timedelta
+from itertools import chain
+from threading import Lock
+from time import monotonic
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func, or_, union
+
+from couchers.db import start_notify_listener
+from couchers.models import (
+    Conversation,
+    FriendRelationship,
+    FriendStatus,
+    GroupChatSubscription,
+    HostRequest,
+    Message,
+    User,
+    UserBlock,
+)
+from couchers.sql import couchers_select as select
+
+logger = logging.getLogger(__name__)
+
+# writes that change someone's counts are announced on this channel, the payload is a comma separated list of user ids,
+# or "*" if everyone's counts may have changed
+UNREAD_COUNTS_NOTIFY_CHANNEL = "unread_counts"
+
+# how long counts are cached, bounds staleness if a change notification is missed
+UNREAD_COUNTS_CACHE_TTL = timedelta(minutes=5)
+
+# notification payloads are limited to 8000 bytes, this keeps a list of user ids well under that
+_NOTIFY_CHUNK_SIZE = 500
+
+_SESSION_INFO_KEY = "unread_counts_changes"
+
+
+@dataclass(frozen=True, kw_only=True)
+class UnreadCounts:
+    unseen_message_count: int
+    unseen_sent_host_request_count: int
+    unseen_received_host_request_count: int
+    pending_friend_request_count: int
+
+
+class UnreadCountsCache:
+    """
+    A TTL cache of user_id -> UnreadCounts
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl.total_seconds()
+        self._lock = Lock()
+        # user_id -> (cached until, counts)
+        self._entries = {}
+        # bumped on every invalidation, so counts computed before a change can't be cached after it
+        self._generation = 0
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if not entry:
+                return None
+            cached_until, counts = entry
+            if cached_until < monotonic():
+                del self._entries[user_id]
+                return None
+            return counts
+
+    def put(self, user_id, counts, generation):
+        with self._lock:
+            if generation == self._generation:
+                self._entries[user_id] = (monotonic() + self._ttl, counts)
+
+    def invalidate(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self._entries.pop(user_id, None)
+            self._generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+
+unread_counts_cache = UnreadCountsCache(UNREAD_COUNTS_CACHE_TTL)
+
+
+def compute_unread_counts(session, context):
+    """
+    Works out the counts from the database
+    """
+    # host requests whose latest message is newer than the last one seen
+    unseen_sent_host_request_count = session.execute(
+        select(func.count())
+        .select_from(HostRequest)
+        .join(Conversation, Conversation.id == HostRequest.conversation_id)
+        .where(HostRequest.surfer_user_id == context.user_id)
+        .where_users_column_visible(context, HostRequest.host_user_id)
+        .where(HostRequest.surfer_last_seen_message_id < Conversation.latest_message_id)
+    ).scalar_one()
+
+    unseen_received_host_request_count = session.execute(
+        select(func.count())
+        .select_from(HostRequest)
+        .join(Conversation, Conversation.id == HostRequest.conversation_id)
+        .where_users_column_visible(context, HostRequest.surfer_user_id)
+        .where(HostRequest.host_user_id == context.user_id)
+        .where(HostRequest.host_last_seen_message_id < Conversation.latest_message_id)
+    ).scalar_one()
+
+    unseen_message_count = session.execute(
+        select(func.count())
+        .select_from(Message)
+        .outerjoin(GroupChatSubscription, GroupChatSubscription.group_chat_id == Message.conversation_id)
+        .where(GroupChatSubscription.user_id == context.user_id)
+        .where(Message.time >= GroupChatSubscription.joined)
+        .where(or_(Message.time <= GroupChatSubscription.left, GroupChatSubscription.left == None))
+        .where(Message.id > GroupChatSubscription.last_seen_message_id)
+    ).scalar_one()
+
+    pending_friend_request_count = session.execute(
+        select(func.count())
+        .select_from(FriendRelationship)
+        .where(FriendRelationship.to_user_id == context.user_id)
+        .where_users_column_visible(context, FriendRelationship.from_user_id)
+        .where(FriendRelationship.status == FriendStatus.pending)
+    ).scalar_one()
+
+    return UnreadCounts(
+        unseen_message_count=unseen_message_count,
+        unseen_sent_host_request_count=unseen_sent_host_request_count,
+        unseen_received_host_request_count=unseen_received_host_request_count,
+        pending_friend_request_count=pending_friend_request_count,
+    )
+
+
+def get_unread_counts(session, context):
+    """
+    Gets the counts for context.user_id, from the cache if possible
+    """
+    counts = unread_counts_cache.get(context.user_id)
+    if counts is None:
+        generation = unread_counts_cache.generation
+        counts = compute_unread_counts(session, context)
+        unread_counts_cache.put(context.user_id, counts, generation)
+    return counts
+
+
+def _visibility_changed(user):
+    state = inspect(user)
+    return state.attrs.is_banned.history.has_changes() or state.attrs.is_deleted.history.has_changes()
+
+
+def _after_flush(session, flush_context):
+    """
+    Collects the users whose counts may change with what was just flushed, and announces them
+    """
+    user_ids = set()
+    conversation_ids = set()
+    everyone = False
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Message):
+            conversation_ids.add(obj.conversation_id)
+        elif isinstance(obj, GroupChatSubscription):
+            user_ids.add(obj.user_id)
+        elif isinstance(obj, HostRequest):
+            user_ids.update((obj.surfer_user_id, obj.host_user_id))
+        elif isinstance(obj, FriendRelationship):
+            user_ids.update((obj.from_user_id, obj.to_user_id))
+        elif isinstance(obj, UserBlock):
+            user_ids.update((obj.blocking_user_id, obj.blocked_user_id))
+        elif isinstance(obj, User) and obj in session.dirty and _visibility_changed(obj):
+            # a user being hidden or unhidden changes the counts of everyone they have talked to
+            everyone = True
+
+    if everyone:
+        session.execute(select(func.pg_notify(UNREAD_COUNTS_NOTIFY_CHANNEL, "*")))
+    else:
+        if conversation_ids:
+            user_ids.update(
+                session.execute(
+                    union(
+                        select(GroupChatSubscription.user_id).where(
+                            GroupChatSubscription.group_chat_id.in_(conversation_ids)
+                        ),
+                        select(HostRequest.surfer_user_id).where(HostRequest.conversation_id.in_(conversation_ids)),
+                        select(HostRequest.host_user_id).where(HostRequest.conversation_id.in_(conversation_ids)),
+                    )
+                ).scalars()
+            )
+        if not user_ids:
+            return
+        sorted_user_ids = sorted(user_ids)
+        for i in range(0, len(sorted_user_ids), _NOTIFY_CHUNK_SIZE):
+            payload = ",".join(str(user_id) for user_id in sorted_user_ids[i : i + _NOTIFY_CHUNK_SIZE])
+            session.execute(select(func.pg_notify(UNREAD_COUNTS_NOTIFY_CHANNEL, payload)))
+
+    changes = session.info.setdefault(_SESSION_INFO_KEY, [False, set()])
+    changes[0] |= everyone
+    changes[1] |= user_ids
+
+
+def _after_commit(session):
+    changes = session.info.pop(_SESSION_INFO_KEY, None)
+    if changes:
+        everyone, user_ids = changes
+        if everyone:
+            unread_counts_cache.clear()
+        else:
+            unread_counts_cache.invalidate(user_ids)
+
+
+def _after_rollback(session):
+    session.info.pop(_SESSION_INFO_KEY, None)
+
+
+event.listen(Session, "after_flush", _after_flush)
+event.listen(Session, "after_commit", _after_commit)
+event.listen(Session, "after_rollback", _after_rollback)
+
+
+def handle_unread_counts_notify(payload):
+    """
+    Called for each notification on UNREAD_COUNTS_NOTIFY_CHANNEL
+    """
+    if payload == "*":
+        unread_counts_cache.clear()
+    else:
+        unread_counts_cache.invalidate([int(user_id) for user_id in payload.split(",")])
+
+
+def start_unread_counts_listener():
+    """
+    Starts a daemon thread that drops cached counts when other processes announce changes
+    """
+    # anything cached before we started listening may have missed a change
+    return start_notify_listener(UNREAD_COUNTS_NOTIFY_CHANNEL, handle_unread_counts_notify, unread_counts_cache.clear)
@@ -17,3 +17,8 @@ SELECT regexp_replace(
   ), '^$', 'slug'
 );
 $$ LANGUAGE SQL STRICT IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION immutable_unaccent("text" TEXT)
+RETURNS TEXT AS $$
+SELECT public.unaccent('public.unaccent', "text");
+$$ LANGUAGE SQL STRICT IMMUTABLE PARALLEL SAFE;
@@ -1,4 +1,5 @@
 from datetime import timedelta
+from types import SimpleNamespace
 
 import grpc
 import pytest
@@ -9,11 +10,18 @@ from couchers.db import session_scope
 from couchers.jobs.handlers import update_badges
 from couchers.models import FriendRelationship, FriendStatus
 from couchers.sql import couchers_select as select
-from couchers.utils import create_coordinate, to_aware_datetime
-from proto import api_pb2, jail_pb2, notifications_pb2
+from couchers.unread_counts import (
+    UnreadCounts,
+    compute_unread_counts,
+    handle_unread_counts_notify,
+    unread_counts_cache,
+)
+from couchers.utils import create_coordinate, to_aware_datetime, today
+from proto import api_pb2, conversations_pb2, jail_pb2, notifications_pb2, requests_pb2
 from tests.test_fixtures import (  # noqa
     api_session,
     blocking_session,
+    conversations_session,
     db,
     email_fields,
     generate_user,
@@ -25,6 +33,7 @@ from tests.test_fixtures import (  # noqa
     push_collector,
     real_api_session,
     real_jail_session,
+    requests_session,
     testconfig,
 )
 
@@ -34,6 +43,111 @@ def _(testconfig):
     pass
 
 
+def test_ping_unread_counts_match_queries(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    user3, token3 = generate_user()
+    make_friends(user1, user2)
+    make_friends(user1, user3)
+
+    def check(users=((user1, token1), (user2, token2), (user3, token3))):
+        for user, token in users:
+            with api_session(token) as api:
+                # twice, the second one comes from the cache
+                res = [api.Ping(api_pb2.PingReq()) for _ in range(2)]
+            with session_scope() as session:
+                expected = compute_unread_counts(session, SimpleNamespace(user_id=user.id))
+            for ping in res:
+                assert (
+                    UnreadCounts(
+                        unseen_message_count=ping.unseen_message_count,
+                        unseen_sent_host_request_count=ping.unseen_sent_host_request_count,
+                        unseen_received_host_request_count=ping.unseen_received_host_request_count,
+                        pending_friend_request_count=ping.pending_friend_request_count,
+                    )
+                    == expected
+                )
+
+    check()
+
+    with api_session(token2) as api:
+        api.SendFriendRequest(api_pb2.SendFriendRequestReq(user_id=user3.id))
+    check()
+
+    with requests_session(token1) as api:
+        host_request_id = api.CreateHostRequest(
+            requests_pb2.CreateHostRequestReq(
+                host_user_id=user2.id,
+                from_date=(today() + timedelta(days=2)).isoformat(),
+                to_date=(today() + timedelta(days=3)).isoformat(),
+                text="Test request",
+            )
+        ).host_request_id
+    check()
+
+    with requests_session(token2) as api:
+        api.SendHostRequestMessage(requests_pb2.SendHostRequestMessageReq(host_request_id=host_request_id, text="Hi"))
+    check()
+
+    with conversations_session(token1) as c:
+        group_chat_id = c.CreateGroupChat(
+            conversations_pb2.CreateGroupChatReq(recipient_user_ids=[user2.id, user3.id])
+        ).group_chat_id
+        for i in range(3):
+            c.SendMessage(conversations_pb2.SendMessageReq(group_chat_id=group_chat_id, text=f"Message {i}"))
+    check()
+
+    with conversations_session(token3) as c:
+        res = c.GetGroupChatMessages(conversations_pb2.GetGroupChatMessagesReq(group_chat_id=group_chat_id))
+        c.MarkLastSeenGroupChat(
+            conversations_pb2.MarkLastSeenGroupChatReq(
+                group_chat_id=group_chat_id, last_seen_message_id=res.messages[1].message_id
+            )
+        )
+    check()
+
+    with conversations_session(token2) as c:
+        c.LeaveGroupChat(conversations_pb2.LeaveGroupChatReq(group_chat_id=group_chat_id))
+    with conversations_session(token1) as c:
+        c.SendMessage(conversations_pb2.SendMessageReq(group_chat_id=group_chat_id, text="After leaving"))
+    check()
+
+    make_user_block(user1, user2)
+    check()
+
+    # user3 can't log in any more
+    make_user_invisible(user3.id)
+    check(users=[(user1, token1), (user2, token2)])
+
+
+def test_unread_counts_notify():
+    counts = UnreadCounts(
+        unseen_message_count=1,
+        unseen_sent_host_request_count=2,
+        unseen_received_host_request_count=3,
+        pending_friend_request_count=4,
+    )
+    unread_counts_cache.clear()
+    for user_id in [1, 2, 3]:
+        unread_counts_cache.put(user_id, counts, unread_counts_cache.generation)
+    assert unread_counts_cache.get(1) == counts
+
+    # another process changed something
+    handle_unread_counts_notify("1,2")
+    assert unread_counts_cache.get(1) is None
+    assert unread_counts_cache.get(2) is None
+    assert unread_counts_cache.get(3) == counts
+
+    # counts computed before a change aren't cached after it
+    generation = unread_counts_cache.generation
+    handle_unread_counts_notify("1")
+    unread_counts_cache.put(1, counts, generation)
+    assert unread_counts_cache.get(1) is None
+
+    handle_unread_counts_notify("*")
+    assert unread_counts_cache.get(3) is None
+
+
 def test_ping(db):
     user, token = generate_user()
 
@@ -1,4 +1,7 @@
 from datetime import timedelta
+from sched import scheduler
+from time import monotonic, sleep
+from types import SimpleNamespace
 from unittest.mock import call, patch
 
 import pytest
@@ -12,7 +15,7 @@ from couchers.crypto import urlsafe_secure_token
 from couchers.db import session_scope
 from couchers.email import queue_email
 from couchers.email.dev import print_dev_email
-from couchers.jobs.enqueue import queue_job
+from couchers.jobs.enqueue import JOB_PRIORITIES, queue_job, queue_jobs, running_job_priority
 from couchers.jobs.handlers import (
     add_users_to_email_list,
     send_message_notifications,
@@ -21,24 +24,49 @@ from couchers.jobs.handlers import (
     send_request_notifications,
     update_badges,
     update_recommendation_scores,
+    update_stale_recommendation_scores,
+)
+from couchers.jobs.worker import (
+    JOB_BATCH_SIZE,
+    JOBS,
+    ClaimedJob,
+    JobTypeLimiter,
+    _finish_job,
+    _listen_for_jobs,
+    _parse_concurrency_limits,
+    _run_job_and_schedule,
+    _wait_for_jobs,
+    get_thread_job_types,
+    process_job,
+    process_job_batch,
+    run_scheduler,
+    service_jobs,
 )
-from couchers.jobs.worker import _run_job_and_schedule, process_job, run_scheduler, service_jobs
 from couchers.metrics import create_prometheus_server, job_process_registry
 from couchers.models import (
     AccountDeletionToken,
     BackgroundJob,
+    BackgroundJobPriority,
     BackgroundJobState,
     Email,
     LoginToken,
     PasswordResetToken,
+    StaleRecommendationScore,
+    User,
     UserBadge,
+    UserRecommendationScore,
 )
+from couchers.recommendation_scores import update_all_recommendation_scores
+from couchers.recommendation_scores import update_stale_recommendation_scores as rs_update_stale_recommendation_scores
 from couchers.sql import couchers_select as select
 from couchers.utils import now, today
-from proto import conversations_pb2, requests_pb2
+from proto import api_pb2, conversations_pb2, requests_pb2
+from proto.internal import jobs_pb2
 from tests.test_fixtures import (  # noqa
+    api_session,
     auth_api_session,
     conversations_session,
+    count_sql_statements,
     db,
     generate_user,
     make_friends,
@@ -270,17 +298,17 @@ def test_service_jobs(db):
     with session_scope() as session:
         queue_email(session, "sender_name", "sender_email", "recipient", "subject", "plain", "html")
 
-    # we create this HitSleep exception here, and mock out the normal sleep(1) in the infinite loop to instead raise
-    # this. that allows us to conveniently get out of the infinite loop and know we had no more jobs left
+    # we create this HitSleep exception here, and mock out the normal wait for new jobs in the infinite loop to
+    # instead raise this. that allows us to conveniently get out of the infinite loop and know we had no more jobs left
     class HitSleep(Exception):
         pass
 
-    # the mock `sleep` function that instead raises the aforementioned exception
-    def raising_sleep(seconds):
+    # the mock `_wait_for_jobs` function that instead raises the aforementioned exception
+    def raising_wait(dbapi_connection, timeout):
         raise HitSleep()
 
     with pytest.raises(HitSleep):
-        with patch("couchers.jobs.worker.sleep", raising_sleep):
+        with patch("couchers.jobs.worker._wait_for_jobs", raising_wait):
             service_jobs()
 
     with session_scope() as session:
@@ -302,10 +330,254 @@ def test_service_jobs(db):
         )
 
 
+def test_job_worker_config():
+    assert _parse_concurrency_limits("") == {}
+    assert _parse_concurrency_limits("send_raw_push_notification:2, send_email:4") == {
+        "send_raw_push_notification": 2,
+        "send_email": 4,
+    }
+
+    new_config = config.copy()
+    with patch("couchers.config.config", new_config):
+        new_config["JOB_WORKER_THREADS"] = 3
+        new_config["JOB_WORKER_QUEUES"] = ""
+        assert get_thread_job_types() == [None, None, None]
+        new_config["JOB_WORKER_QUEUES"] = "default:2, push:1,email:1"
+        default_job_types, default_job_types_again, push_job_types, email_job_types = get_thread_job_types()
+        assert default_job_types == default_job_types_again
+        assert "handle_notification" in default_job_types
+        assert "send_raw_push_notification" not in default_job_types
+        assert push_job_types == ["send_raw_push_notification", "send_raw_push_notifications"]
+        assert email_job_types == ["send_email"]
+        new_config["JOB_WORKER_QUEUES"] = "default:1,nonexistent:1"
+        with pytest.raises(ValueError):
+            get_thread_job_types()
+
+
+def test_job_batches_single_job_type(db):
+    with session_scope() as session:
+        for _ in range(2):
+            queue_job(session, "purge_login_tokens", empty_pb2.Empty())
+            queue_job(session, "purge_password_reset_tokens", empty_pb2.Empty())
+
+    def completed_job_types():
+        with session_scope() as session:
+            return (
+                session.execute(
+                    select(BackgroundJob.job_type).where(BackgroundJob.state == BackgroundJobState.completed)
+                )
+                .scalars()
+                .all()
+            )
+
+    # a batch is all of the most urgent job's type, even with room for the others
+    assert process_job_batch(JOB_BATCH_SIZE) == 2
+    [first_job_type, second_job_type] = completed_job_types()
+    assert first_job_type == second_job_type
+    assert process_job_batch(JOB_BATCH_SIZE) == 2
+    assert sorted(completed_job_types()) == ["purge_login_tokens"] * 2 + ["purge_password_reset_tokens"] * 2
+    assert process_job_batch(JOB_BATCH_SIZE) == 0
+
+
+def test_job_routing_and_limits(db):
+    with session_scope() as session:
+        queue_job(session, "purge_login_tokens", empty_pb2.Empty())
+        queue_job(session, "purge_password_reset_tokens", empty_pb2.Empty())
+        queue_job(session, "purge_account_deletion_tokens", empty_pb2.Empty())
+
+    # only the routed job types are picked up
+    assert process_job_batch(JOB_BATCH_SIZE, job_types=["purge_login_tokens"]) == 1
+    assert process_job_batch(JOB_BATCH_SIZE, job_types=["purge_login_tokens"]) == 0
+
+    limiter = JobTypeLimiter({"purge_password_reset_tokens": 1})
+
+    # another thread is running a purge_password_reset_tokens job, so it's at its limit
+    running = SimpleNamespace(job_type="purge_password_reset_tokens")
+    assert limiter.claim(lambda excluded: [running]) == [running]
+
+    assert process_job_batch(JOB_BATCH_SIZE, limiter=limiter) == 1
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(BackgroundJob.state).where(BackgroundJob.job_type == "purge_password_reset_tokens")
+            ).scalar_one()
+            == BackgroundJobState.pending
+        )
+
+    # and can be claimed again once released
+    limiter.release([running])
+    assert process_job_batch(JOB_BATCH_SIZE, limiter=limiter) == 1
+    assert process_job_batch(JOB_BATCH_SIZE, limiter=limiter) == 0
+
+
+def test_queue_job_wakes_worker(db):
+    with _listen_for_jobs() as dbapi_connection:
+        # nothing queued, so this times out
+        start = monotonic()
+        _wait_for_jobs(dbapi_connection, timedelta(seconds=0.2))
+        assert monotonic() - start >= 0.2
+
+        with session_scope() as session:
+            queue_job(session, "purge_login_tokens", empty_pb2.Empty())
+            queue_job(session, "purge_login_tokens", empty_pb2.Empty())
+
+        # woken straight away once the transaction commits
+        start = monotonic()
+        _wait_for_jobs(dbapi_connection, timedelta(seconds=30))
+        assert monotonic() - start < 10
+
+    assert process_job_batch(JOB_BATCH_SIZE) == 2
+    assert process_job_batch(JOB_BATCH_SIZE) == 0
+
+
+def test_queue_job_run_at_and_dedup_key(db):
+    with session_scope() as session:
+        job_id = queue_job(
+            session, "purge_login_tokens", empty_pb2.Empty(), run_at=now() + timedelta(minutes=5), dedup_key="a"
+        )
+        assert job_id
+        # coalesced into the job already waiting
+        assert not queue_job(session, "purge_login_tokens", empty_pb2.Empty(), dedup_key="a")
+        # different key or different job type are separate jobs
+        assert queue_job(session, "purge_login_tokens", empty_pb2.Empty(), dedup_key="b")
+        assert queue_job(session, "purge_password_reset_tokens", empty_pb2.Empty(), dedup_key="a")
+
+    # the delayed job isn't due yet
+    assert process_job()
+    assert process_job()
+    assert not process_job()
+
+    with session_scope() as session:
+        assert session.execute(select(BackgroundJob.state).where(BackgroundJob.id == job_id)).scalar_one() == (
+            BackgroundJobState.pending
+        )
+        session.execute(
+            select(BackgroundJob).where(BackgroundJob.id == job_id)
+        ).scalar_one().next_attempt_after = func.now()
+
+    assert process_job()
+
+    # once it has run, the key can be used again
+    with session_scope() as session:
+        assert queue_job(session, "purge_login_tokens", empty_pb2.Empty(), dedup_key="a")
+
+
+def test_queue_jobs_run_at_and_dedup_keys(db):
+    run_at = now() + timedelta(minutes=5)
+    with session_scope() as session:
+        queue_job(session, "purge_login_tokens", empty_pb2.Empty(), dedup_key="a")
+        # "a" is already waiting and the second "b" is a duplicate within the batch
+        queue_jobs(
+            session,
+            "purge_login_tokens",
+            [empty_pb2.Empty()] * 4,
+            run_at=run_at,
+            dedup_keys=["a", "b", "c", "b"],
+        )
+
+    with session_scope() as session:
+        jobs = session.execute(select(BackgroundJob.dedup_key, BackgroundJob.next_attempt_after)).all()
+        assert sorted(dedup_key for dedup_key, _ in jobs) == ["a", "b", "c"]
+        assert {next_attempt_after for dedup_key, next_attempt_after in jobs if dedup_key != "a"} == {run_at}
+
+
+def test_job_priorities(db):
+    # catches typos in the job types
+    assert set(JOB_PRIORITIES) <= set(JOBS)
+
+    with session_scope() as session:
+        # bulk, queued first
+        bulk_id = queue_job(session, "update_recommendation_scores", empty_pb2.Empty())
+        normal_id = queue_job(session, "purge_login_tokens", empty_pb2.Empty())
+        high_id = queue_job(session, "send_raw_push_notification", empty_pb2.Empty())
+        # queued by a bulk job, so bulk too
+        with running_job_priority(BackgroundJobPriority.bulk):
+            inherited_id = queue_job(session, "send_raw_push_notification", empty_pb2.Empty())
+
+    with session_scope() as session:
+        assert dict(session.execute(select(BackgroundJob.id, BackgroundJob.priority)).all()) == {
+            bulk_id: BackgroundJobPriority.bulk,
+            normal_id: BackgroundJobPriority.normal,
+            high_id: BackgroundJobPriority.high,
+            inherited_id: BackgroundJobPriority.bulk,
+        }
+
+    def mock_job(payload):
+        pass
+
+    mock_jobs = {
+        job_type: (empty_pb2.Empty, mock_job)
+        for job_type in ["update_recommendation_scores", "purge_login_tokens", "send_raw_push_notification"]
+    }
+
+    def completed_ids():
+        with session_scope() as session:
+            return set(
+                session.execute(
+                    select(BackgroundJob.id).where(BackgroundJob.state == BackgroundJobState.completed)
+                ).scalars()
+            )
+
+    # higher priority first, though they were all queued at the same time
+    with patch("couchers.jobs.worker.JOBS", mock_jobs):
+        assert process_job()
+        assert completed_ids() == {high_id}
+        assert process_job()
+        assert completed_ids() == {high_id, normal_id}
+        assert process_job()
+        assert process_job()
+        assert completed_ids() == {high_id, normal_id, bulk_id, inherited_id}
+        assert not process_job()
+
+
+def test_job_batch_claim_round_trips(db):
+    num_jobs = 200
+
+    MOCK_JOBS = {
+        "mock_job": (empty_pb2.Empty, lambda payload: None),
+    }
+
+    def claim_statements(statements):
+        return [
+            statement
+            for statement in statements
+            if statement.startswith("SELECT") and "FOR UPDATE SKIP LOCKED" in statement
+        ]
+
+    claims = {}
+    with patch("couchers.jobs.worker.JOBS", MOCK_JOBS):
+        for batch_size in [1, JOB_BATCH_SIZE]:
+            with session_scope() as session:
+                for _ in range(num_jobs):
+                    queue_job(session, "mock_job", empty_pb2.Empty())
+
+            processed = 0
+            with count_sql_statements() as statements:
+                while count := process_job_batch(batch_size):
+                    processed += count
+            assert processed == num_jobs
+            claims[batch_size] = len(claim_statements(statements))
+
+    # one claim per job, and one more that comes up empty
+    assert claims[1] == num_jobs + 1
+    # the first job of each batch, then the rest of the batch of the same type
+    assert claims[JOB_BATCH_SIZE] == 2 * num_jobs // JOB_BATCH_SIZE + 1
+
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(func.count())
+                .select_from(BackgroundJob)
+                .where(BackgroundJob.state == BackgroundJobState.completed)
+            ).scalar_one()
+            == 2 * num_jobs
+        )
+
+
 def test_scheduler(db, monkeypatch):
     MOCK_SCHEDULE = [
         ("purge_login_tokens", timedelta(seconds=7)),
-        ("send_message_notifications", timedelta(seconds=11)),
+        ("purge_password_reset_tokens", timedelta(seconds=11)),
     ]
 
     current_time = 0
@@ -336,6 +608,11 @@ def test_scheduler(db, monkeypatch):
     monkeypatch.setattr(couchers.jobs.worker, "monotonic", mock_monotonic)
     monkeypatch.setattr(couchers.jobs.worker, "sleep", mock_sleep)
 
+    def coalesced_count(job_type):
+        return job_process_registry.get_sample_value("couchers_scheduled_jobs_coalesced_total", {"job": job_type}) or 0
+
+    coalesced_before = [coalesced_count(job_type) for job_type, _ in MOCK_SCHEDULE]
+
     with pytest.raises(EndOfTime):
         run_scheduler()
 
@@ -360,12 +637,18 @@ def test_scheduler(db, monkeypatch):
         (70.0, 0),
     ]
 
+    # nothing processed the jobs, so each type was only queued once and the rest were coalesced into that job
+    assert [coalesced_count(job_type) - before for (job_type, _), before in zip(MOCK_SCHEDULE, coalesced_before)] == [
+        10,
+        6,
+    ]
+
     with session_scope() as session:
         assert (
             session.execute(
                 select(func.count()).select_from(BackgroundJob).where(BackgroundJob.state == BackgroundJobState.pending)
             ).scalar_one()
-            == 18
+            == 2
         )
         assert (
             session.execute(
@@ -375,6 +658,150 @@ def test_scheduler(db, monkeypatch):
         )
 
 
+def test_singleton_jobs(db, monkeypatch):
+    monkeypatch.setattr(couchers.jobs.worker, "SINGLETONS", {"purge_login_tokens"})
+    monkeypatch.setattr(couchers.jobs.worker, "SCHEDULE", [("purge_login_tokens", timedelta(minutes=5))])
+
+    def skipped_count():
+        return (
+            job_process_registry.get_sample_value(
+                "couchers_scheduled_jobs_skipped_total", {"job": "purge_login_tokens"}
+            )
+            or 0
+        )
+
+    with session_scope() as session:
+        running_id = queue_job(session, "purge_login_tokens", empty_pb2.Empty())
+        job_id = queue_job(session, "purge_login_tokens", empty_pb2.Empty())
+        # pretend another worker is running the first one
+        running = session.execute(select(BackgroundJob).where(BackgroundJob.id == running_id)).scalar_one()
+        running.try_count = 1
+        running.leased_until = now() + timedelta(minutes=5)
+
+    # the worker puts the job off without counting it as a try
+    assert not process_job()
+    with session_scope() as session:
+        job = session.execute(select(BackgroundJob).where(BackgroundJob.id == job_id)).scalar_one()
+        assert job.state == BackgroundJobState.pending
+        assert job.try_count == 0
+        assert job.leased_until is None
+        assert job.next_attempt_after > now()
+
+    # and the scheduler doesn't queue another one
+    skipped_before = skipped_count()
+    _run_job_and_schedule(scheduler(monotonic, sleep), 0)
+    assert skipped_count() == skipped_before + 1
+    with session_scope() as session:
+        assert session.execute(select(func.count()).select_from(BackgroundJob)).scalar_one() == 2
+
+    # once the other one is done, it runs
+    with session_scope() as session:
+        running = session.execute(select(BackgroundJob).where(BackgroundJob.id == running_id)).scalar_one()
+        running.state = BackgroundJobState.completed
+        running.leased_until = None
+        session.execute(
+            select(BackgroundJob).where(BackgroundJob.id == job_id)
+        ).scalar_one().next_attempt_after = func.now()
+    assert process_job()
+    with session_scope() as session:
+        assert (
+            session.execute(select(BackgroundJob.state).where(BackgroundJob.id == job_id)).scalar_one()
+            == BackgroundJobState.completed
+        )
+
+
+def test_job_leases(db):
+    with session_scope() as session:
+        job_id = queue_job(session, "purge_login_tokens", empty_pb2.Empty())
+
+    leases = []
+
+    def mock_job(payload):
+        # the claim is committed before the job runs, so it's visible to everyone else
+        with session_scope() as session:
+            job = session.execute(select(BackgroundJob).where(BackgroundJob.id == job_id)).scalar_one()
+            leases.append((job.state, job.try_count, job.leased_until))
+        # and no other worker picks it up
+        assert not process_job()
+
+    with patch("couchers.jobs.worker.JOBS", {"purge_login_tokens": (empty_pb2.Empty, mock_job)}):
+        assert process_job()
+
+    [(state, try_count, leased_until)] = leases
+    assert state == BackgroundJobState.pending
+    assert try_count == 1
+    assert leased_until > now()
+
+    with session_scope() as session:
+        job = session.execute(select(BackgroundJob).where(BackgroundJob.id == job_id)).scalar_one()
+        assert job.state == BackgroundJobState.completed
+        assert job.leased_until is None
+
+        # now pretend a worker claimed it and died
+        job.state = BackgroundJobState.pending
+        job.leased_until = now() - timedelta(seconds=1)
+        stale = ClaimedJob(
+            id=job.id,
+            job_type=job.job_type,
+            payload=job.payload,
+            priority=job.priority,
+            try_count=job.try_count,
+            max_tries=job.max_tries,
+        )
+
+    # the expired lease lets another worker claim it
+    with patch("couchers.jobs.worker.JOBS", {"purge_login_tokens": (empty_pb2.Empty, lambda payload: None)}):
+        assert process_job()
+
+    with session_scope() as session:
+        job = session.execute(select(BackgroundJob).where(BackgroundJob.id == job_id)).scalar_one()
+        assert job.state == BackgroundJobState.completed
+        assert job.try_count == 2
+        job.state = BackgroundJobState.pending
+
+    # and the worker that lost the lease can't record its outcome
+    _finish_job(stale, state=BackgroundJobState.failed)
+    with session_scope() as session:
+        assert (
+            session.execute(select(BackgroundJob.state).where(BackgroundJob.id == job_id)).scalar_one()
+            == BackgroundJobState.pending
+        )
+
+
+def test_job_abandoned_on_last_try(db, monkeypatch):
+    monkeypatch.setattr(couchers.jobs.worker, "SCHEDULE", [("purge_login_tokens", timedelta(minutes=5))])
+
+    _run_job_and_schedule(scheduler(monotonic, sleep), 0)
+
+    with session_scope() as session:
+        job = session.execute(select(BackgroundJob)).scalar_one()
+        job_id = job.id
+        # pretend a worker claimed it for its last try and died
+        job.try_count = job.max_tries
+        job.leased_until = now() - timedelta(seconds=1)
+
+    # out of tries so not claimed again, but marked as failed
+    assert not process_job()
+    with session_scope() as session:
+        job = session.execute(select(BackgroundJob).where(BackgroundJob.id == job_id)).scalar_one()
+        assert job.state == BackgroundJobState.failed
+        assert job.leased_until is None
+
+    # so the next scheduled run isn't coalesced into it
+    _run_job_and_schedule(scheduler(monotonic, sleep), 0)
+    assert process_job()
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(func.count())
+                .select_from(BackgroundJob)
+                .where(BackgroundJob.job_type == "purge_login_tokens")
+                .where(BackgroundJob.state == BackgroundJobState.completed)
+            ).scalar_one()
+            == 1
+        )
+
+
 def test_job_retry(db):
     with session_scope() as session:
         queue_job(session, "mock_job", empty_pb2.Empty())
@@ -455,6 +882,11 @@ def test_no_jobs_no_problem(db):
         assert session.execute(select(func.count()).select_from(BackgroundJob)).scalar_one() == 0
 
 
+def _run_for_users(handler, *users):
+    for user in users:
+        handler(jobs_pb2.MissedMessagesPayload(user_id=user.id))
+
+
 def test_send_message_notifications_basic(db):
     user1, token1 = generate_user()
     user2, token2 = generate_user()
@@ -464,7 +896,7 @@ def test_send_message_notifications_basic(db):
     make_friends(user1, user3)
     make_friends(user2, user3)
 
-    send_message_notifications(empty_pb2.Empty())
+    _run_for_users(send_message_notifications, user1, user2, user3)
     process_jobs()
 
     # should find no jobs, since there's no messages
@@ -492,7 +924,7 @@ def test_send_message_notifications_basic(db):
         c.SendMessage(conversations_pb2.SendMessageReq(group_chat_id=group_chat_id, text="Test message 5"))
         c.SendMessage(conversations_pb2.SendMessageReq(group_chat_id=group_chat_id, text="Test message 6"))
 
-    send_message_notifications(empty_pb2.Empty())
+    _run_for_users(send_message_notifications, user1, user2, user3)
     process_jobs()
 
     # no emails sent out
@@ -504,9 +936,23 @@ def test_send_message_notifications_basic(db):
             == 0
         )
 
+        # but the recipients have checks queued for once the messages are old enough
+        checks = session.execute(
+            select(BackgroundJob.payload, BackgroundJob.next_attempt_after)
+            .where(BackgroundJob.job_type == "send_message_notifications")
+            .where(BackgroundJob.state == BackgroundJobState.pending)
+        ).all()
+        assert {jobs_pb2.MissedMessagesPayload.FromString(payload).user_id for payload, _ in checks} == {
+            user2.id,
+            user3.id,
+        }
+        # one per user per minute, the messages were all sent within at most two minutes
+        assert len(checks) <= 4
+        assert all(next_attempt_after > now() + timedelta(minutes=4) for _, next_attempt_after in checks)
+
     # this should generate emails for both user2 and user3
     with patch("couchers.jobs.handlers.now", now_5_min_in_future):
-        send_message_notifications(empty_pb2.Empty())
+        _run_for_users(send_message_notifications, user1, user2, user3)
         process_jobs()
 
     with session_scope() as session:
@@ -521,7 +967,7 @@ def test_send_message_notifications_basic(db):
 
     # shouldn't generate any more emails
     with patch("couchers.jobs.handlers.now", now_5_min_in_future):
-        send_message_notifications(empty_pb2.Empty())
+        _run_for_users(send_message_notifications, user1, user2, user3)
         process_jobs()
 
     with session_scope() as session:
@@ -542,7 +988,7 @@ def test_send_message_notifications_muted(db):
     make_friends(user1, user3)
     make_friends(user2, user3)
 
-    send_message_notifications(empty_pb2.Empty())
+    _run_for_users(send_message_notifications, user1, user2, user3)
     process_jobs()
 
     # should find no jobs, since there's no messages
@@ -576,7 +1022,7 @@ def test_send_message_notifications_muted(db):
         c.SendMessage(conversations_pb2.SendMessageReq(group_chat_id=group_chat_id, text="Test message 5"))
         c.SendMessage(conversations_pb2.SendMessageReq(group_chat_id=group_chat_id, text="Test message 6"))
 
-    send_message_notifications(empty_pb2.Empty())
+    _run_for_users(send_message_notifications, user1, user2, user3)
     process_jobs()
 
     # no emails sent out
@@ -590,7 +1036,7 @@ def test_send_message_notifications_muted(db):
 
     # this should generate emails for both user2 and NOT user3
     with patch("couchers.jobs.handlers.now", now_5_min_in_future):
-        send_message_notifications(empty_pb2.Empty())
+        _run_for_users(send_message_notifications, user1, user2, user3)
         process_jobs()
 
     with session_scope() as session:
@@ -605,7 +1051,7 @@ def test_send_message_notifications_muted(db):
 
     # shouldn't generate any more emails
     with patch("couchers.jobs.handlers.now", now_5_min_in_future):
-        send_message_notifications(empty_pb2.Empty())
+        _run_for_users(send_message_notifications, user1, user2, user3)
         process_jobs()
 
     with session_scope() as session:
@@ -624,7 +1070,7 @@ def test_send_request_notifications_host_request(db):
     today_plus_2 = (today() + timedelta(days=2)).isoformat()
     today_plus_3 = (today() + timedelta(days=3)).isoformat()
 
-    send_request_notifications(empty_pb2.Empty())
+    _run_for_users(send_request_notifications, user1, user2)
     process_jobs()
 
     # should find no jobs, since there's no messages
@@ -645,7 +1091,7 @@ def test_send_request_notifications_host_request(db):
 
         # check send_request_notifications successfully creates background job
         with patch("couchers.jobs.handlers.now", now_5_min_in_future):
-            send_request_notifications(empty_pb2.Empty())
+            _run_for_users(send_request_notifications, user1, user2)
             process_jobs()
         assert (
             session.execute(
@@ -658,7 +1104,7 @@ def test_send_request_notifications_host_request(db):
         session.execute(delete(BackgroundJob).execution_options(synchronize_session=False))
 
         with patch("couchers.jobs.handlers.now", now_5_min_in_future):
-            send_request_notifications(empty_pb2.Empty())
+            _run_for_users(send_request_notifications, user1, user2)
             process_jobs()
         # should find no messages since host has already been notified
         assert (
@@ -684,7 +1130,7 @@ def test_send_request_notifications_host_request(db):
 
         # check send_request_notifications successfully creates background job
         with patch("couchers.jobs.handlers.now", now_5_min_in_future):
-            send_request_notifications(empty_pb2.Empty())
+            _run_for_users(send_request_notifications, user1, user2)
             process_jobs()
         assert (
             session.execute(
@@ -697,7 +1143,7 @@ def test_send_request_notifications_host_request(db):
         session.execute(delete(BackgroundJob).execution_options(synchronize_session=False))
 
         with patch("couchers.jobs.handlers.now", now_5_min_in_future):
-            send_request_notifications(empty_pb2.Empty())
+            _run_for_users(send_request_notifications, user1, user2)
             process_jobs()
         # should find no messages since guest has already been notified
         assert (
@@ -714,7 +1160,7 @@ def test_send_message_notifications_seen(db):
 
     make_friends(user1, user2)
 
-    send_message_notifications(empty_pb2.Empty())
+    _run_for_users(send_message_notifications, user1, user2)
 
     # should find no jobs, since there's no messages
     with session_scope() as session:
@@ -741,7 +1187,7 @@ def test_send_message_notifications_seen(db):
             conversations_pb2.MarkLastSeenGroupChatReq(group_chat_id=group_chat_id, last_seen_message_id=m_id)
         )
 
-    send_message_notifications(empty_pb2.Empty())
+    _run_for_users(send_message_notifications, user1, user2)
 
     # no emails sent out
     with session_scope() as session:
@@ -757,7 +1203,7 @@ def test_send_message_notifications_seen(db):
 
     # still shouldn't generate emails as user2 has seen all messages
     with patch("couchers.jobs.handlers.now", now_30_min_in_future):
-        send_message_notifications(empty_pb2.Empty())
+        _run_for_users(send_message_notifications, user1, user2)
 
     with session_scope() as session:
         assert (
@@ -954,6 +1400,82 @@ def test_update_recommendation_scores(db):
     update_recommendation_scores(empty_pb2.Empty())
 
 
+def _stale_recommendation_score_user_ids():
+    with session_scope() as session:
+        return set(session.execute(select(StaleRecommendationScore.user_id)).scalars())
+
+
+def test_update_stale_recommendation_scores(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    user3, token3 = generate_user()
+
+    # new users are stale straight away
+    assert _stale_recommendation_score_user_ids() == {user1.id, user2.id, user3.id}
+
+    # without the noise, recommendation_score is just the sum of the components
+    with patch("couchers.recommendation_scores._poor_man_gaussian", return_value=0):
+        update_stale_recommendation_scores(empty_pb2.Empty())
+    assert _stale_recommendation_score_user_ids() == set()
+    with session_scope() as session:
+        scores = {score.user_id: score for score in session.execute(select(UserRecommendationScore)).scalars().all()}
+        assert set(scores) == {user1.id, user2.id, user3.id}
+        # a short profile of someone who can't host: -5, and just signed up so active in the last 14 days: 1 + 2
+        assert scores[user1.id].profile_points == -5
+        assert scores[user1.id].reference_points == 0
+        assert scores[user1.id].activeness_points == 3
+        assert scores[user1.id].verification_points == 0
+        assert scores[user1.id].response_rate_points == 0
+        assert scores[user1.id].reference_count == 0
+        recommendation_score = session.execute(
+            select(User.recommendation_score).where(User.id == user1.id)
+        ).scalar_one()
+        assert recommendation_score == -2
+
+    # writes to the users table that don't go into the score don't make the user stale
+    with session_scope() as session:
+        session.execute(select(User).where(User.id == user3.id)).scalar_one().last_notified_message_id = 10
+    assert _stale_recommendation_score_user_ids() == set()
+
+    with session_scope() as session:
+        create_host_reference(session, user2.id, user1.id, timedelta(days=7))
+    assert user1.id in _stale_recommendation_score_user_ids()
+    assert user2.id in _stale_recommendation_score_user_ids()
+    assert user3.id not in _stale_recommendation_score_user_ids()
+
+    with api_session(token3) as api:
+        api.UpdateProfile(api_pb2.UpdateProfileReq(occupation=api_pb2.NullableStringValue(value="Tester")))
+    assert user3.id in _stale_recommendation_score_user_ids()
+
+    # less than one batch at a time
+    assert rs_update_stale_recommendation_scores(batch_size=2) == 3
+    assert _stale_recommendation_score_user_ids() == set()
+
+    def components():
+        with session_scope() as session:
+            return {
+                user_id: tuple(rest)
+                for user_id, *rest in session.execute(
+                    select(
+                        UserRecommendationScore.user_id,
+                        UserRecommendationScore.profile_points,
+                        UserRecommendationScore.reference_points,
+                        UserRecommendationScore.activeness_points,
+                        UserRecommendationScore.verification_points,
+                        UserRecommendationScore.response_rate_points,
+                        UserRecommendationScore.reference_count,
+                    )
+                ).all()
+            }
+
+    incremental = components()
+    assert incremental[user1.id][-1] == 1
+
+    # the stale runs left everyone where a full recompute puts them
+    update_all_recommendation_scores()
+    assert components() == incremental
+
+
 def test_update_badges(db, push_collector):
     user1, _ = generate_user()
     user2, _ = generate_user()
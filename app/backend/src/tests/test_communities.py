@@ -1,8 +1,10 @@
+import os
 from datetime import timedelta
 
 import grpc
 import pytest
 from google.protobuf import wrappers_pb2
+from sqlalchemy.sql import delete, func, text
 
 from couchers import errors
 from couchers.db import session_scope
@@ -17,6 +19,7 @@ from couchers.models import (
     PageVersion,
     SignupFlow,
     Thread,
+    User,
 )
 from couchers.sql import couchers_select as select
 from couchers.tasks import enforce_community_memberships
@@ -30,6 +33,7 @@ from tests.test_fixtures import (  # noqa
     discussions_session,
     events_session,
     generate_user,
+    generate_users_from_template,
     get_user_id_and_token,
     pages_session,
     recreate_database,
@@ -960,6 +964,125 @@ def test_LeaveCommunity_regression(db):
         assert not api.GetCommunity(communities_pb2.GetCommunityReq(community_id=c2_id)).member
 
 
+def _community_member_ids(session, node_id):
+    return set(
+        session.execute(
+            select(ClusterSubscription.user_id)
+            .join(Cluster, Cluster.id == ClusterSubscription.cluster_id)
+            .where(Cluster.parent_node_id == node_id)
+            .where(Cluster.is_official_cluster)
+        ).scalars()
+    )
+
+
+def test_enforce_community_memberships_incremental(db):
+    user1, _ = generate_user(geom=create_1d_point(1), geom_radius=0.1)
+    user2, _ = generate_user(geom=create_1d_point(1), geom_radius=0.1)
+    user3, _ = generate_user(geom=create_1d_point(30), geom_radius=0.1)
+
+    with session_scope() as session:
+        c0_id = create_community(session, 0, 20, "Community 0", [user1], [], None).id
+
+    enforce_community_memberships()
+    with session_scope() as session:
+        assert _community_member_ids(session, c0_id) == {user1.id, user2.id}
+        since = session.execute(select(func.now())).scalar_one()
+
+    # user3 moves in, and a user who is in the community but isn't a member (e.g. they left) doesn't get added back
+    with session_scope() as session:
+        session.execute(select(User).where(User.id == user3.id)).scalar_one().geom = create_1d_point(10)
+        session.execute(delete(ClusterSubscription).where(ClusterSubscription.user_id == user2.id))
+
+    enforce_community_memberships(since=since)
+    with session_scope() as session:
+        assert _community_member_ids(session, c0_id) == {user1.id, user3.id}
+        since = session.execute(select(func.now())).scalar_one()
+
+    # a new community picks up everyone in it
+    with session_scope() as session:
+        c1_id = create_community(session, 0, 5, "Community 1", [user3], [], None).id
+
+    enforce_community_memberships(since=since)
+    with session_scope() as session:
+        assert _community_member_ids(session, c1_id) == {user1.id, user2.id, user3.id}
+
+    # a full run adds everyone
+    enforce_community_memberships()
+    with session_scope() as session:
+        assert _community_member_ids(session, c0_id) == {user1.id, user2.id, user3.id}
+
+
+# set COMMUNITY_MEMBERSHIP_BENCHMARK_USERS=1000000 and COMMUNITY_MEMBERSHIP_BENCHMARK_NODES=5000 to try against a
+# realistically sized dataset
+COMMUNITY_MEMBERSHIP_BENCHMARK_USERS = int(os.environ.get("COMMUNITY_MEMBERSHIP_BENCHMARK_USERS", "2000"))
+COMMUNITY_MEMBERSHIP_BENCHMARK_NODES = int(os.environ.get("COMMUNITY_MEMBERSHIP_BENCHMARK_NODES", "50"))
+
+
+def test_enforce_community_memberships_many(db):
+    template_user, _ = generate_user()
+
+    # a grid of one degree square communities, twice as wide as it is high
+    cols = round((2 * COMMUNITY_MEMBERSHIP_BENCHMARK_NODES) ** 0.5)
+    rows = COMMUNITY_MEMBERSHIP_BENCHMARK_NODES // cols
+    random_point_in_grid = f"ST_SetSRID(ST_MakePoint(random() * {cols}, random() * {rows}), 4326)"
+
+    # users scattered at random over the grid
+    generate_users_from_template(template_user, COMMUNITY_MEMBERSHIP_BENCHMARK_USERS, geom=random_point_in_grid)
+    with session_scope() as session:
+        session.execute(
+            text(
+                "INSERT INTO nodes (geom) "
+                "SELECT ST_Multi(ST_MakeEnvelope(i % :cols, i / :cols, i % :cols + 1, i / :cols + 1, 4326)) "
+                "FROM generate_series(0, :num_nodes - 1) AS i"
+            ),
+            {"cols": cols, "num_nodes": cols * rows},
+        )
+        session.execute(
+            text(
+                "INSERT INTO clusters (parent_node_id, name, description, is_official_cluster) "
+                "SELECT id, 'Community ' || id, 'Description', true FROM nodes"
+            )
+        )
+        session.execute(text("ANALYZE nodes"))
+        session.execute(text("ANALYZE clusters"))
+
+    def memberships():
+        with session_scope() as session:
+            return set(session.execute(select(ClusterSubscription.user_id, ClusterSubscription.cluster_id)).all())
+
+    enforce_community_memberships()
+    full = memberships()
+    # every generated user is in exactly one of the grid cells, the template user is outside the grid
+    assert len(full) == COMMUNITY_MEMBERSHIP_BENCHMARK_USERS
+    assert len({user_id for user_id, _ in full}) == COMMUNITY_MEMBERSHIP_BENCHMARK_USERS
+
+    with session_scope() as session:
+        since = session.execute(select(func.now())).scalar_one()
+        # one in a hundred users moves
+        session.execute(
+            text(f"UPDATE users SET geom = {random_point_in_grid}, geom_updated = now() WHERE id % 100 = 0")
+        )
+        moved = set(
+            session.execute(
+                select(User.id, Cluster.id)
+                .join(Node, func.ST_Contains(Node.geom, User.geom))
+                .join(Cluster, Cluster.parent_node_id == Node.id)
+                .where(Cluster.is_official_cluster)
+                .where(User.geom_updated >= since)
+            ).all()
+        )
+    assert moved
+
+    # only the users that moved get memberships of the cells they moved to
+    enforce_community_memberships(since=since)
+    incremental = memberships()
+    assert incremental == full | moved
+
+    # and a full run has nothing left to add
+    enforce_community_memberships()
+    assert memberships() == incremental
+
+
 def test_enforce_community_memberships_for_user(testing_communities):
     """
     Make sure the user is added to the right communities on signup
@@ -1,26 +1,36 @@
+import os
 from datetime import timedelta
 
 import grpc
 import pytest
 from google.protobuf import wrappers_pb2
+from sqlalchemy.sql import func, text
 
 from couchers import errors
 from couchers.db import session_scope
 from couchers.jobs.worker import process_job
 from couchers.models import (
+    BackgroundJob,
+    Conversation,
+    GroupChat,
     GroupChatRole,
     GroupChatSubscription,
+    Message,
+    MessageType,
     Notification,
     NotificationDelivery,
     NotificationDeliveryType,
     NotificationTopicAction,
 )
+from couchers.servicers.conversations import generate_message_notifications
 from couchers.sql import couchers_select as select
 from couchers.utils import Duration_from_timedelta, now, to_aware_datetime
 from proto import api_pb2, conversations_pb2, notification_data_pb2, notifications_pb2
+from proto.internal import jobs_pb2
 from tests.test_fixtures import (  # noqa
     api_session,
     conversations_session,
+    count_sql_statements,
     db,
     generate_user,
     make_friends,
@@ -188,6 +198,137 @@ def test_list_group_chats_ordering(db):
         assert res.group_chats[4].title == "Chat 0"
 
 
+def test_generate_message_notifications_query_count(db):
+    author, _ = generate_user()
+    recipients = [generate_user()[0] for _ in range(20)]
+
+    def send_message(num_recipients):
+        with session_scope() as session:
+            conversation = Conversation()
+            group_chat = GroupChat(conversation=conversation, title="Chat", creator_id=author.id, is_dm=False)
+            session.add(group_chat)
+            session.add(GroupChatSubscription(user_id=author.id, group_chat=group_chat, role=GroupChatRole.admin))
+            for user in recipients[:num_recipients]:
+                session.add(
+                    GroupChatSubscription(user_id=user.id, group_chat=group_chat, role=GroupChatRole.participant)
+                )
+            session.flush()
+            message = Message(
+                conversation_id=conversation.id, author_id=author.id, text="Hi", message_type=MessageType.text
+            )
+            session.add(message)
+            session.flush()
+            return message.id
+
+    # warm up
+    generate_message_notifications(jobs_pb2.GenerateMessageNotificationsPayload(message_id=send_message(2)))
+
+    message_id = send_message(2)
+    with count_sql_statements() as statements_2:
+        generate_message_notifications(jobs_pb2.GenerateMessageNotificationsPayload(message_id=message_id))
+
+    message_id = send_message(20)
+    with count_sql_statements() as statements_20:
+        generate_message_notifications(jobs_pb2.GenerateMessageNotificationsPayload(message_id=message_id))
+
+    # the fan-out, missed messages checks included, doesn't depend on the number of recipients
+    assert len(statements_20) == len(statements_2)
+    # every recipient got a missed messages check
+    with session_scope() as session:
+        payloads = session.execute(
+            select(BackgroundJob.payload).where(BackgroundJob.job_type == "send_message_notifications")
+        ).scalars()
+        assert {jobs_pb2.MissedMessagesPayload.FromString(payload).user_id for payload in payloads} == {
+            user.id for user in recipients
+        }
+
+
+def test_list_group_chats_query_count(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    user3, token3 = generate_user()
+
+    with session_scope() as session:
+        for i in range(55):
+            conversation = Conversation()
+            group_chat = GroupChat(conversation=conversation, title=f"Chat {i}", creator_id=user1.id, is_dm=False)
+            session.add(group_chat)
+            session.add(GroupChatSubscription(user_id=user1.id, group_chat=group_chat, role=GroupChatRole.admin))
+            session.add(GroupChatSubscription(user_id=user2.id, group_chat=group_chat, role=GroupChatRole.participant))
+            if i % 2:
+                session.add(
+                    GroupChatSubscription(user_id=user3.id, group_chat=group_chat, role=GroupChatRole.participant)
+                )
+            session.flush()
+            session.add(
+                Message(conversation_id=conversation.id, author_id=user1.id, message_type=MessageType.chat_created)
+            )
+            session.add(
+                Message(conversation_id=conversation.id, author_id=user2.id, text="Hi", message_type=MessageType.text)
+            )
+
+    with conversations_session(token1) as c:
+        # warm up auth etc
+        c.ListGroupChats(conversations_pb2.ListGroupChatsReq(number=1))
+
+        with count_sql_statements() as statements_5:
+            res = c.ListGroupChats(conversations_pb2.ListGroupChatsReq(number=5))
+        assert len(res.group_chats) == 5
+
+        with count_sql_statements() as statements_50:
+            res = c.ListGroupChats(conversations_pb2.ListGroupChatsReq(number=50))
+        assert len(res.group_chats) == 50
+
+    # the number of queries doesn't depend on the number of chats on the page
+    assert len(statements_50) == len(statements_5)
+    assert len(statements_50) < 10
+
+    assert res.group_chats[0].title == "Chat 54"
+    assert res.group_chats[0].member_user_ids == [user1.id, user2.id]
+    assert res.group_chats[0].admin_user_ids == [user1.id]
+    assert res.group_chats[0].unseen_message_count == 2
+    assert res.group_chats[1].member_user_ids == [user1.id, user2.id, user3.id]
+
+
+def test_conversation_latest_message(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    make_friends(user1, user2)
+
+    def check(group_chat_id):
+        with session_scope() as session:
+            conversation = session.execute(select(Conversation).where(Conversation.id == group_chat_id)).scalar_one()
+            latest = session.execute(
+                select(Message).where(Message.conversation_id == group_chat_id).order_by(Message.id.desc()).limit(1)
+            ).scalar_one()
+            assert conversation.latest_message_id == latest.id
+            assert conversation.latest_message_time == latest.time
+            return latest
+
+    with conversations_session(token1) as c:
+        group_chat_id = c.CreateGroupChat(
+            conversations_pb2.CreateGroupChatReq(recipient_user_ids=[user2.id])
+        ).group_chat_id
+        check(group_chat_id)
+        c.SendMessage(conversations_pb2.SendMessageReq(group_chat_id=group_chat_id, text="Test message 1"))
+        assert check(group_chat_id).text == "Test message 1"
+
+    with conversations_session(token2) as c:
+        c.SendMessage(conversations_pb2.SendMessageReq(group_chat_id=group_chat_id, text="Test message 2"))
+        assert check(group_chat_id).text == "Test message 2"
+        res = c.ListGroupChats(conversations_pb2.ListGroupChatsReq())
+        assert res.group_chats[0].latest_message.text.text == "Test message 2"
+
+    with session_scope() as session:
+        # every conversation starts with a control message, so they all have a latest message
+        assert (
+            session.execute(
+                select(func.count()).select_from(Conversation).where(Conversation.latest_message_id == None)
+            ).scalar_one()
+            == 0
+        )
+
+
 def test_list_group_chats_ordering_after_left(db):
     # user is member to 4 group chats, and has left one.
     # The one user left has the most recent message, but user left before then,
@@ -896,6 +1037,65 @@ def test_search_messages_left_joined(db):
         assert res.results[2].message.text.text == "Test message 10"
 
 
+# set MESSAGE_SEARCH_BENCHMARK_MESSAGES=5000000 to try the search against a realistically sized dataset
+MESSAGE_SEARCH_BENCHMARK_MESSAGES = int(os.environ.get("MESSAGE_SEARCH_BENCHMARK_MESSAGES", "7000"))
+
+
+def test_search_messages_many(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    user3, token3 = generate_user()
+    make_friends(user1, user2)
+    make_friends(user2, user3)
+
+    with conversations_session(token1) as c:
+        own_chat_id = c.CreateGroupChat(
+            conversations_pb2.CreateGroupChatReq(recipient_user_ids=[user2.id])
+        ).group_chat_id
+    with conversations_session(token2) as c:
+        other_chat_id = c.CreateGroupChat(
+            conversations_pb2.CreateGroupChatReq(recipient_user_ids=[user3.id])
+        ).group_chat_id
+
+    # one in a hundred messages is in user1's chat, one in seven mentions hiking
+    with session_scope() as session:
+        session.execute(
+            text(
+                "INSERT INTO messages (conversation_id, author_id, message_type, time, text) "
+                "SELECT CASE WHEN i % 100 = 0 THEN :own_chat_id ELSE :other_chat_id END, :author_id, 'text', "
+                "now() + i * interval '1 millisecond', "
+                "'Message ' || md5(i::text) || CASE WHEN i % 7 = 0 THEN ' about hiking' ELSE '' END "
+                "FROM generate_series(1, :num_messages) AS i"
+            ),
+            {
+                "own_chat_id": own_chat_id,
+                "other_chat_id": other_chat_id,
+                "author_id": user2.id,
+                "num_messages": MESSAGE_SEARCH_BENCHMARK_MESSAGES,
+            },
+        )
+        session.execute(text("ANALYZE messages"))
+
+    results = []
+    last_message_id = 0
+    with conversations_session(token1) as c:
+        while True:
+            res = c.SearchMessages(
+                conversations_pb2.SearchMessagesReq(query="hiking", last_message_id=last_message_id, number=3)
+            )
+            results += res.results
+            if res.no_more:
+                break
+            last_message_id = res.last_message_id
+
+    # every matching message in user1's chat exactly once, newest first, and nothing from the other chat
+    message_ids = [result.message.message_id for result in results]
+    assert len(message_ids) == MESSAGE_SEARCH_BENCHMARK_MESSAGES // 700
+    assert message_ids == sorted(set(message_ids), reverse=True)
+    assert all(result.group_chat_id == own_chat_id for result in results)
+    assert all(result.message.text.text.endswith(" about hiking") for result in results)
+
+
 def test_admin_behaviour(db):
     user1, token1 = generate_user()
     user2, token2 = generate_user()
@@ -1,12 +1,18 @@
+import socket
+import socketserver
+from threading import Thread
+from types import SimpleNamespace
 from unittest.mock import patch
 
 import pytest
 
 import couchers.email
 import couchers.jobs.handlers
+import couchers.templates.v2
 from couchers.config import config
 from couchers.crypto import random_hex, urlsafe_secure_token
 from couchers.db import session_scope
+from couchers.email.smtp import SMTPConnectionPool, get_attachments, send_smtp_email, smtp_pool
 from couchers.models import (
     ContentReport,
     Email,
@@ -26,6 +32,7 @@ from couchers.tasks import (
     send_email_changed_confirmation_to_new_email,
     send_signup_email,
 )
+from couchers.templates.v2 import env, get_email_templates, render_email, template_folder
 from couchers.utils import Timestamp_from_datetime, now, timedelta
 from proto import admin_pb2, api_pb2, events_pb2, notification_data_pb2, notifications_pb2
 from tests.test_communities import create_community
@@ -50,6 +57,148 @@ def _(testconfig):
     pass
 
 
+def test_render_email():
+    template_args = {
+        "user": SimpleNamespace(name="Test User", timezone=None, avatar_thumbnail_url=None),
+        "badge_name": "Active Volunteer",
+        "actioned": "added to",
+        "unsub_type": "badge additions",
+        "_year": 2024,
+        "_timezone_display": "UTC",
+    }
+    plain_unsub_section = "\n\n---\n\nEdit your notification settings at <http://localhost:3000/account-settings>"
+    html_unsub_section = '<a href="http://localhost:3000/account-settings">Manage notification preferences</a>.'
+
+    plain, html = render_email("badge", template_args, plain_unsub_section, html_unsub_section)
+
+    # same output as splicing the unsubscribe section into the template source
+    plain_source = (template_folder / "badge.txt").read_text()
+    html_source = (template_folder / "generated_html" / "badge.html").read_text()
+    assert plain == env.from_string(plain_source + plain_unsub_section).render(template_args)
+    assert html == env.from_string(html_source.replace("___UNSUB_SECTION___", html_unsub_section)).render(template_args)
+    assert plain.endswith(plain_unsub_section)
+    assert html_unsub_section in html
+
+    # compiled once
+    assert get_email_templates("badge") is get_email_templates("badge")
+
+    # templates are picked up from disk every time with auto reload
+    config["EMAIL_TEMPLATE_AUTO_RELOAD"] = True
+    assert get_email_templates("badge") is not get_email_templates("badge")
+
+
+def test_render_email_many():
+    template_args = {
+        "user": SimpleNamespace(name="Test User", timezone=None, avatar_thumbnail_url=None),
+        "badge_name": "Active Volunteer",
+        "actioned": "added to",
+        "unsub_type": "badge additions",
+        "_year": 2024,
+        "_timezone_display": "UTC",
+    }
+    couchers.templates.v2._email_templates.clear()
+    with patch(
+        "couchers.templates.v2._load_email_templates", wraps=couchers.templates.v2._load_email_templates
+    ) as mock:
+        rendered = {render_email("badge", template_args, "", "") for _ in range(100)}
+    # parsed from disk once, and every render comes out the same
+    assert mock.call_count == 1
+    assert len(rendered) == 1
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """
+    Just enough of SMTP to accept mail from smtplib without TLS or auth
+    """
+
+    def handle(self):
+        self.server.connections.append(self.connection)
+        self.wfile.write(b"220 localhost stand-in\r\n")
+        data = None
+        for line in self.rfile:
+            if data is not None:
+                if line == b".\r\n":
+                    self.server.messages.append(b"".join(data))
+                    data = None
+                    self.wfile.write(b"250 OK\r\n")
+                else:
+                    data.append(line)
+                continue
+            command = line[:4].upper()
+            if command == b"DATA":
+                data = []
+                self.wfile.write(b"354 go ahead\r\n")
+            elif command == b"QUIT":
+                self.wfile.write(b"221 bye\r\n")
+                return
+            else:
+                self.wfile.write(b"250 OK\r\n")
+
+
+@pytest.fixture
+def smtp_server(monkeypatch):
+    server = socketserver.ThreadingTCPServer(("localhost", 0), _SMTPHandler)
+    server.daemon_threads = True
+    server.connections = []
+    server.messages = []
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    new_config = config.copy()
+    new_config["ENABLE_EMAIL"] = True
+    new_config["SMTP_HOST"] = "localhost"
+    new_config["SMTP_PORT"] = server.server_address[1]
+    monkeypatch.setattr(couchers.jobs.handlers, "config", new_config)
+    monkeypatch.setattr(couchers.email.smtp, "config", new_config)
+
+    smtp_pool.close_all()
+    yield server
+    smtp_pool.close_all()
+    server.shutdown()
+    server.server_close()
+
+
+def _send_test_email(i=0):
+    return send_smtp_email(
+        "Couchers.org",
+        "notify@couchers.org.invalid",
+        f"user{i}@couchers.org.invalid",
+        "subject",
+        "plain",
+        "<img src='attachment_imgs/logo-grey.png'>",
+        None,
+        None,
+    )
+
+
+def test_smtp_connection_reuse(smtp_server):
+    for i in range(3):
+        _send_test_email(i)
+    assert len(smtp_server.messages) == 3
+    assert len(smtp_server.connections) == 1
+    # the logo got attached from the cached attachment bytes
+    assert "attachment_imgs/logo-grey.png" in dict(get_attachments())
+    assert b"cid:" in smtp_server.messages[0]
+
+    # the server hangs up on us while the connection is sitting in the pool
+    pool = SMTPConnectionPool(noop_interval=timedelta(0), max_age=timedelta(minutes=10))
+    with patch("couchers.email.smtp.smtp_pool", pool):
+        _send_test_email()
+        smtp_server.connections[-1].shutdown(socket.SHUT_RDWR)
+        # the NOOP check notices and we reconnect
+        _send_test_email()
+        pool.close_all()
+    assert len(smtp_server.messages) == 5
+    assert len(smtp_server.connections) == 3
+
+
+def test_send_many_emails(smtp_server):
+    num_emails = 100
+    for i in range(num_emails):
+        _send_test_email(i)
+    assert len(smtp_server.messages) == num_emails
+    assert len(smtp_server.connections) == 1
+
+
 def test_signup_verification_email(db):
     request_email = f"{random_hex(12)}@couchers.org.invalid"
 
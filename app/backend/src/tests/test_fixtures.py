@@ -8,6 +8,7 @@ from unittest.mock import patch
 
 import grpc
 import pytest
+from sqlalchemy import event
 from sqlalchemy.orm import close_all_sessions
 from sqlalchemy.sql import or_, text
 
@@ -16,7 +17,9 @@ from couchers.constants import GUIDELINES_VERSION, TOS_VERSION
 from couchers.crypto import random_hex
 from couchers.db import _get_base_engine, session_scope
 from couchers.descriptor_pool import get_descriptor_pool
-from couchers.interceptors import AuthValidatorInterceptor, _try_get_and_update_user_details
+from couchers.email.smtp import smtp_pool
+from couchers.geojson_snapshots import geojson_snapshots
+from couchers.interceptors import AuthValidatorInterceptor, _try_get_user_details
 from couchers.jobs.worker import process_job
 from couchers.models import (
     Base,
@@ -35,6 +38,7 @@ from couchers.models import (
     UserBlock,
     UserSession,
 )
+from couchers.notifications.settings import preference_cache
 from couchers.servicers.account import Account, Iris
 from couchers.servicers.admin import Admin
 from couchers.servicers.api import API
@@ -58,6 +62,7 @@ from couchers.servicers.resources import Resources
 from couchers.servicers.search import Search
 from couchers.servicers.threads import Threads
 from couchers.sql import couchers_select as select
+from couchers.unread_counts import unread_counts_cache
 from couchers.utils import create_coordinate, now
 from proto import (
     account_pb2_grpc,
@@ -224,6 +229,11 @@ def db():
     """
 
     recreate_database()
+    # user ids start from scratch in the new database
+    preference_cache.clear()
+    smtp_pool.close_all()
+    unread_counts_cache.clear()
+    geojson_snapshots.clear()
 
 
 def generate_user(*, delete_user=False, complete_profile=False, **kwargs):
@@ -333,6 +343,31 @@ def generate_user(*, delete_user=False, complete_profile=False, **kwargs):
     return user, token
 
 
+def generate_users_from_template(template_user, num_users, **overrides):
+    """
+    Bulk inserts num_users copies of template_user in one statement, for datasets too big to make with generate_user
+
+    The copies only get a users row. Keyword arguments are SQL expressions for columns that should differ from the
+    template, and can use the index i of the copy, from 1 to num_users. The username and email are unique by default
+    """
+    overrides = {
+        "username": "username || '_' || i",
+        "email": "i || '_' || email",
+        **overrides,
+    }
+    columns = [column.name for column in User.__table__.columns if column.computed is None and column.name != "id"]
+    with session_scope() as session:
+        session.execute(
+            text(
+                f"INSERT INTO users ({', '.join(columns)}) "
+                f"SELECT {', '.join(overrides.get(name, name) for name in columns)} "
+                "FROM users, generate_series(1, :num_users) AS i WHERE users.id = :template_user_id"
+            ),
+            {"num_users": num_users, "template_user_id": template_user.id},
+        )
+        session.execute(text("ANALYZE users"))
+
+
 def get_user_id_and_token(session, username):
     user_id = session.execute(select(User).where(User.username == username)).scalar_one().id
     token = session.execute(select(UserSession).where(UserSession.user_id == user_id)).scalar_one().token
@@ -563,10 +598,19 @@ class FakeChannel:
         self._is_jailed = is_jailed
         self._is_superuser = is_superuser
         self._token_expiry = token_expiry
+        self._invocation_metadata = ()
+        # what the last call sent with send_initial_metadata
+        self.initial_metadata = None
 
     def abort(self, code, details):
         raise FakeRpcError(code, details)
 
+    def invocation_metadata(self):
+        return self._invocation_metadata
+
+    def send_initial_metadata(self, initial_metadata):
+        self.initial_metadata = initial_metadata
+
     def add_generic_rpc_handlers(self, generic_rpc_handlers):
         from grpc._server import _validate_generic_rpc_handlers
 
@@ -579,7 +623,10 @@ class FakeChannel:
 
         _check_user_perms(uri, self.user_id, self._is_jailed, self._is_superuser, self._token_expiry)
 
-        def fake_handler(request):
+        def fake_handler(request, metadata=()):
+            self._invocation_metadata = metadata
+            self.initial_metadata = None
+
             # Do a full serialization cycle on the request and the
             # response to catch accidental use of unserializable data.
             request = handler.request_deserializer(request_serializer(request))
@@ -593,7 +640,7 @@ class FakeChannel:
 
 def fake_channel(token=None):
     if token:
-        user_id, is_jailed, is_superuser, token_expiry = _try_get_and_update_user_details(token, is_api_key=False)
+        user_id, is_jailed, is_superuser, token_expiry = _try_get_user_details(token, is_api_key=False)
         return FakeChannel(user_id=user_id, is_jailed=is_jailed, is_superuser=is_superuser, token_expiry=token_expiry)
     return FakeChannel()
 
@@ -881,6 +928,24 @@ def fast_passwords():
             yield
 
 
+@contextmanager
+def count_sql_statements():
+    """
+    Collects the SQL statements sent to the database inside the block, used to catch N+1 query regressions
+    """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    engine = _get_base_engine()
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
 def process_jobs():
     while process_job():
         pass
@@ -1,2 +1,173 @@
+import gzip
+import json
+from datetime import timedelta
+
+import grpc
+import pytest
+from google.protobuf import empty_pb2
+
 # Test that gis and all its protobuf wrappers can be imported properly
 import couchers.servicers.gis  # noqa
+from couchers import errors
+from couchers.geojson_snapshots import GeoJSONSnapshots, geojson_snapshots
+from couchers.servicers.gis import GIS, NOT_MODIFIED_HEADER, _etag_matches
+from couchers.tiles import Tile, TileCache, tile_cache
+from proto import gis_pb2, gis_pb2_grpc, pages_pb2
+from tests.test_fixtures import (  # noqa
+    db,
+    fake_channel,
+    generate_user,
+    make_user_block,
+    pages_session,
+    testconfig,
+)
+
+
+@pytest.fixture(autouse=True)
+def _(testconfig):
+    tile_cache.clear()
+    geojson_snapshots.clear()
+
+
+def test_etag_matches():
+    assert _etag_matches('"abc"', '"abc"')
+    assert _etag_matches('W/"abc"', '"abc"')
+    assert _etag_matches('"def", "abc"', '"abc"')
+    assert _etag_matches("*", '"abc"')
+    assert not _etag_matches('"def"', '"abc"')
+    assert not _etag_matches(None, '"abc"')
+
+
+def test_tile_cache():
+    cache = TileCache(timedelta(minutes=1), max_tiles=2)
+    cache.put(1, Tile(data=b"1", etag="1"))
+    cache.put(2, Tile(data=b"2", etag="2"))
+    # 1 is now the most recently used
+    assert cache.get(1).data == b"1"
+    cache.put(3, Tile(data=b"3", etag="3"))
+    assert cache.get(2) is None
+    assert cache.get(1).data == b"1"
+    assert cache.get(3).data == b"3"
+
+    expired = TileCache(timedelta(seconds=-1), max_tiles=2)
+    expired.put(1, Tile(data=b"1", etag="1"))
+    assert expired.get(1) is None
+
+
+def test_geojson_snapshots():
+    builds = []
+
+    def build(session):
+        builds.append(session)
+        return b'{"type": "FeatureCollection", "features": []}'
+
+    snapshots = GeoJSONSnapshots(timedelta(minutes=1))
+    snapshot = snapshots.get(None, "places", build)
+    assert snapshots.get(None, "places", build) is snapshot
+    assert len(builds) == 1
+    assert gzip.decompress(snapshot.gzipped) == snapshot.data
+    assert snapshot.gzipped_etag != snapshot.etag
+
+    snapshots.invalidate(["guides"])
+    assert snapshots.get(None, "places", build) is snapshot
+    snapshots.invalidate(["places"])
+    snapshots.get(None, "places", build)
+    assert len(builds) == 2
+
+    expired = GeoJSONSnapshots(timedelta(seconds=-1))
+    expired.get(None, "places", build)
+    expired.get(None, "places", build)
+    assert len(builds) == 4
+
+
+def test_GetPlaces_snapshot(db):
+    _, token = generate_user()
+    channel = fake_channel(token)
+    gis_pb2_grpc.add_GISServicer_to_server(GIS(), channel)
+    api = gis_pb2_grpc.GISStub(channel)
+
+    res = api.GetPlaces(empty_pb2.Empty())
+    assert res.content_type == "application/json"
+    assert json.loads(res.data) == {"type": "FeatureCollection", "features": None}
+    metadata = dict(channel.initial_metadata)
+    assert "content-encoding" not in metadata
+    # edits show up right away, the etag saves resending unchanged layers
+    assert metadata["cache-control"] == "private, no-cache"
+    etag = metadata["etag"]
+
+    res = api.GetPlaces(empty_pb2.Empty(), metadata=(("if-none-match", etag),))
+    assert not res.data
+    assert dict(channel.initial_metadata)[NOT_MODIFIED_HEADER] == "1"
+
+    with pages_session(token) as pages_api:
+        pages_api.CreatePlace(
+            pages_pb2.CreatePlaceReq(
+                title="dummy title",
+                content="dummy content",
+                address="dummy address",
+                location=pages_pb2.Coordinate(lat=1, lng=1),
+            )
+        )
+
+    # the edit dropped the snapshot
+    res = api.GetPlaces(empty_pb2.Empty(), metadata=(("if-none-match", etag),))
+    assert len(json.loads(res.data)["features"]) == 1
+    assert dict(channel.initial_metadata)["etag"] != etag
+
+    res = api.GetPlaces(empty_pb2.Empty(), metadata=(("accept-encoding", "gzip, deflate, br"),))
+    metadata = dict(channel.initial_metadata)
+    assert metadata["content-encoding"] == "gzip"
+    assert len(json.loads(gzip.decompress(res.data))["features"]) == 1
+
+    res = api.GetGuides(empty_pb2.Empty(), metadata=(("accept-encoding", "gzip;q=0"),))
+    assert "content-encoding" not in dict(channel.initial_metadata)
+    assert json.loads(res.data)["features"] is None
+
+
+def test_GetUserTile(db):
+    user, token = generate_user()
+    other_user, _ = generate_user()
+    blocked_user, _ = generate_user()
+    make_user_block(user, blocked_user)
+
+    channel = fake_channel(token)
+    gis_pb2_grpc.add_GISServicer_to_server(GIS(), channel)
+    api = gis_pb2_grpc.GISStub(channel)
+
+    # clustered
+    res = api.GetUserTile(gis_pb2.GetTileReq(z=0, x=0, y=0))
+    assert res.content_type == "application/vnd.mapbox-vector-tile"
+    assert res.data
+    etag = dict(channel.initial_metadata)["etag"]
+
+    # not clustered
+    res = api.GetUserTile(gis_pb2.GetTileReq(z=12, x=0, y=0))
+    assert res.content_type == "application/vnd.mapbox-vector-tile"
+
+    res = api.GetUserTile(gis_pb2.GetTileReq(z=0, x=0, y=0), metadata=(("if-none-match", etag),))
+    assert not res.data
+    assert dict(channel.initial_metadata)[NOT_MODIFIED_HEADER] == "1"
+
+    # someone who hasn't blocked anyone sees the blocked user too
+    _, other_token = generate_user()
+    other_channel = fake_channel(other_token)
+    gis_pb2_grpc.add_GISServicer_to_server(GIS(), other_channel)
+    res = gis_pb2_grpc.GISStub(other_channel).GetUserTile(gis_pb2.GetTileReq(z=0, x=0, y=0))
+    assert dict(other_channel.initial_metadata)["etag"] != etag
+
+    with pytest.raises(grpc.RpcError) as e:
+        api.GetUserTile(gis_pb2.GetTileReq(z=0, x=1, y=0))
+    assert e.value.code() == grpc.StatusCode.INVALID_ARGUMENT
+    assert e.value.details() == errors.INVALID_TILE
+
+
+def test_GetCommunityTile(db):
+    _, token = generate_user()
+    channel = fake_channel(token)
+    gis_pb2_grpc.add_GISServicer_to_server(GIS(), channel)
+    api = gis_pb2_grpc.GISStub(channel)
+
+    for method in [api.GetCommunityTile, api.GetPlaceTile, api.GetGuideTile]:
+        res = method(gis_pb2.GetTileReq(z=2, x=1, y=1))
+        assert res.content_type == "application/vnd.mapbox-vector-tile"
+        assert "etag" in dict(channel.initial_metadata)
@@ -1,13 +1,19 @@
 from concurrent import futures
 from contextlib import contextmanager
+from select import select as wait_until_readable
+from unittest.mock import patch
 
 import grpc
 import pytest
 from google.protobuf import empty_pb2
+from sqlalchemy.sql import func
 
 from couchers import errors
+from couchers.api_call_log import _sanitized_bytes, api_call_log, get_sanitization_plan
+from couchers.auth_cache import AUTH_CACHE_NOTIFY_CHANNEL, auth_cache, handle_auth_cache_notify, session_activity
+from couchers.config import config
 from couchers.crypto import random_hex
-from couchers.db import session_scope
+from couchers.db import _get_base_engine, session_scope
 from couchers.interceptors import (
     AuthValidatorInterceptor,
     CookieInterceptor,
@@ -18,14 +24,16 @@ from couchers.metrics import servicer_duration_histogram
 from couchers.models import APICall, UserSession
 from couchers.servicers.account import Account
 from couchers.servicers.api import API
+from couchers.servicers.auth import delete_session
 from couchers.sql import couchers_select as select
-from proto import account_pb2, admin_pb2, api_pb2, auth_pb2
+from couchers.utils import now, timedelta
+from proto import account_pb2, admin_pb2, api_pb2, auth_pb2, search_pb2, threads_pb2
 from tests.test_fixtures import db, generate_user, real_admin_session, testconfig  # noqa
 
 
 @pytest.fixture(autouse=True)
 def _(testconfig):
-    pass
+    api_call_log.clear()
 
 
 @contextmanager
@@ -180,6 +188,8 @@ def test_tracing_interceptor_ok_open(db):
     with interceptor_dummy_api(TestRpc, interceptors=[TracingInterceptor()]) as call_rpc:
         call_rpc(empty_pb2.Empty())
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/testing.Test/TestRpc"
@@ -206,6 +216,8 @@ def test_tracing_interceptor_sensitive(db):
             auth_pb2.SignupFlowReq(account=auth_pb2.SignupAccount(password="should be removed", username="not removed"))
         )
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/testing.Test/TestRpc"
@@ -249,6 +261,8 @@ def test_tracing_interceptor_exception(db):
         with pytest.raises(Exception, match="Some error message"):
             call_rpc(auth_pb2.SignupAccount(password="should be removed", username="not removed"))
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/testing.Test/TestRpc"
@@ -276,6 +290,8 @@ def test_tracing_interceptor_abort(db):
         with pytest.raises(Exception, match="now a grpc abort"):
             call_rpc(auth_pb2.SignupAccount(password="should be removed", username="not removed"))
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/testing.Test/TestRpc"
@@ -290,6 +306,88 @@ def test_tracing_interceptor_abort(db):
     _check_histogram_labels("/testing.Test/TestRpc", "False", "Exception", "FAILED_PRECONDITION", 1)
 
 
+def test_sanitization_plan():
+    # no sensitive fields anywhere inside
+    assert get_sanitization_plan("org.couchers.api.search.UserSearchRes") is None
+    assert get_sanitization_plan("google.protobuf.Empty") is None
+    # only the paths leading to sensitive fields are kept
+    assert get_sanitization_plan("org.couchers.auth.AuthReq") == (("password",), ())
+    sensitive_fields, submessages = get_sanitization_plan("org.couchers.auth.SignupFlowReq")
+    assert sensitive_fields == ()
+    assert [name for name, _, _ in submessages] == ["account"]
+
+    req = auth_pb2.SignupFlowReq(account=auth_pb2.SignupAccount(password="should be removed", username="not removed"))
+    sanitized = auth_pb2.SignupFlowReq.FromString(_sanitized_bytes(req))
+    assert not sanitized.account.password
+    assert sanitized.account.username == "not removed"
+    # the original is left alone
+    assert req.account.password == "should be removed"
+
+    # unset submessages stay unset
+    assert not auth_pb2.SignupFlowReq.FromString(_sanitized_bytes(auth_pb2.SignupFlowReq())).HasField("account")
+
+
+def test_sanitized_bytes_large_responses():
+    # representative large responses
+    user_search_res = search_pb2.UserSearchRes(
+        results=[
+            search_pb2.Result(
+                rank=i,
+                user=api_pb2.User(
+                    user_id=i,
+                    username=f"user{i}",
+                    name="Test User",
+                    about_me="About me " * 200,
+                    language_abilities=[api_pb2.LanguageAbility(code="eng")] * 3,
+                    regions_visited=["US", "FR", "DE"] * 5,
+                ),
+            )
+            for i in range(50)
+        ]
+    )
+    get_thread_res = threads_pb2.GetThreadRes(
+        replies=[
+            threads_pb2.Reply(thread_id=i, content="Reply content " * 40, author_user_id=i, num_replies=3)
+            for i in range(100)
+        ]
+    )
+
+    # messages without sensitive fields are serialized directly without copying
+    with patch("couchers.api_call_log.deepcopy", side_effect=AssertionError("copied")):
+        for res in [user_search_res, get_thread_res]:
+            assert not get_sanitization_plan(res.DESCRIPTOR.full_name)
+            assert _sanitized_bytes(res) == res.SerializeToString()
+
+
+def test_tracing_interceptor_sampling(db):
+    config["API_CALL_LOG_SAMPLE_RATE"] = 0.0
+
+    def TestRpc(request, context):
+        return empty_pb2.Empty()
+
+    def FailingRpc(request, context):
+        context.abort(grpc.StatusCode.FAILED_PRECONDITION, "failed")
+
+    with interceptor_dummy_api(TestRpc, interceptors=[TracingInterceptor()]) as call_rpc:
+        call_rpc(empty_pb2.Empty())
+        call_rpc(empty_pb2.Empty())
+
+    with interceptor_dummy_api(FailingRpc, interceptors=[TracingInterceptor()]) as call_rpc:
+        with pytest.raises(grpc.RpcError):
+            call_rpc(empty_pb2.Empty())
+
+    # nothing is written until the queue is flushed
+    with session_scope() as session:
+        assert session.execute(select(func.count()).select_from(APICall)).scalar_one() == 0
+
+    api_call_log.flush()
+
+    # successful calls are sampled out, failures are always logged
+    with session_scope() as session:
+        trace = session.execute(select(APICall)).scalar_one()
+        assert trace.status_code == "FAILED_PRECONDITION"
+
+
 def test_auth_interceptor(db):
     super_user, super_token = generate_user(is_superuser=True)
     user, token = generate_user()
@@ -372,6 +470,94 @@ def test_auth_interceptor(db):
         assert e.value.details() == "Unauthorized"
 
 
+def test_auth_interceptor_cache(db):
+    super_user, super_token = generate_user(is_superuser=True)
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+
+    account = Account()
+
+    rpc_def = {
+        "rpc": account.GetAccountInfo,
+        "service_name": "org.couchers.api.account.Account",
+        "method_name": "GetAccountInfo",
+        "interceptors": [AuthValidatorInterceptor()],
+        "request_type": empty_pb2.Empty,
+        "response_type": account_pb2.GetAccountInfoRes,
+    }
+
+    with interceptor_dummy_api(**rpc_def) as call_rpc:
+        for _ in range(3):
+            res = call_rpc(empty_pb2.Empty(), metadata=(("cookie", f"couchers-sesh={token1}"),))
+            assert res.username == user1.username
+        res = call_rpc(empty_pb2.Empty(), metadata=(("cookie", f"couchers-sesh={token2}"),))
+        assert res.username == user2.username
+
+    # session activity is only written out on flush
+    with session_scope() as session:
+        assert session.execute(select(UserSession.api_calls).where(UserSession.token == token1)).scalar_one() == 0
+
+    session_activity.flush()
+
+    with session_scope() as session:
+        assert session.execute(select(UserSession.api_calls).where(UserSession.token == token1)).scalar_one() == 3
+        assert session.execute(select(UserSession.api_calls).where(UserSession.token == token2)).scalar_one() == 1
+
+    # logging out drops the cached session
+    assert delete_session(token1)
+
+    # banning drops all cached sessions of that user
+    with real_admin_session(super_token) as api:
+        api.BanUser(admin_pb2.BanUserReq(user=user2.username, admin_note="spam"))
+
+    with interceptor_dummy_api(**rpc_def) as call_rpc:
+        for token in [token1, token2]:
+            with pytest.raises(grpc.RpcError) as e:
+                call_rpc(empty_pb2.Empty(), metadata=(("cookie", f"couchers-sesh={token}"),))
+            assert e.value.code() == grpc.StatusCode.UNAUTHENTICATED
+
+
+def test_auth_cache_notify(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+    expiry = now() + timedelta(hours=1)
+
+    def fill_cache():
+        auth_cache.clear()
+        auth_cache.put(token1, False, (user1.id, False, False, expiry))
+        auth_cache.put(token2, False, (user2.id, False, False, expiry))
+
+    # what another process sees
+    fill_cache()
+    handle_auth_cache_notify(f"user:{user1.id}")
+    assert not auth_cache.get(token1, False)
+    assert auth_cache.get(token2, False)
+
+    connection = _get_base_engine().raw_connection()
+    try:
+        dbapi_connection = connection.driver_connection
+        dbapi_connection.autocommit = True
+        with dbapi_connection.cursor() as cursor:
+            cursor.execute(f"LISTEN {AUTH_CACHE_NOTIFY_CHANNEL};")
+
+        # logging out is announced without the token itself
+        assert delete_session(token2)
+        wait_until_readable([dbapi_connection], [], [], 10)
+        dbapi_connection.poll()
+        payloads = [notify.payload for notify in dbapi_connection.notifies]
+    finally:
+        connection.invalidate()
+
+    assert len(payloads) == 1
+    assert payloads[0].startswith("token:")
+    assert token2 not in payloads[0]
+
+    fill_cache()
+    handle_auth_cache_notify(payloads[0])
+    assert auth_cache.get(token1, False)
+    assert not auth_cache.get(token2, False)
+
+
 def test_tracing_interceptor_auth_cookies(db):
     user, token = generate_user()
 
@@ -391,6 +577,8 @@ def test_tracing_interceptor_auth_cookies(db):
         res1 = call_rpc(empty_pb2.Empty(), metadata=(("cookie", f"couchers-sesh={token}"),))
     assert res1.username == user.username
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/org.couchers.api.account.Account/GetAccountInfo"
@@ -428,6 +616,8 @@ def test_tracing_interceptor_auth_api_key(db):
         res1 = call_rpc(empty_pb2.Empty(), metadata=(("authorization", f"Bearer {api_key}"),))
     assert res1.username == user.username
 
+    api_call_log.flush()
+
     with session_scope() as session:
         trace = session.execute(select(APICall)).scalar_one()
         assert trace.method == "/org.couchers.api.account.Account/GetAccountInfo"
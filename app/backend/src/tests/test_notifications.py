@@ -1,31 +1,54 @@
 import json
+import os
 import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
 from urllib.parse import parse_qs, urlparse
 
 import grpc
+import http_ece
 import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
 from google.protobuf import empty_pb2
+from sqlalchemy.sql import func
 
 from couchers import errors
+from couchers.config import config
 from couchers.crypto import b64decode
 from couchers.jobs.worker import process_job
 from couchers.models import (
+    BackgroundJob,
+    BackgroundJobState,
     HostingStatus,
     MeetupStatus,
     Notification,
     NotificationDelivery,
     NotificationDeliveryType,
+    NotificationPreference,
     NotificationTopicAction,
+    PushNotificationDeliveryAttempt,
+    PushNotificationSubscription,
     User,
 )
-from couchers.notifications.notify import notify
+from couchers.notifications.background import send_raw_push_notifications
+from couchers.notifications.notify import notify, notify_many
+from couchers.notifications.push import push_to_subscriptions
+from couchers.notifications.push_api import close_http_sessions, send_push
+from couchers.notifications.settings import (
+    get_preference,
+    get_preferences,
+    handle_preferences_changed_notify,
+    set_preference,
+)
 from couchers.sql import couchers_select as select
 from proto import api_pb2, auth_pb2, conversations_pb2, notification_data_pb2, notifications_pb2
-from proto.internal import unsubscribe_pb2
+from proto.internal import jobs_pb2, unsubscribe_pb2
 from tests.test_fixtures import (  # noqa
     api_session,
     auth_api_session,
     conversations_session,
+    count_sql_statements,
     db,
     email_fields,
     generate_user,
@@ -93,6 +116,117 @@ def test_SetNotificationSettings_preferences_respected_editable(db, enabled):
             assert deliv is None
 
 
+def test_notify_many(db, push_collector):
+    users = [generate_user()[0] for _ in range(5)]
+
+    def badge_data():
+        return notification_data_pb2.BadgeAdd(
+            badge_id="volunteer",
+            badge_name="Active Volunteer",
+            badge_description="This user is an active volunteer for Couchers.org",
+        )
+
+    with session_scope() as session:
+        with count_sql_statements() as statements:
+            notify_many(session, user_data=[(user.id, badge_data()) for user in users], topic_action="badge:add")
+        # one insert for the notifications, one for the jobs, one to wake the worker
+        assert len(statements) == 3
+
+    with session_scope() as session:
+        notifications = session.execute(select(Notification).order_by(Notification.id)).scalars().all()
+        assert [notification.user_id for notification in notifications] == [user.id for user in users]
+        assert all(notification.topic_action == NotificationTopicAction.badge__add for notification in notifications)
+
+        jobs = session.execute(select(BackgroundJob).order_by(BackgroundJob.id)).scalars().all()
+        assert [job.job_type for job in jobs] == ["handle_notification"] * len(users)
+        assert [jobs_pb2.HandleNotificationPayload.FromString(job.payload).notification_id for job in jobs] == [
+            notification.id for notification in notifications
+        ]
+
+    process_jobs()
+
+    for user in users:
+        push_collector.assert_user_has_single_matching(
+            user.id, title="The Active Volunteer badge was added to your profile"
+        )
+
+
+def test_notify_many_statements_dont_grow_with_users(db):
+    num_users = 200
+    user_ids = [generate_user()[0].id for _ in range(num_users)]
+
+    with session_scope() as session:
+        with count_sql_statements() as statements:
+            notify_many(
+                session,
+                user_data=[(user_id, notification_data_pb2.BadgeAdd()) for user_id in user_ids],
+                topic_action="badge:add",
+            )
+        # the same three statements as for the five users in test_notify_many
+        assert len(statements) == 3
+
+    with session_scope() as session:
+        assert session.execute(select(func.count()).select_from(Notification)).scalar_one() == num_users
+        assert session.execute(select(func.count()).select_from(BackgroundJob)).scalar_one() == num_users
+
+
+def test_get_preferences(db):
+    user1, token1 = generate_user()
+    user2, token2 = generate_user()
+
+    chat_message = NotificationTopicAction.chat__message
+    badge_add = NotificationTopicAction.badge__add
+
+    with session_scope() as session:
+        set_preference(session, user1.id, chat_message, NotificationDeliveryType.push, False)
+        set_preference(session, user1.id, chat_message, NotificationDeliveryType.email, True)
+
+    with session_scope() as session:
+        with count_sql_statements() as statements:
+            preferences = get_preferences(
+                session,
+                [(user1.id, chat_message), (user1.id, badge_add), (user2.id, chat_message), (user2.id, badge_add)],
+                use_cache=False,
+            )
+        assert len(statements) == 1
+
+    assert preferences[user1.id, chat_message] == [NotificationDeliveryType.email, NotificationDeliveryType.digest]
+    for user_id, topic_action in [(user1.id, badge_add), (user2.id, chat_message), (user2.id, badge_add)]:
+        assert preferences[user_id, topic_action] == [
+            dt for dt in NotificationDeliveryType if dt in topic_action.defaults
+        ]
+
+
+def test_preference_cache(db):
+    user, token = generate_user()
+
+    topic_action = NotificationTopicAction.chat__message
+
+    with session_scope() as session:
+        assert NotificationDeliveryType.push in get_preference(session, user.id, topic_action)
+
+        # cached now
+        with count_sql_statements() as statements:
+            assert NotificationDeliveryType.push in get_preference(session, user.id, topic_action)
+        assert len(statements) == 0
+
+    # changing a preference drops the cached copy once committed
+    with session_scope() as session:
+        set_preference(session, user.id, topic_action, NotificationDeliveryType.push, False)
+
+    with session_scope() as session:
+        assert NotificationDeliveryType.push not in get_preference(session, user.id, topic_action)
+
+    # a change made in another process gets to the worker through NOTIFY
+    with session_scope() as session:
+        session.execute(select(NotificationPreference)).scalar_one().deliver = True
+
+    with session_scope() as session:
+        assert NotificationDeliveryType.push not in get_preference(session, user.id, topic_action)
+        handle_preferences_changed_notify(str(user.id))
+        assert NotificationDeliveryType.push in get_preference(session, user.id, topic_action)
+
+
 def test_SetNotificationSettings_preferences_not_editable(db):
     user, token = generate_user()
 
@@ -403,3 +537,170 @@ def test_SendTestPushNotification(db, push_collector):
         title="Checking push notifications work!",
         body="If you see this, then it's working :)",
     )
+
+
+class _PushServiceHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.server.pushes.append((self.client_address, self.path, self.headers["authorization"], body))
+        status = 410 if self.path == "/gone" else 201
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def push_server():
+    server = ThreadingHTTPServer(("localhost", 0), _PushServiceHandler)
+    server.daemon_threads = True
+    server.pushes = []
+    server.url = f"http://localhost:{server.server_address[1]}"
+    Thread(target=server.serve_forever, daemon=True).start()
+    close_http_sessions()
+    yield server
+    close_http_sessions()
+    server.shutdown()
+    server.server_close()
+
+
+def _gen_subscription_keys():
+    receiver_private_key = ec.generate_private_key(ec.SECP256R1())
+    p256dh_key = receiver_private_key.public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+    return receiver_private_key, os.urandom(16), p256dh_key
+
+
+def test_send_push_reuses_connection_and_vapid(push_server):
+    receiver_private_key, auth_key, p256dh_key = _gen_subscription_keys()
+    for i in range(3):
+        resp = send_push(
+            f"push {i}".encode(),
+            f"{push_server.url}/sub",
+            auth_key,
+            p256dh_key,
+            config["PUSH_NOTIFICATIONS_VAPID_SUBJECT"],
+            config["PUSH_NOTIFICATIONS_VAPID_PRIVATE_KEY"],
+        )
+        assert resp.status_code == 201
+
+    assert len(push_server.pushes) == 3
+    # one keep-alive connection
+    assert len({client_address for client_address, _, _, _ in push_server.pushes}) == 1
+    # the signed claim is reused
+    assert len({authorization for _, _, authorization, _ in push_server.pushes}) == 1
+    # each push is still encrypted separately
+    assert [
+        http_ece.decrypt(body, private_key=receiver_private_key, auth_secret=auth_key)
+        for _, _, _, body in push_server.pushes
+    ] == [b"push 0", b"push 1", b"push 2"]
+
+
+def test_send_raw_push_notifications(db, push_server):
+    user, _ = generate_user()
+    with session_scope() as session:
+        sub_ids = []
+        for path in ["/sub1", "/sub2", "/gone"]:
+            _, auth_key, p256dh_key = _gen_subscription_keys()
+            sub = PushNotificationSubscription(
+                user_id=user.id,
+                endpoint=push_server.url + path,
+                auth_key=auth_key,
+                p256dh_key=p256dh_key,
+                full_subscription_info="{}",
+            )
+            session.add(sub)
+            session.flush()
+            sub_ids.append(sub.id)
+        push_to_subscriptions(session, sub_ids, title="title", body="body")
+
+    with session_scope() as session:
+        assert (
+            session.execute(
+                select(BackgroundJob.job_type).where(BackgroundJob.state == BackgroundJobState.pending)
+            ).scalar_one()
+            == "send_raw_push_notifications"
+        )
+
+    process_jobs()
+
+    assert sorted(path for _, path, _, _ in push_server.pushes) == ["/gone", "/sub1", "/sub2"]
+    with session_scope() as session:
+        attempts = session.execute(select(PushNotificationDeliveryAttempt)).scalars().all()
+        assert sorted(attempt.status_code for attempt in attempts) == [201, 201, 410]
+        disabled = (
+            session.execute(
+                select(PushNotificationSubscription.endpoint).where(
+                    PushNotificationSubscription.disabled_at < func.now()
+                )
+            )
+            .scalars()
+            .all()
+        )
+        assert disabled == [push_server.url + "/gone"]
+        assert (
+            session.execute(
+                select(func.count())
+                .select_from(BackgroundJob)
+                .where(BackgroundJob.state != BackgroundJobState.completed)
+            ).scalar_one()
+            == 0
+        )
+
+
+def test_send_raw_push_notifications_skips_unsendable(db, push_server):
+    user, _ = generate_user()
+    with session_scope() as session:
+        _, auth_key, p256dh_key = _gen_subscription_keys()
+        sub = PushNotificationSubscription(
+            user_id=user.id,
+            endpoint=push_server.url + "/sub",
+            auth_key=auth_key,
+            p256dh_key=p256dh_key,
+            full_subscription_info="{}",
+        )
+        session.add(sub)
+        session.flush()
+        sub_id = sub.id
+
+    send_raw_push_notifications(
+        jobs_pb2.SendRawPushNotificationsPayload(
+            pushes=[
+                # deleted subscription
+                jobs_pb2.SendRawPushNotificationPayload(push_notification_subscription_id=sub_id + 1, data=b"a"),
+                # too long to ever be sent
+                jobs_pb2.SendRawPushNotificationPayload(push_notification_subscription_id=sub_id, data=b"b" * 4000),
+                jobs_pb2.SendRawPushNotificationPayload(push_notification_subscription_id=sub_id, data=b"c"),
+            ]
+        )
+    )
+
+    assert len(push_server.pushes) == 1
+    with session_scope() as session:
+        attempts = session.execute(select(PushNotificationDeliveryAttempt)).scalars().all()
+        assert [(attempt.push_notification_subscription_id, attempt.success) for attempt in attempts] == [
+            (sub_id, True)
+        ]
+        # nothing is requeued
+        assert session.execute(select(func.count()).select_from(BackgroundJob)).scalar_one() == 0
+
+
+def test_send_push_many(push_server):
+    _, auth_key, p256dh_key = _gen_subscription_keys()
+    endpoint = f"{push_server.url}/sub"
+    vapid_sub = config["PUSH_NOTIFICATIONS_VAPID_SUBJECT"]
+    vapid_private_key = config["PUSH_NOTIFICATIONS_VAPID_PRIVATE_KEY"]
+    num_pushes = 100
+
+    for _ in range(num_pushes):
+        resp = send_push(b"push", endpoint, auth_key, p256dh_key, vapid_sub, vapid_private_key)
+        assert resp.status_code == 201
+
+    assert len(push_server.pushes) == num_pushes
+    assert len({client_address for client_address, _, _, _ in push_server.pushes}) == 1
+    assert len({authorization for _, _, authorization, _ in push_server.pushes}) == 1
@@ -1,21 +1,40 @@
+import os
 from datetime import timedelta
+from time import monotonic, sleep
 
 import pytest
 from google.protobuf import wrappers_pb2
+from sqlalchemy import event
+from sqlalchemy.sql import func, literal_column, or_, text
 
+import couchers.servicers.search
 from couchers.db import session_scope
-from couchers.models import EventOccurrence, MeetupStatus
+from couchers.models import EventOccurrence, MeetupStatus, User
+from couchers.recommendation_scores import update_stale_recommendation_scores
+from couchers.servicers.search import (
+    REGCONFIG,
+    TRI_SIMILARITY_THRESHOLD,
+    TRI_SIMILARITY_WEIGHT,
+    _build_doc,
+    _gen_search_elements,
+    _run_sub_search,
+)
+from couchers.sql import couchers_select as select
 from couchers.utils import Timestamp_from_datetime, create_coordinate, millis_from_dt, now
 from proto import api_pb2, communities_pb2, events_pb2, search_pb2
 from tests.test_communities import create_community, testing_communities  # noqa
 from tests.test_fixtures import (  # noqa
     communities_session,
+    count_sql_statements,
     db,
     events_session,
     generate_user,
+    generate_users_from_template,
+    make_friends,
     search_session,
     testconfig,
 )
+from tests.test_references import create_host_reference
 
 
 @pytest.fixture(autouse=True)
@@ -47,6 +66,54 @@ def test_Search(testing_communities):
                 include_guides=True,
             )
         )
+        assert not res.partial_results
+
+
+def test_Search_partial_results(db, monkeypatch):
+    """
+    A sub-search that runs past the deadline is left out, and the rest is still returned
+    """
+    user, token = generate_user()
+
+    def slow_search_events(session, *args):
+        session.execute(select(func.pg_sleep(5)))
+        return []
+
+    monkeypatch.setattr(couchers.servicers.search, "SEARCH_TIMEOUT", timedelta(seconds=0.5))
+    monkeypatch.setattr(couchers.servicers.search, "_search_events", slow_search_events)
+
+    with search_session(token) as api:
+        res = api.Search(search_pb2.SearchReq(query=user.username, include_users=True))
+    assert res.partial_results
+    assert user.id in [result.user.user_id for result in res.results]
+
+
+def test_run_sub_search_deadline():
+    def search(session):
+        raise AssertionError("ran without a timeout")
+
+    # less than a millisecond left would round down to statement_timeout=0, which means no timeout
+    with pytest.raises(TimeoutError):
+        _run_sub_search(monotonic() + 0.0005, search)
+
+
+def test_run_sub_search_deadline_between_statements(db):
+    statements = []
+
+    def search(session):
+        # each statement is well within the deadline, but the sub-search as a whole isn't
+        for _ in range(5):
+            statements.append(session.execute(select(func.current_setting("statement_timeout"))).scalar_one())
+            sleep(0.2)
+
+    start = monotonic()
+    with pytest.raises(TimeoutError):
+        _run_sub_search(monotonic() + 0.5, search)
+    assert monotonic() - start < 1
+    assert len(statements) == 3
+    # the timeout is what's left of the deadline before each statement
+    assert all(int(timeout.removesuffix("ms")) <= 500 for timeout in statements)
+    assert int(statements[0].removesuffix("ms")) > int(statements[-1].removesuffix("ms"))
 
 
 def test_UserSearch(testing_communities):
@@ -57,6 +124,124 @@ def test_UserSearch(testing_communities):
         assert len(res.results) > 0
 
 
+def test_UserSearch_query_count(db):
+    """
+    Serializing a page of users should take the same number of queries regardless of how many users are on the page
+    """
+    user, token = generate_user()
+    friend, _ = generate_user(complete_profile=True)
+    make_friends(user, friend)
+
+    with search_session(token) as api:
+        with count_sql_statements() as statements_small:
+            res = api.UserSearch(search_pb2.UserSearchReq())
+        assert len(res.results) == 2
+
+    for i in range(48):
+        other_user, _ = generate_user(complete_profile=i % 2 == 0)
+        if i % 3 == 0:
+            make_friends(other_user, user)
+
+    with search_session(token) as api:
+        with count_sql_statements() as statements_large:
+            res = api.UserSearch(search_pb2.UserSearchReq(page_size=50))
+        assert len(res.results) == 50
+
+    assert len(statements_large) == len(statements_small)
+
+
+# set SEARCH_BENCHMARK_USERS=500000 to try the search against a realistically sized dataset
+SEARCH_BENCHMARK_USERS = int(os.environ.get("SEARCH_BENCHMARK_USERS", "2000"))
+
+
+def _search_users_before_stored_tsvector(session, query, page_size):
+    """
+    The user search query as it was when the tsvector was built for every row at query time
+    """
+    tsq = func.websearch_to_tsquery(REGCONFIG, query)
+    tsv = literal_column(str(User.__table__.c.search_tsv.computed.sqltext))
+    sim = func.word_similarity(func.unaccent(query), func.unaccent(User.username + " " + User.name))
+    rank = (TRI_SIMILARITY_WEIGHT * sim + func.ts_rank_cd(tsv, tsq)).label("rank")
+    doc = _build_doc([User.username, User.name], [User.city], [User.about_me])
+    snippet = func.ts_headline(REGCONFIG, doc, tsq, "StartSel=**,StopSel=**").label("snippet")
+    return session.execute(
+        select(User.id, rank, snippet)
+        .where(or_(tsv.op("@@")(tsq), sim > TRI_SIMILARITY_THRESHOLD))
+        .order_by(rank.desc())
+        .limit(page_size + 1)
+    ).all()
+
+
+def _search_users_with_stored_tsvector(session, query, page_size):
+    rank, snippet, execute_search_statement = _gen_search_elements(
+        query,
+        False,
+        None,
+        page_size,
+        User.username + " " + User.name,
+        User.search_tsv,
+        [User.username, User.name],
+        [User.city],
+        [User.about_me],
+    )
+    return execute_search_statement(session, select(User.id, rank, snippet))
+
+
+def _search_query_plan(search, query):
+    """
+    Runs the search with sequential scans discouraged and returns the query plan of the search statement
+    """
+    with session_scope() as session:
+        session.execute(text("SET LOCAL enable_seqscan = off"))
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        connection = session.connection()
+        event.listen(connection, "before_cursor_execute", before_cursor_execute)
+        try:
+            search(session, query, 10)
+        finally:
+            event.remove(connection, "before_cursor_execute", before_cursor_execute)
+
+        statement, parameters = statements[-1]
+        return "\n".join(connection.exec_driver_sql("EXPLAIN " + statement, parameters).scalars())
+
+
+def test_search_users_stored_tsvector(db):
+    template, _ = generate_user(complete_profile=True)
+    generate_users_from_template(
+        template,
+        SEARCH_BENCHMARK_USERS,
+        username="'benchmark_' || i",
+        name="initcap(left(md5(i::text), 8)) || ' ' || (ARRAY['Baggins', 'Gamgee', 'Took', 'Brandybuck'])[i % 4 + 1]",
+        about_me="'I like ' || (ARRAY['hiking', 'cooking', 'sailing', 'climbing', 'painting'])[i % 5 + 1] || "
+        "' and ' || md5((i * 7)::text)",
+    )
+
+    with session_scope() as session:
+        user_id, name = session.execute(select(User.id, User.name).where(User.username == "benchmark_777")).one()
+
+    for query in [name, "climbing"]:
+        with session_scope() as session:
+            before = _search_users_before_stored_tsvector(session, query, 10)
+        with session_scope() as session:
+            after = _search_users_with_stored_tsvector(session, query, 10)
+
+        # same ranking as building the tsvector at query time
+        assert len(after) == 11
+        assert [round(rank, 6) for _, rank, _ in before] == [round(rank, 6) for _, rank, _ in after]
+        if query == name:
+            assert after[0].id == user_id
+
+        # both sides of the match can be answered from an index
+        plan = _search_query_plan(_search_users_with_stored_tsvector, query)
+        assert "ix_users_search_tsv" in plan
+        assert "ix_users_search_title_trgm" in plan
+        assert "Seq Scan on users" not in plan
+
+
 def test_regression_search_in_area(db):
     """
     Makes sure search_in_area works.
@@ -158,6 +343,22 @@ def test_user_filter_meetup_status(db):
         assert [result.user.user_id for result in res.results] == [user_does_not_want_to_meet.id]
 
 
+def test_user_filter_only_with_references(db):
+    user1, token1 = generate_user()
+    user2, _ = generate_user()
+    user3, _ = generate_user()
+
+    # two references, user1 should still only show up once
+    with session_scope() as session:
+        create_host_reference(session, user2.id, user1.id, timedelta(days=7))
+        create_host_reference(session, user3.id, user1.id, timedelta(days=7))
+    update_stale_recommendation_scores()
+
+    with search_session(token1) as api:
+        res = api.UserSearch(search_pb2.UserSearchReq(only_with_references=True))
+        assert [result.user.user_id for result in res.results] == [user1.id]
+
+
 @pytest.fixture
 def sample_event_data() -> dict:
     """Dummy data for creating events."""
@@ -1,6 +1,15 @@
 #!/bin/sh
 /bin/sed -i 's/{VICTORIAMETRICS_API_KEY}/'$VICTORIAMETRICS_API_KEY'/' /etc/prometheus/prometheus.yml
 /bin/sed -i 's/{PROMETHEUS_ENVIRONMENT}/'$PROMETHEUS_ENVIRONMENT'/' /etc/prometheus/prometheus.yml
+# each job worker process serves its metrics on its own port, 8001 and up, this should match the backend's
+# JOB_WORKER_PROCESSES
+BACKEND_JOBS_TARGETS='"backend:8001"'
+i=1
+while [ "$i" -lt "${JOB_WORKER_PROCESSES:-1}" ]; do
+  BACKEND_JOBS_TARGETS="$BACKEND_JOBS_TARGETS, \"backend:$((8001 + i))\""
+  i=$((i + 1))
+done
+/bin/sed -i 's/{BACKEND_JOBS_TARGETS}/'"$BACKEND_JOBS_TARGETS"'/' /etc/prometheus/prometheus.yml
 /bin/prometheus --config.file=/etc/prometheus/prometheus.yml \
              --storage.tsdb.path=/prometheus \
              --web.console.libraries=/usr/share/prometheus/console_libraries \